@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from core.cache import LocalLRUCache
+from .models import User
+
+"""
+    Authenticated identity cache, shared by REST (`CustomJWTAuthentication`) and websocket (`TokenAuthMiddleware`) auth.
+    Every user identity is a projection of `User` row (without password) plus `has_profile` flag, cached in
+    `IDENTITY_CACHE_ALIAS` cache and in process LRU tier, both are invalidated on `User`/`Profile` changes
+    (see `authentication.signals`). Bumping `IDENTITY_CACHE_VERSION` drops all entries when projection changes.
+"""
+
+IDENTITY_CACHE_ALIAS = getattr(settings, 'IDENTITY_CACHE_ALIAS', 'default')
+IDENTITY_CACHE_TTL = getattr(settings, 'IDENTITY_CACHE_TTL', 60 * 60)
+IDENTITY_CACHE_VERSION = getattr(settings, 'IDENTITY_CACHE_VERSION', 1)
+IDENTITY_LOCAL_TTL = getattr(settings, 'IDENTITY_LOCAL_TTL', 5)
+IDENTITY_LOCAL_MAXSIZE = getattr(settings, 'IDENTITY_LOCAL_MAXSIZE', 4096)
+
+IDENTITY_FIELDS = tuple(field.attname for field in User._meta.concrete_fields if field.attname != 'password')
+
+_local = LocalLRUCache(maxsize=IDENTITY_LOCAL_MAXSIZE, ttl=IDENTITY_LOCAL_TTL)
+
+
+def identity_key(user_id):
+    return f'identity:{user_id}'
+
+
+def get_cache():
+    return caches[IDENTITY_CACHE_ALIAS]
+
+
+def _load_identity(user_id):
+    values = User.objects.filter(pk=user_id).values_list(*IDENTITY_FIELDS, 'profile__id').first()
+    if values is None:
+        return None
+    return values[:-1], values[-1] is not None
+
+
+def get_identity(user_id):
+    """
+        @return (user fields values, has_profile) or None if there is no user with provided id.
+    """
+    user_id = int(user_id)
+    local_key = (IDENTITY_CACHE_VERSION, user_id)
+    identity = _local.get(local_key)
+    if identity is not None:
+        return identity
+    cache = get_cache()
+    identity = cache.get(identity_key(user_id), version=IDENTITY_CACHE_VERSION)
+    if identity is None:
+        identity = _load_identity(user_id)
+        if identity is None:
+            return None
+        cache.set(identity_key(user_id), identity, IDENTITY_CACHE_TTL, version=IDENTITY_CACHE_VERSION)
+    _local.set(local_key, identity)
+    return identity
+
+
+def get_user(user_id):
+    """
+        @return `User` built from cached identity (password is deferred, so it's loaded only if accessed and never
+                written back by `save()`) or None if there is no user with provided id.
+    """
+    identity = get_identity(user_id)
+    if identity is None:
+        return None
+    values, has_profile = identity
+    user = User.from_db(DEFAULT_DB_ALIAS, IDENTITY_FIELDS, values)
+    user.cached_has_profile = has_profile
+    return user
+
+
+def _delete(user_id):
+    _local.delete((IDENTITY_CACHE_VERSION, int(user_id)))
+    get_cache().delete(identity_key(user_id), version=IDENTITY_CACHE_VERSION)
+
+
+def invalidate(user_id):
+    # Deleted again on commit, so concurrent reads of not yet committed changes don't stay cached
+    _delete(user_id)
+    transaction.on_commit(lambda: _delete(user_id))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+from authentication import search
+
+
+class Command(BaseCommand):
+    help = 'Rewrites users search documents and reindexes them. ' \
+           'Documents are kept on users/profiles changes, so it is only needed once for existing users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        backend = search.get_backend(options['database'])
+        with transaction.atomic(using=options['database']):
+            backend.install()
+            count = search.index_all_users(batch_size=options['batch_size'])
+            backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} users ({backend.vendor}).'))
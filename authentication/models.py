@@ -1,8 +1,9 @@
 from django.db import models
+from django.db.models import OuterRef, Prefetch, Subquery
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.utils import timezone
-from django.core.cache import cache
+from core import presence
 
 
 class UserManager(BaseUserManager):
@@ -28,8 +29,30 @@ class UserManager(BaseUserManager):
         user.save()
         return user
 
+    def with_chat_profile(self):
+        """
+            Users with everything `ChatUserSerializer` needs, profile joined and latest image, cover and session
+            prefetched => fixed number of queries whatever users count is.
+        """
+        def latest_media(media_type):
+            latest = Media.objects.filter(profile=OuterRef('profile'), type=media_type).order_by('-created_at', '-pk')
+            return Media.objects.filter(pk=Subquery(latest.values('pk')[:1]))
 
-NOTIFICATIONS_CACHE_TTL = 60 * 60 * 2
+        latest_session = Session.objects.filter(user=OuterRef('user')).order_by('-started_at', '-pk')
+        return self.get_queryset().select_related('profile').prefetch_related(
+            Prefetch('profile__media', queryset=latest_media('IMAGE'), to_attr='prefetched_latest_image'),
+            Prefetch('profile__media', queryset=latest_media('COVER'), to_attr='prefetched_latest_cover'),
+            Prefetch('sessions', queryset=Session.objects.filter(pk=Subquery(latest_session.values('pk')[:1])),
+                     to_attr='prefetched_latest_session'),
+        )
+
+
+def chats_group_name(user_id):
+    return f'user.{user_id}.chats'
+
+
+def notifications_group_name(user_id):
+    return f'user.{user_id}.notifications'
 
 
 class User(AbstractBaseUser, PermissionsMixin):
@@ -59,50 +82,15 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     @property
     def chats_group(self):
-        return f'user.{self.pk}.chats'
+        return chats_group_name(self.pk)
 
     @property
     def notifications_group(self):
-        return f'user.{self.pk}.notifications'
+        return notifications_group_name(self.pk)
 
     @property
     def notifications_group_active(self):
-        return cache.get(f'user:{self.pk}:notifications:active')
-
-    @notifications_group_active.setter
-    def notifications_group_active(self, value):
-        if value:
-            cache.set(f'user:{self.pk}:notifications:active', 1, timeout=NOTIFICATIONS_CACHE_TTL)
-        else:
-            cache.delete(f'user:{self.pk}:notifications:active')
-
-    def activate_notifications(self):
-        self.notifications_group_active = True
-
-    def deactivate_notifications(self):
-        self.notifications_group_active = False
-
-    @property
-    def active_session(self):
-        session = None
-        try:
-            session = self.sessions.filter(state='ACTIVE').latest('started_at')
-        except Session.DoesNotExist:
-            pass
-        return session
-
-    @property
-    def active_chat_session(self):
-        session = None
-        try:
-            session = self.chats_sessions.filter(state='ACTIVE').latest('started_at')
-        except Session.DoesNotExist:
-            pass
-        return session
-
-    @property
-    def active_chats_sessions(self):
-        return self.chats_sessions.filter(state='ACTIVE')
+        return presence.is_connected(presence.get_connections(self.pk), presence.KIND_NOTIFICATIONS)
 
     # def active_chat_session(self, chat):
     #     session = None
@@ -112,22 +100,22 @@ class User(AbstractBaseUser, PermissionsMixin):
     #         pass
     #     return session
 
+    """
+        Live sessions are kept in presence registry, database only holds ended sessions history.
+    """
+
     @property
     def session(self):
-        session = None
-        try:
-            session = self.sessions.latest('started_at')
-        except Session.DoesNotExist:
-            pass
-        return session
-
-    def start_session(self, channel_name):
-        sessions = self.sessions
-        for session in sessions.filter(state='ACTIVE'):
-            session.end()
-        return sessions.create(channel_name=channel_name)
+        connections = getattr(self, 'prefetched_connections', None)
+        if connections is None:
+            connections = presence.get_connections(self.pk)
+        return Session.latest_of(self, connections)
 
     def has_profile(self):
+        # Users built from identity cache (see `authentication.identity`) know it without a query
+        cached_has_profile = getattr(self, 'cached_has_profile', None)
+        if cached_has_profile is not None:
+            return cached_has_profile
         return hasattr(self, 'profile')
 
 
@@ -160,6 +148,8 @@ class Profile(models.Model):
 
     @property
     def latest_image(self):
+        if hasattr(self, 'prefetched_latest_image'):
+            return next(iter(self.prefetched_latest_image), None)
         return self.media.filter(type='IMAGE').latest('created_at')
 
     @latest_image.setter
@@ -175,6 +165,8 @@ class Profile(models.Model):
 
     @property
     def latest_cover(self):
+        if hasattr(self, 'prefetched_latest_cover'):
+            return next(iter(self.prefetched_latest_cover), None)
         return self.media.filter(type='COVER').latest('created_at')
 
 
@@ -210,4 +202,35 @@ class Session(models.Model):
     def end(self):
         self.state = 'INACTIVE'
         self.ended_at = timezone.now()
-        self.save()
+        self.save(update_fields=['state', 'ended_at'])
+
+    @classmethod
+    def latest_of(cls, user, connections):
+        """
+            @return unsaved active session if user has live chats connection else latest session from history.
+        """
+        live = [connection for connection in connections if connection['kind'] == presence.KIND_CHATS]
+        if live:
+            connection = min(live, key=lambda item: item['started_at'])
+            return cls(user=user, state='ACTIVE', started_at=connection['started_at'])
+        if hasattr(user, 'prefetched_latest_session'):
+            return next(iter(user.prefetched_latest_session), None)
+        session = None
+        try:
+            session = user.sessions.latest('started_at')
+        except cls.DoesNotExist:
+            pass
+        return session
+
+
+class UserSearchDocument(models.Model):
+    """
+        Denormalized users directory search document, kept by `authentication.search` on `User`/`Profile` changes
+        and indexed by the database (see `authentication.search`).
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='search_document')
+    # First name, last name and username => ranked above `about` matches
+    name = models.TextField()
+    # Quote and description
+    about = models.TextField(default='')
+    updated_at = models.DateTimeField(auto_now=True)
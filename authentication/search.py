@@ -0,0 +1,233 @@
+import re
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.module_loading import import_string
+from .models import User, UserSearchDocument
+
+"""
+    Users directory search.
+    Every user has a denormalized `UserSearchDocument` (name and about), rewritten on `User`/`Profile` changes
+    (see `authentication.signals`), and the database keeps a full-text index of it (SQLite FTS5 table with prefix
+    index kept by triggers, Postgres GIN expression index).
+    Every query term is a prefix (type-ahead), users matching all terms are ranked with name matches first and ties
+    are ordered by id, so paging by (search_rank, id) keyset is stable.
+"""
+
+USER_SEARCH_BACKEND = getattr(settings, 'USER_SEARCH_BACKEND', None)
+USER_SEARCH_CONFIG = getattr(settings, 'USER_SEARCH_CONFIG', 'simple')
+USER_SEARCH_MAX_TERMS = getattr(settings, 'USER_SEARCH_MAX_TERMS', 8)
+# Shortest prefix index of SQLite backend, shorter prefixes would scan every term of the index
+USER_SEARCH_MIN_TERM_LENGTH = getattr(settings, 'USER_SEARCH_MIN_TERM_LENGTH', 2)
+
+TERM_PATTERN = re.compile(r'\w+')
+
+
+def parse_terms(query):
+    """
+        @return query words only, so full-text query syntax of user input is never interpreted, words shorter than
+                `USER_SEARCH_MIN_TERM_LENGTH` are dropped.
+    """
+    terms = [term for term in TERM_PATTERN.findall((query or '').lower()) if len(term) >= USER_SEARCH_MIN_TERM_LENGTH]
+    return terms[:USER_SEARCH_MAX_TERMS]
+
+
+class UserSearchBackend:
+    """
+        @method install: creates index structures if missing.
+        @method rebuild: reindexes all documents.
+        @method search: [(user id, search_rank)] of users matching all terms prefixes.
+    """
+    vendor = None
+    table = UserSearchDocument._meta.db_table
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+
+    def execute(self, *statements):
+        with connections[self.using].cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def fetch(self, sql, params):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def install(self):
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def search(self, terms, cursor=None, limit=20):
+        raise NotImplementedError
+
+    @staticmethod
+    def keyset(sql, params, cursor, limit):
+        if cursor is not None:
+            score, pk = cursor
+            sql += ' WHERE score < %s OR (score = %s AND id < %s)'
+            params += [score, score, pk]
+        return sql + ' ORDER BY score DESC, id DESC LIMIT %s', params + [limit]
+
+
+class SQLiteUserSearchBackend(UserSearchBackend):
+    vendor = 'sqlite'
+    fts_table = f'{UserSearchDocument._meta.db_table}_fts'
+
+    def install(self):
+        table, fts_table = self.table, self.fts_table
+        self.execute(
+            # prefix => 2 and 3 characters prefix queries are index lookups instead of terms scans
+            f"""CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                name, about, content='{table}', content_rowid='user_id', prefix='2 3',
+                tokenize='unicode61 remove_diacritics 2'
+            )""",
+            f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {fts_table}(rowid, name, about) VALUES (new.user_id, new.name, new.about);
+                END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {fts_table}({fts_table}, rowid, name, about)
+                        VALUES ('delete', old.user_id, old.name, old.about);
+                END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE OF name, about ON {table} BEGIN
+                    INSERT INTO {fts_table}({fts_table}, rowid, name, about)
+                        VALUES ('delete', old.user_id, old.name, old.about);
+                    INSERT INTO {fts_table}(rowid, name, about) VALUES (new.user_id, new.name, new.about);
+                END""",
+        )
+
+    def rebuild(self):
+        self.execute(
+            f"INSERT INTO {self.fts_table}({self.fts_table}) VALUES ('rebuild')",
+            f"INSERT INTO {self.fts_table}({self.fts_table}) VALUES ('optimize')",
+        )
+
+    def search(self, terms, cursor=None, limit=20):
+        # bm25() is lower for better matches, name column weights 10 times about column
+        sql = f"""
+            SELECT id, score FROM (
+                SELECT rowid AS id, -bm25({self.fts_table}, 10.0, 1.0) AS score FROM {self.fts_table}
+                WHERE {self.fts_table} MATCH %s
+            ) matches
+        """
+        query = ' '.join(f'"{term}"*' for term in terms)
+        return self.fetch(*self.keyset(sql, [query], cursor, limit))
+
+
+class PostgresUserSearchBackend(UserSearchBackend):
+    vendor = 'postgresql'
+    index = f'{UserSearchDocument._meta.db_table}_search_idx'
+
+    @property
+    def document(self):
+        return f"(setweight(to_tsvector('{USER_SEARCH_CONFIG}', name), 'A') || " \
+               f"setweight(to_tsvector('{USER_SEARCH_CONFIG}', about), 'B'))"
+
+    def install(self):
+        self.execute(f'CREATE INDEX IF NOT EXISTS {self.index} ON {self.table} USING GIN ({self.document})')
+
+    def rebuild(self):
+        self.execute(f'REINDEX INDEX {self.index}')
+
+    def search(self, terms, cursor=None, limit=20):
+        sql = f"""
+            SELECT id, score FROM (
+                SELECT user_id AS id, ts_rank({self.document}, query) AS score
+                FROM {self.table}, to_tsquery('{USER_SEARCH_CONFIG}', %s) query
+                WHERE {self.document} @@ query
+            ) matches
+        """
+        query = ' & '.join(f'{term}:*' for term in terms)
+        return self.fetch(*self.keyset(sql, [query], cursor, limit))
+
+
+BACKENDS = {backend.vendor: backend for backend in (SQLiteUserSearchBackend, PostgresUserSearchBackend)}
+
+
+def get_backend(using=DEFAULT_DB_ALIAS):
+    if USER_SEARCH_BACKEND:
+        return import_string(USER_SEARCH_BACKEND)(using)
+    try:
+        return BACKENDS[connections[using].vendor](using)
+    except KeyError:
+        raise ImproperlyConfigured(f'No users search backend for "{connections[using].vendor}" database.')
+
+
+def build_document(user):
+    profile = getattr(user, 'profile', None)
+    name = [user.username]
+    about = []
+    if profile is not None:
+        name = [profile.first_name, profile.last_name] + name
+        about = [value for value in (profile.quote, profile.description) if value]
+    return UserSearchDocument(user=user, name=' '.join(name), about=' '.join(about))
+
+
+def index_user(user_id, create=True):
+    """
+        Rewrites document of the user if changed (e.g. `last_login` updates don't touch the index).
+        @param create: False to only update existing document, as while user is being deleted.
+    """
+    user = User.objects.select_related('profile').filter(pk=user_id).first()
+    if user is None:
+        return
+    document = build_document(user)
+    existing = UserSearchDocument.objects.filter(pk=user.pk).values_list('name', 'about').first()
+    if existing == (document.name, document.about):
+        return
+    if existing is not None:
+        UserSearchDocument.objects.filter(pk=user.pk).update(name=document.name, about=document.about)
+    elif create:
+        document.save(force_insert=True)
+
+
+def index_all_users(batch_size=1000):
+    """
+        Rewrites documents of all users, for users created before search documents.
+        @return users count
+    """
+    UserSearchDocument.objects.all().delete()
+    count = 0
+    users = User.objects.select_related('profile').order_by('pk')
+    batch = []
+    for user in users.iterator(chunk_size=batch_size):
+        batch.append(build_document(user))
+        if len(batch) >= batch_size:
+            UserSearchDocument.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+    UserSearchDocument.objects.bulk_create(batch)
+    return count + len(batch)
+
+
+class UserSearch:
+    """
+        Type-ahead users search, paginated by `RankedKeysetPagination`.
+        Query with '@' is looked up as exact email instead.
+    """
+
+    def __init__(self, query, queryset):
+        self.query = query.strip()
+        self.queryset = queryset
+
+    def page(self, cursor, limit):
+        """
+            @return users with `search_rank` attribute, best match first.
+        """
+        if '@' in self.query:
+            rows = [] if cursor else [(pk, 0) for pk in self.queryset.filter(
+                email=User.objects.normalize_email(self.query)).values_list('pk', flat=True)[:1]]
+        else:
+            terms = parse_terms(self.query)
+            rows = get_backend().search(terms, cursor, limit) if terms else []
+        users = self.queryset.in_bulk([pk for pk, _ in rows])
+        page = []
+        for pk, score in rows:
+            user = users.get(pk)
+            if user is None:
+                continue
+            user.search_rank = score
+            page.append(user)
+        return page
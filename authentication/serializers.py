@@ -1,3 +1,4 @@
+from django.db import models
 from rest_framework import serializers
 from .models import User, Profile, Media, Session
 from django.contrib import auth
@@ -12,6 +13,7 @@ from . import exceptions
 import re
 from django.utils import timezone
 from core.exceptions import AuthUserDisabled
+from core import presence
 
 # make a pattern
 pattern = "^[A-Za-z0-9_]*$"
@@ -187,11 +189,19 @@ class SessionSerializer(serializers.ModelSerializer):
         fields = ['state', 'started_at', 'ended_at']
 
 
+class ChatUserListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        users = list(data.all() if isinstance(data, models.Manager) else data)
+        presence.prefetch_connections(users)
+        return super().to_representation(users)
+
+
 class ChatUserSerializer(serializers.ModelSerializer):
     profile = ProfileSerializer(many=False, read_only=True)
     session = SessionSerializer(many=False, read_only=True)
 
     class Meta:
         model = User
+        list_serializer_class = ChatUserListSerializer
         fields = ['id', 'email', 'username', 'is_verified', 'is_active', 'is_staff', 'created_at',
                   'updated_at', 'last_login', 'profile', 'session']
@@ -0,0 +1,36 @@
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from .models import Profile, User
+from . import identity
+from . import search
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_identity(sender, instance, **kwargs):
+    identity.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_profile_identity(sender, instance, **kwargs):
+    identity.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def index_user_search_document(sender, instance, **kwargs):
+    search.index_user(instance.pk)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def index_profile_search_document(sender, instance, signal, **kwargs):
+    # Profile is deleted before its user, so document is only updated then
+    search.index_user(instance.user_id, create=signal is post_save)
+
+
+@receiver(post_migrate)
+def install_users_search(sender, using, **kwargs):
+    # Search index structures are raw SQL (no migrations), created once authentication tables exist
+    if sender.name == 'authentication':
+        search.get_backend(using).install()
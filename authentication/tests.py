@@ -1,3 +1,124 @@
-from django.test import TestCase
+from datetime import date
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from .models import User, Profile, UserSearchDocument
+from . import identity
 
-# Create your tests here.
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage', CACHES=LOCMEM_CACHES)
+class IdentityCacheTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.user.tokens["access"]}')
+
+    def create_profile(self):
+        return Profile.objects.create(user=self.user, first_name='owner', last_name='owner', gender='MALE',
+                                      birthdate=date(2000, 1, 1), country_code='EG', device_language='en')
+
+    def test_authenticated_request_reads_identity_from_cache(self):
+        self.create_profile()
+        self.assertEqual(self.client.get(reverse('auth_profile_current')).status_code, 200)
+        # Neither the user nor `HasProfile` check is queried, only what the view serializes
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('auth_profile_current'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries.captured_queries
+                          if f'FROM "{User._meta.db_table}"' in query['sql']])
+
+    def test_profile_creation_invalidates_identity(self):
+        self.assertNotEqual(self.client.get(reverse('auth_profile_current')).status_code, 200)
+        self.assertFalse(identity.get_user(self.user.pk).has_profile())
+        self.create_profile()
+        self.assertTrue(identity.get_user(self.user.pk).has_profile())
+        self.assertEqual(self.client.get(reverse('auth_profile_current')).status_code, 200)
+
+    def test_user_deactivation_invalidates_identity(self):
+        self.create_profile()
+        self.assertEqual(self.client.get(reverse('auth_profile_current')).status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertNotEqual(self.client.get(reverse('auth_profile_current')).status_code, 200)
+
+    def test_cached_user_save_keeps_password(self):
+        user = identity.get_user(self.user.pk)
+        user.is_verified = True
+        user.save()
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_verified)
+        self.assertTrue(self.user.check_password('password'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UserSearchTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch('core.presence.get_many_connections',
+                             lambda user_ids: {user_id: [] for user_id in user_ids})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = self.create_user('owner', 'Owner', 'Account')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @staticmethod
+    def create_user(username, first_name, last_name, description=None):
+        user = User.objects.create_user(username, f'{username}@example.com', 'password')
+        Profile.objects.create(user=user, first_name=first_name, last_name=last_name, gender='MALE',
+                               birthdate=date(2000, 1, 1), country_code='EG', device_language='en',
+                               description=description)
+        return user
+
+    def search(self, **params):
+        response = self.client.get(reverse('auth_user_list'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_type_ahead_matches_prefixes_of_all_terms(self):
+        john = self.create_user('jsmith', 'John', 'Smith')
+        self.create_user('jdoe', 'John', 'Doe')
+        smithson = self.create_user('other', 'Jane', 'Smithson')
+        self.assertEqual([user['id'] for user in self.search(search='jo sm')['results']], [john.pk])
+        self.assertEqual(len(self.search(search='smi')['results']), 2)
+        # Single character terms are not looked up
+        self.assertEqual([user['id'] for user in self.search(search='j smiths')['results']], [smithson.pk])
+        self.assertEqual(self.search(search='j')['results'], [])
+
+    def test_name_matches_rank_above_description_and_pages_are_stable(self):
+        described = self.create_user('described', 'Some', 'One', description='Loves football')
+        named = [self.create_user(f'foot{index}', 'Football', 'Fan') for index in range(3)]
+        expected = [user['id'] for user in self.search(search='foot', page_size=50)['results']]
+        self.assertEqual(expected[-1], described.pk)
+        self.assertEqual(set(expected[:-1]), {user.pk for user in named})
+        ids = []
+        cursor = None
+        while True:
+            data = self.search(search='foot', page_size=1, **({'cursor': cursor} if cursor else {}))
+            ids += [user['id'] for user in data['results']]
+            cursor = data['next']
+            if cursor is None:
+                break
+        self.assertEqual(ids, expected)
+
+    def test_documents_follow_profile_changes_and_email_is_exact(self):
+        self.user.profile.first_name = 'Renamed'
+        self.user.profile.save()
+        self.assertEqual([user['id'] for user in self.search(search='renam')['results']], [self.user.pk])
+        self.assertEqual(self.search(search='owne')['results'][0]['id'], self.user.pk)
+        self.assertEqual(self.search(search='Owner')['results'][0]['id'], self.user.pk)
+        self.assertEqual([user['id'] for user in self.search(search='owner@example.com')['results']],
+                         [self.user.pk])
+        self.assertEqual(self.search(search='owner@example')['results'], [])
+
+    def test_rebuild_command_indexes_existing_users(self):
+        UserSearchDocument.objects.all().delete()
+        self.assertEqual(self.search(search='owner')['results'], [])
+        call_command('rebuild_users_search', stdout=StringIO())
+        self.assertEqual(len(self.search(search='owner')['results']), 1)
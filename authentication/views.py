@@ -22,7 +22,8 @@ from .utils import MailingUtils
 from core.s3 import S3
 from rest_framework.exceptions import NotAuthenticated
 from core.exceptions import NotAuthenticatedRequest
-from rest_framework.filters import SearchFilter
+from core.pagination import RankedKeysetPagination, StandardResultsSetPagination
+from .search import UserSearch
 from core.permissions import HasProfile
 
 
@@ -256,16 +257,33 @@ class UserDetailAPIView(GenericAPIView):
                 raise error
 
 
-# TODO: use @ when moving to Postgre db
 class UsersListAPIView(ListAPIView):
     serializer_class = serializers.ChatUserSerializer
-    queryset = User.objects.all()
+    queryset = User.objects.with_chat_profile()
     renderer_classes = (StandardRenderer,)
     permission_classes = [permissions.IsAuthenticated, HasProfile]
-    filter_backends = [SearchFilter]
-    search_fields = ['profile__first_name', 'profile__last_name', 'username',
-                     'profile__quote', 'profile__description', '=email',
-                     'profile__media__name']
+    search_query_param = 'search'
+
+    """
+        @param search: type-ahead query over users search documents (see `authentication.search`), results are
+                       ranked and paginated by `cursor` instead of page number.
+    """
+
+    def get_search_query(self):
+        return self.request.query_params.get(self.search_query_param, '').strip()
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            self._paginator = RankedKeysetPagination() if self.get_search_query() else StandardResultsSetPagination()
+        return self._paginator
+
+    def get_queryset(self):
+        queryset = super(UsersListAPIView, self).get_queryset()
+        query = self.get_search_query()
+        if query:
+            return UserSearch(query, queryset)
+        return queryset.order_by('pk')
 
     def permission_denied(self, request, message=None, code=None):
         try:
@@ -0,0 +1,137 @@
+"""
+    ChatMessaging.send benchmark, previous pipeline (rate tokens, saving, recipients and every message notification
+    in their own `database_sync_to_async` hops) against current one (one sync unit of work per batch, notifications
+    digest) on a test database. Thread pool hops are counted by wrapping `SyncToAsync.__call__`.
+    Needs redis (cache and channel layer) as the app does, use a scratch redis database.
+    Usage: python benchmarks/messaging.py [--frames 200] [--senders 1]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_app.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import django  # noqa: E402
+
+django.setup()
+
+from asgiref.sync import SyncToAsync  # noqa: E402
+from channels.db import database_sync_to_async  # noqa: E402
+from channels.layers import get_channel_layer  # noqa: E402
+from django.db import connection  # noqa: E402
+from authentication.models import User, Profile  # noqa: E402
+from chat import ingestion  # noqa: E402
+from chat.messaging import ChatMessaging, STREAM_CHAT, check_retry_after  # noqa: E402
+from chat.models import Chat  # noqa: E402
+from core import presence, ratelimit  # noqa: E402
+from notification.digests import digests  # noqa: E402
+
+hops = 0
+sync_to_async_call = SyncToAsync.__call__
+
+
+async def counted_sync_to_async_call(self, *args, **kwargs):
+    global hops
+    hops += 1
+    return await sync_to_async_call(self, *args, **kwargs)
+
+
+class PreviousChatMessaging(ChatMessaging):
+    async def send(self, content):
+        buckets = ingestion.get_rate_buckets(self.user.pk, self.chat.pk)
+        cost = ingestion.get_frame_cost(content)
+        check_retry_after(ratelimit.take_local(buckets, cost))
+        check_retry_after(await database_sync_to_async(ratelimit.take)(buckets, cost))
+        messages, _ = await ingestion.batcher.submit(
+            ingestion.build_messages(content, user_id=self.user.pk, chat_id=self.chat.pk))
+        for message in messages:
+            await self.channel_layer.group_send(self.group_name, {
+                'type': 'chat_message', 'stream': STREAM_CHAT, 'chat_id': self.chat.pk, 'message': message,
+            })
+        users_chats_groups, users_notifications_groups, unread_counts = await database_sync_to_async(
+            self.prepare_fan_out)(messages)
+        chat_delta = self.build_chat_delta(messages[-1], unread_counts)
+        await asyncio.gather(self.forward_to_users_chats(users_chats_groups, chat_delta),
+                             *[self.forward_to_users_notifications(dict.fromkeys(users_notifications_groups, 1),
+                                                                   dict(message))
+                               for message in messages])
+        return messages
+
+
+def create_user(username):
+    user = User.objects.create_user(username, f'{username}@example.com', 'password')
+    Profile.objects.create(user=user, first_name=username, last_name=username, gender='MALE',
+                           birthdate=date(2000, 1, 1), country_code='EG', device_language='en')
+    return user
+
+
+def create_chat(senders):
+    """
+        @return chat of `senders` and a member connected to notifications only (gets every message notification)
+    """
+    chat = Chat.objects.create(type='ROOM')
+    members = [create_user(f'bench_{chat.pk}_{i}') for i in range(senders + 1)]
+    chat.users.add(*members)
+    presence.connect(members[-1].pk, f'bench.{chat.pk}', presence.KIND_NOTIFICATIONS)
+    return chat, members[:-1]
+
+
+async def run(messaging_class, frames, senders):
+    chat, users = await database_sync_to_async(create_chat)(senders)
+    channel_layer = get_channel_layer()
+    senders_messaging = [messaging_class(channel_layer, user, chat) for user in users]
+    latencies = []
+
+    async def send_frames(messaging):
+        for index in range(frames // senders):
+            started_at = time.perf_counter()
+            await messaging.send({'type': 'TEXT', 'content': f'Benchmark message {index}'})
+            latencies.append(time.perf_counter() - started_at)
+
+    global hops
+    hops = 0
+    started_at = time.perf_counter()
+    await asyncio.gather(*[send_frames(messaging) for messaging in senders_messaging])
+    elapsed = time.perf_counter() - started_at
+    # Pending digests are part of the work
+    while digests.tasks:
+        await asyncio.gather(*digests.tasks.values())
+    latencies.sort()
+    return {
+        'hops': hops / len(latencies),
+        'mean': statistics.mean(latencies) * 1e3,
+        'p50': latencies[len(latencies) // 2] * 1e3,
+        'p99': latencies[int(len(latencies) * 0.99)] * 1e3,
+        'rate': len(latencies) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--senders', type=int, default=1)
+    args = parser.parse_args()
+    # Rate limits are not measured
+    ingestion.MESSAGE_RATE_USER = ingestion.MESSAGE_RATE_CHAT = 10 ** 6
+    ingestion.MESSAGE_RATE_USER_BURST = ingestion.MESSAGE_RATE_CHAT_BURST = 10 ** 6
+    SyncToAsync.__call__ = counted_sync_to_async_call
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        print(f'{"pipeline":<12}{"hops/frame":>12}{"mean (ms)":>12}{"p50 (ms)":>12}{"p99 (ms)":>12}{"frames/s":>12}')
+        for name, messaging_class in (('previous', PreviousChatMessaging), ('current', ChatMessaging)):
+            result = asyncio.run(run(messaging_class, args.frames, args.senders))
+            print(f'{name:<12}{result["hops"]:>12.2f}{result["mean"]:>12.2f}{result["p50"]:>12.2f}'
+                  f'{result["p99"]:>12.2f}{result["rate"]:>12.0f}')
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        SyncToAsync.__call__ = sync_to_async_call
+
+
+if __name__ == '__main__':
+    main()
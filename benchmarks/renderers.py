@@ -0,0 +1,100 @@
+"""
+    StandardRenderer benchmark, previous renderer (`str(data)` 'ErrorDetail' sniffing + `json.dumps`) against current
+    one on payloads shaped like serialized messages pages and chats list pages.
+    Usage: python benchmarks/renderers.py [--repeat 200]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_app.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import django  # noqa: E402
+
+django.setup()
+
+from rest_framework import renderers  # noqa: E402
+from rest_framework.response import Response  # noqa: E402
+from core import renderers as core_renderers  # noqa: E402
+from core.renderers import StandardRenderer  # noqa: E402
+
+
+class PreviousStandardRenderer(renderers.JSONRenderer):
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps({'errors': data} if 'ErrorDetail' in str(data) else {'data': data})
+
+
+NOW = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+def iso(value):
+    return value.isoformat().replace('+00:00', 'Z')
+
+
+def message(index, chat_id=1):
+    return OrderedDict([
+        ('id', index), ('chat_id', chat_id), ('user_id', index % 7 + 1), ('seq', index), ('type', 'TEXT'),
+        ('content', f'Message number {index} with some ordinary chat text, emojis \U0001F600 and unicode عربي.'),
+        ('created_at', iso(NOW + timedelta(seconds=index))),
+    ])
+
+
+def user(index):
+    media = OrderedDict([('id', index), ('media', f'https://bucket.s3.amazonaws.com/media/{index}.png'),
+                         ('created_at', iso(NOW)), ('name', f'{index}.png'), ('type', 'IMAGE'),
+                         ('extension', 'png'), ('size', 1024 * index)])
+    profile = OrderedDict([('id', index), ('first_name', f'First{index}'), ('last_name', f'Last{index}'),
+                           ('gender', 'MALE'), ('birthdate', '2000-01-01'), ('country_code', 'EG'),
+                           ('device_language', 'en'), ('quote', None), ('description', 'Some description'),
+                           ('latest_image', media), ('latest_cover', media), ('score', 10 * index)])
+    session = OrderedDict([('id', index), ('state', 'INACTIVE'), ('started_at', iso(NOW)), ('ended_at', iso(NOW))])
+    return OrderedDict([('id', index), ('username', f'user{index}'), ('email', f'user{index}@example.com'),
+                        ('created_at', iso(NOW)), ('updated_at', iso(NOW)), ('last_login', iso(NOW)),
+                        ('profile', profile), ('session', session)])
+
+
+def chat(index, users_count):
+    return OrderedDict([('id', index), ('type', 'ROOM'), ('created_at', iso(NOW)), ('updated_at', iso(NOW)),
+                        ('last_activity_at', iso(NOW)), ('latest_message', message(index, index)),
+                        ('users', [user(index * 10 + i) for i in range(users_count)])])
+
+
+PAYLOADS = {
+    'messages page (20)': {'next': 2, 'previous': None, 'results': [message(i) for i in range(20)]},
+    'messages sync (200)': {'messages': [message(i) for i in range(200)], 'last_seq': 200, 'has_more': False},
+    'chats list page (20 x 3 users)': {'next': 'cursor', 'results': [chat(i, 3) for i in range(20)]},
+    'error': [{'code': 'not_chat_member', 'message': 'User is not chat member.', 'fields': [], 'status_code': 403}],
+}
+
+
+def context(name):
+    return {'response': Response(status=403 if name == 'error' else 200)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    repeat = parser.parse_args().repeat
+    encoder = 'orjson' if core_renderers.orjson is not None else 'json'
+    print(f'{"payload":<34}{"previous (us)":>16}{f"current/{encoder} (us)":>24}{"speedup":>10}')
+    for name, payload in PAYLOADS.items():
+        renderer_context = context(name)
+        timings = []
+        for renderer in (PreviousStandardRenderer(), StandardRenderer()):
+            seconds = min(timeit.repeat(lambda: renderer.render(payload, renderer_context=renderer_context),
+                                        number=repeat, repeat=5))
+            timings.append(seconds / repeat * 1e6)
+        previous, current = timings
+        print(f'{name:<34}{previous:>16.1f}{current:>24.1f}{previous / current:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import asyncio
+import time
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+from .models import chat_group_name
+
+"""
+    Ephemeral chat activity (typing, recording voice), it only goes through the channel layer, nothing is saved.
+    Activities of all members of a chat connected to the worker are coalesced into at most one group event per
+    `ACTIVITY_INTERVAL` seconds, so a room full of typists costs one event per interval, not one per keystroke.
+    A repeated activity of the same (user, chat) is dropped for `ACTIVITY_REPEAT_INTERVAL` seconds, clients keep
+    showing an activity until `STOPPED` or a while after the latest event.
+"""
+
+ACTIVITY_INTERVAL = getattr(settings, 'ACTIVITY_INTERVAL', 1)
+ACTIVITY_REPEAT_INTERVAL = getattr(settings, 'ACTIVITY_REPEAT_INTERVAL', 3)
+
+ACTIVITY_TYPING = 'TYPING'
+ACTIVITY_RECORDING = 'RECORDING'
+ACTIVITY_STOPPED = 'STOPPED'
+ACTIVITY_TYPES = {ACTIVITY_TYPING, ACTIVITY_RECORDING, ACTIVITY_STOPPED}
+
+
+def parse_activity(value):
+    if value not in ACTIVITY_TYPES:
+        raise ValidationError({'activity': f'"{value}" is not a valid choice.'})
+    return value
+
+
+class ActivityCoalescer:
+    def __init__(self, interval=ACTIVITY_INTERVAL, repeat_interval=ACTIVITY_REPEAT_INTERVAL):
+        self.interval = interval
+        self.repeat_interval = repeat_interval
+        # {chat_id: {user id (str): activity}}
+        self.pending = {}
+        # {chat_id: task}, a chat has a task while its events are sent or within `interval` after
+        self.flush_tasks = {}
+        # {(user_id, chat_id): (activity, monotonic time)} of not stopped activities
+        self.last_activities = {}
+
+    def submit(self, channel_layer, chat_id, user_id, activity):
+        """
+            @return whether activity is going to be sent
+        """
+        now = time.monotonic()
+        key = (user_id, chat_id)
+        last = self.last_activities.get(key)
+        if last is None and activity == ACTIVITY_STOPPED:
+            return False
+        if last is not None and last[0] == activity and now - last[1] < self.repeat_interval:
+            return False
+        if activity == ACTIVITY_STOPPED:
+            del self.last_activities[key]
+        else:
+            self.last_activities[key] = (activity, now)
+        self.pending.setdefault(chat_id, {})[str(user_id)] = activity
+        if chat_id not in self.flush_tasks:
+            self.flush_tasks[chat_id] = asyncio.ensure_future(self.flush(channel_layer, chat_id))
+        return True
+
+    async def flush(self, channel_layer, chat_id):
+        # Leading event is sent at once, then the following ones are gathered for `interval`
+        try:
+            while self.pending.get(chat_id):
+                await channel_layer.group_send(chat_group_name(chat_id), {
+                    'type': 'chat_activity',
+                    'chat_id': chat_id,
+                    'activities': self.pending.pop(chat_id),
+                })
+                await asyncio.sleep(self.interval)
+        finally:
+            self.flush_tasks.pop(chat_id, None)
+
+
+coalescer = ActivityCoalescer()
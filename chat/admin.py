@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import Chat, Message, Session
+from .models import Chat, Message, Session, ConversationPair
 
 admin.site.register(Chat)
 admin.site.register(Message)
 admin.site.register(Session)
+admin.site.register(ConversationPair)
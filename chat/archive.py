@@ -0,0 +1,193 @@
+import json
+import zlib
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from core.cache import LocalLRUCache
+from core.renderers import dumps
+from .models import Chat, Message, MessageArchiveSegment
+
+"""
+    Tiered messages storage.
+    Messages older than `MESSAGE_ARCHIVE_AGE_DAYS` are moved from `Message` table (hot tier) into compressed
+    `MessageArchiveSegment` rows of `MESSAGE_ARCHIVE_SEGMENT_SIZE` messages each (see `archive_messages` command).
+    Archived ids of a chat are always lower than its hot ids and chat `last_message` always stays hot, so reads continue
+    from the archive once they go past the oldest hot message (history pages, sync and export).
+    Archived messages aren't in the messages search index.
+"""
+
+MESSAGE_ARCHIVE_AGE_DAYS = getattr(settings, 'MESSAGE_ARCHIVE_AGE_DAYS', 180)
+MESSAGE_ARCHIVE_SEGMENT_SIZE = getattr(settings, 'MESSAGE_ARCHIVE_SEGMENT_SIZE', 1000)
+MESSAGE_ARCHIVE_COMPRESS_LEVEL = getattr(settings, 'MESSAGE_ARCHIVE_COMPRESS_LEVEL', 6)
+MESSAGE_ARCHIVE_LOCAL_MAXSIZE = getattr(settings, 'MESSAGE_ARCHIVE_LOCAL_MAXSIZE', 64)
+
+# Row layout of segments data
+ARCHIVE_FIELDS = ('id', 'user_id', 'seq', 'type', 'content', 'created_at', 'is_disabled')
+ID, USER_ID, SEQ, TYPE, CONTENT, CREATED_AT, IS_DISABLED = range(len(ARCHIVE_FIELDS))
+
+# Segments are immutable, decoded rows are kept for paging through the same segment
+_segments = LocalLRUCache(maxsize=MESSAGE_ARCHIVE_LOCAL_MAXSIZE, ttl=60)
+
+
+def encode_rows(rows):
+    return zlib.compress(dumps(rows), MESSAGE_ARCHIVE_COMPRESS_LEVEL)
+
+
+def segment_rows(segment_id):
+    """
+        @return segment rows (oldest first) with parsed datetimes.
+    """
+    rows = _segments.get(segment_id)
+    if rows is None:
+        data = MessageArchiveSegment.objects.values_list('data', flat=True).get(pk=segment_id)
+        rows = json.loads(zlib.decompress(bytes(data)))
+        for row in rows:
+            row[CREATED_AT] = parse_datetime(row[CREATED_AT])
+        _segments.set(segment_id, rows)
+    return rows
+
+
+def to_message(chat_id, row):
+    return Message(id=row[ID], chat_id=chat_id, user_id=row[USER_ID], seq=row[SEQ], type=row[TYPE],
+                   content=row[CONTENT], created_at=row[CREATED_AT], is_disabled=row[IS_DISABLED])
+
+
+class MessageArchive:
+    """
+        Archived messages of a chat, disabled messages excluded like hot tier reads (sync reads keep them as
+        tombstones).
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+
+    @property
+    def segments(self):
+        return MessageArchiveSegment.objects.filter(chat_id=self.chat_id)
+
+    def collect(self, segments_ids, accept, limit, newest_first, include_disabled=False):
+        messages = []
+        for segment_id in segments_ids:
+            rows = segment_rows(segment_id)
+            for row in (reversed(rows) if newest_first else rows):
+                if (include_disabled or not row[IS_DISABLED]) and accept(row):
+                    messages.append(to_message(self.chat_id, row))
+                    if len(messages) >= limit:
+                        return messages
+        return messages
+
+    def before(self, before_id, limit):
+        """
+            @param before_id: None for the newest archived messages.
+            @return messages with lower ids than `before_id`, newest first.
+        """
+        segments = self.segments
+        if before_id is not None:
+            segments = segments.filter(first_id__lt=before_id)
+        segments_ids = segments.order_by('-last_id').values_list('pk', flat=True).iterator()
+        return self.collect(segments_ids, lambda row: before_id is None or row[ID] < before_id, limit, True)
+
+    def after(self, after_id, limit):
+        """
+            @return messages with higher ids than `after_id`, oldest first.
+        """
+        segments_ids = self.segments.filter(last_id__gt=after_id).order_by('last_id') \
+            .values_list('pk', flat=True).iterator()
+        return self.collect(segments_ids, lambda row: row[ID] > after_id, limit, False)
+
+    def since_seq(self, since_seq, limit):
+        """
+            @return messages with higher sequence numbers than `since_seq`, oldest first, disabled ones included.
+        """
+        segments_ids = self.segments.filter(last_seq__gt=since_seq).order_by('last_seq') \
+            .values_list('pk', flat=True).iterator()
+        return self.collect(segments_ids, lambda row: row[SEQ] is not None and row[SEQ] > since_seq, limit, False,
+                            include_disabled=True)
+
+    def count(self):
+        return self.segments.aggregate(count=Sum('count'))['count'] or 0
+
+    def page(self, offset, limit):
+        """
+            @return `limit` messages after skipping `offset` messages, newest first.
+        """
+        segments_ids = []
+        for segment_id, count in self.segments.order_by('-last_id').values_list('pk', 'count').iterator():
+            if offset >= count:
+                offset -= count
+                continue
+            segments_ids.append(segment_id)
+        skipped = 0
+
+        def accept(row):
+            nonlocal skipped
+            if skipped < offset:
+                skipped += 1
+                return False
+            return True
+
+        return self.collect(segments_ids, accept, limit, True)
+
+    def iter_rows(self, since=None, until=None, after_id=None, include_disabled=False):
+        """
+            @return generator of export rows (see `chat.export.EXPORT_FIELDS`), oldest first.
+        """
+        segments = self.segments
+        if since is not None:
+            segments = segments.filter(last_created_at__gte=since)
+        if until is not None:
+            segments = segments.filter(first_created_at__lt=until)
+        if after_id is not None:
+            segments = segments.filter(last_id__gt=after_id)
+        for segment_id in segments.order_by('last_id').values_list('pk', flat=True).iterator():
+            for row in segment_rows(segment_id):
+                if (row[IS_DISABLED] and not include_disabled) or (after_id is not None and row[ID] <= after_id) \
+                        or (since is not None and row[CREATED_AT] < since) \
+                        or (until is not None and row[CREATED_AT] >= until):
+                    continue
+                yield {'id': row[ID], 'chat_id': self.chat_id, 'user_id': row[USER_ID], 'seq': row[SEQ],
+                       'type': row[TYPE], 'content': row[CONTENT], 'created_at': row[CREATED_AT]}
+
+
+def get_cutoff(age_days=MESSAGE_ARCHIVE_AGE_DAYS):
+    return timezone.now() - timedelta(days=age_days)
+
+
+def get_cold_chats_ids(cutoff):
+    return Message.objects.filter(created_at__lt=cutoff).values_list('chat_id', flat=True).distinct()
+
+
+def archive_chat(chat_id, cutoff, segment_size=MESSAGE_ARCHIVE_SEGMENT_SIZE):
+    """
+        Moves messages of the chat older than `cutoff` into segments, a segment per transaction.
+        @return archived messages count
+    """
+    archived = 0
+    while True:
+        with transaction.atomic():
+            # Locks counter row => no messages are inserted meanwhile (see `Chat.assign_sequences`)
+            last_message_id = Chat.objects.select_for_update().filter(pk=chat_id) \
+                .values_list('last_message_id', flat=True).first()
+            first_recent_id = Message.objects.filter(chat_id=chat_id, created_at__gte=cutoff) \
+                .aggregate(pk=Min('pk'))['pk']
+            # Everything below it is older than cutoff, and last message stays hot for the chats list
+            boundaries = [pk for pk in (first_recent_id, last_message_id) if pk is not None]
+            messages = Message.objects.filter(chat_id=chat_id)
+            if boundaries:
+                messages = messages.filter(pk__lt=min(boundaries))
+            rows = [list(row) for row in messages.order_by('pk').values_list(*ARCHIVE_FIELDS)[:segment_size]]
+            if not rows:
+                return archived
+            seqs = [row[SEQ] for row in rows if row[SEQ] is not None]
+            created_ats = [row[CREATED_AT] for row in rows]
+            MessageArchiveSegment.objects.create(
+                chat_id=chat_id, first_id=rows[0][ID], last_id=rows[-1][ID],
+                first_seq=min(seqs, default=None), last_seq=max(seqs, default=None),
+                first_created_at=min(created_ats), last_created_at=max(created_ats),
+                count=sum(1 for row in rows if not row[IS_DISABLED]), data=encode_rows(rows),
+            )
+            Message.objects.filter(chat_id=chat_id, pk__gte=rows[0][ID], pk__lte=rows[-1][ID]).delete()
+        archived += len(rows)
@@ -1,17 +1,28 @@
-import datetime
-
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.db import connection
+from django.http import QueryDict
 from . import exceptions
-from .models import Chat
-from .serializers import ChatSerializer, MessageSerializer
-from authentication.serializers import ChatUserSerializer
+from .models import Chat, chat_group_name
+from . import membership
+from .messaging import ChatMessaging, get_chat_json, project_chat_delta, STREAM_CHAT, STREAM_CHATS, \
+    STREAM_NOTIFICATIONS
 from rest_framework.exceptions import ValidationError
-from authentication.exceptions import auth_user_not_found, AuthUserNotFoundException
-import asyncio
+from authentication.exceptions import auth_user_not_found, AuthProfileNotFoundException
+from core import presence
+from core.exceptions import FlamesCLoudException, NotAuthenticatedRequest, RateLimited, rate_limited
+from core.outbound import OutboundQueueMixin, merge_data
+from notification.digests import digest_frame, merge_digest_frames
+from core.renderers import dumps
+from . import export
+from .activity import ACTIVITY_STOPPED
+from . import unread
 
 
-class ChatsConsumer(AsyncJsonWebsocketConsumer):
+class ChatsConsumer(OutboundQueueMixin, AsyncJsonWebsocketConsumer):
     user = None
     chats_group_name = None
     session = None
@@ -24,6 +35,8 @@ class ChatsConsumer(AsyncJsonWebsocketConsumer):
             return await self.close(code=auth_user_not_found())
         # Init Session
         self.session = await self.start_user_session()
+        presence.ensure_history_flusher()
+        presence.ensure_heartbeat()
         self.chats_group_name = self.user.chats_group
         await self.channel_layer.group_add(self.chats_group_name, self.channel_name)
 
@@ -34,39 +47,38 @@ class ChatsConsumer(AsyncJsonWebsocketConsumer):
             await self.end_user_session()
 
     async def chat_message(self, event):
-        chat_id = event['chat_id']
-        chat = await self.get_chat_json(chat_id=chat_id)
-        await self.send_json(content=chat)
+        # Delta built once by sender, full chat is only fetched for events without delta or user unread count
+        chat = event.get('chat')
+        if chat is not None:
+            chat = project_chat_delta(self.user, chat)
+        if chat is None:
+            chat = await self.get_chat_json(chat_id=event['chat_id'])
+        # Updates of the same chat waiting for a slow client are merged
+        self.queue_json(chat, key=event['chat_id'], merge=merge_data)
 
     @database_sync_to_async
     def get_chat_json(self, chat_id):
-        chat_json = None
-        try:
-            serializer = ChatSerializer(instance=self.user.chats.get(pk=chat_id))
-            serializer.uid = self.user.pk
-            chat_json = serializer.data
-        except Chat.DoesNotExist:
-            pass
-        return chat_json
+        return get_chat_json(self.user, chat_id)
 
     @database_sync_to_async
     def start_user_session(self):
-        return self.user.start_session(self.channel_name)
+        return presence.connect(self.user.pk, self.channel_name, presence.KIND_CHATS)
 
     @database_sync_to_async
     def end_user_session(self):
-        self.session.end()
+        presence.disconnect(self.user.pk, self.channel_name, presence.KIND_CHATS)
 
 
 # TODO: check if any of the users not in channel group post message some way in there notification channel or
 #       something like that.
-class ChatConsumer(AsyncJsonWebsocketConsumer):
+class ChatConsumer(OutboundQueueMixin, AsyncJsonWebsocketConsumer):
     user = None
     chat_id = None
     chat = None
     session = None
     is_chat_member = None
     chat_group_name = None
+    messaging = None
 
     async def connect(self):
         await self.accept()
@@ -77,23 +89,29 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         self.chat_id = self.scope['url_route']['kwargs']['chat_id']
         if not self.chat_id.isnumeric():
             return await self.close(code=exceptions.chat_not_found())
+        members_ids = await self.get_chat_members(self.chat_id)
+        if members_ids is None:
+            return await self.close(code=exceptions.chat_not_found())
+        self.is_chat_member = self.user.pk in members_ids
+        if not self.is_chat_member:
+            return await self.close(code=exceptions.unauthoraized_chat_access())
         try:
             self.chat = await self.get_chat(self.chat_id)
         finally:
             if not self.chat:
                 return await self.close(code=exceptions.chat_not_found())
-        self.is_chat_member = await self.check_chat_member(self.chat, self.user.pk)
-        if not self.is_chat_member:
-            return await self.close(code=exceptions.unauthoraized_chat_access())
         # Init Session
-        try:
-            self.session = await self.start_chat_session()
-        except AuthUserNotFoundException:
-            return await self.close(code=auth_user_not_found())
-        self.chat_group_name = f'chat.{self.chat_id}'
+        self.session = await self.start_chat_session()
+        presence.ensure_history_flusher()
+        presence.ensure_heartbeat()
+        unread.ensure_markers_flusher()
+        self.messaging = ChatMessaging(self.channel_layer, self.user, self.chat)
+        self.chat_group_name = self.messaging.group_name
         await self.channel_layer.group_add(self.chat_group_name, self.channel_name)
 
     async def disconnect(self, code):
+        if self.messaging:
+            self.messaging.report_activity(ACTIVITY_STOPPED)
         if self.chat_group_name:
             await self.channel_layer.group_discard(self.chat_group_name, self.channel_name)
         if self.session:
@@ -103,92 +121,291 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         # Double Checking Data (As we need to accept connection to send )
         if not self.is_chat_member:
             return
+        if isinstance(content, dict) and content.get('action') == 'resume':
+            try:
+                data = await self.messaging.resume(content)
+            except Exception:
+                return await self.close(code=exceptions.chat_message_invalid())
+            return self.queue_json({'type': 'SYNC', 'data': data})
+        if isinstance(content, dict) and content.get('action') == 'read':
+            try:
+                data = await self.messaging.mark_read(content)
+            except Exception:
+                return await self.close(code=exceptions.chat_message_invalid())
+            return self.queue_json({'type': 'READ', 'data': data})
+        if isinstance(content, dict) and content.get('action') == 'activity':
+            try:
+                return self.messaging.report_activity(content.get('activity'))
+            except ValidationError:
+                return await self.close(code=exceptions.chat_message_invalid())
+        # Content is a message or list of messages (batch frame)
         try:
-            message = await self.create_message(content=content)
+            await self.messaging.send(content)
+        except RateLimited as error:
+            # Frame is dropped, client slows down and sends it again
+            self.queue_json({'type': 'ERROR', 'error': rate_limited(), 'retry_after': error.retry_after})
         except (ValidationError, Exception):
             return await self.close(code=exceptions.chat_message_invalid())
 
-        await self.channel_layer.group_send(
-            self.chat_group_name,
-            {
-                'type': 'chat_message',
-                'message': message
-            }
-        )
-        users_chats_groups = await self.get_users_chats_groups()
-        users_notifications_groups = await self.get_users_notifications_groups()
-        send_chats = self.forward_to_users_chats(users_chats_groups)
-        send_notifications = self.forward_to_users_notifications(users_notifications_groups, message)
-        await asyncio.gather(send_chats, send_notifications)
-
     async def chat_message(self, event):
         message = event['message']
-        await self.send_json(content=message)
-
-    async def forward_to_users_chats(self, groups):
-        content = {
-            'type': 'chat_message',
-            'chat_id': self.chat_id,
-        }
-        for group in groups:
-            await self.channel_layer.group_send(group, content)
-
-    async def forward_to_users_notifications(self, groups, message):
-        await self.prepare_message_to_notification(message)
-        content = {
-            'type': 'chat_message',
-            'message': message,
-        }
-        for group in groups:
-            await self.channel_layer.group_send(group, content)
+        self.queue_json(message)
 
-    @database_sync_to_async
-    def prepare_message_to_notification(self, message):
-        del message['chat_id']
-        del message['user_id']
-        chat_serializer = ChatSerializer(instance=self.chat)
-        chat_serializer.uid = self.user.pk
-        message['chat'] = chat_serializer.data
-        message['user'] = ChatUserSerializer(instance=self.user).data
+    async def chat_activity(self, event):
+        activities = {user_id: value for user_id, value in event['activities'].items() if user_id != str(self.user.pk)}
+        if activities:
+            self.queue_json({'type': 'ACTIVITY', 'chat_id': event['chat_id'], 'data': activities},
+                            key='activity', merge=merge_data, ephemeral=True)
 
     @database_sync_to_async
     def get_chat(self, chat_id):
         return Chat.objects.get(pk=chat_id)
 
     @database_sync_to_async
-    def check_chat_member(self, chat, user_id):
-        return chat.users.filter(pk=user_id).exists()
+    def get_chat_members(self, chat_id):
+        return membership.members(chat_id)
+
+    @database_sync_to_async
+    def start_chat_session(self):
+        return presence.connect(self.user.pk, self.channel_name, presence.KIND_CHAT, chat_id=self.chat.pk)
 
+    @database_sync_to_async
+    def end_chat_session(self):
+        presence.disconnect(self.user.pk, self.channel_name, presence.KIND_CHAT, chat_id=self.chat.pk)
+
+
+def merge_notifications_frames(old, new):
+    return {**new, 'data': merge_digest_frames(old['data'], new['data'])}
+
+
+class MultiplexConsumer(OutboundQueueMixin, AsyncJsonWebsocketConsumer):
     """
-        @return chats groups of active users and notifications groups of users that active but not active at any chat or
-                active at another chats but not current chat.
+        One authenticated connection for chats list, notifications and any number of chats streams.
+        Incoming frames:
+            {'action': 'subscribe' | 'unsubscribe', 'stream': 'chats' | 'notifications' | 'chat', 'chat_id': ...}
+            {'action': 'message', 'chat_id': ..., 'message': message or list of messages}
+            {'action': 'resume', 'chat_id': ..., 'since_seq': ..., 'limit': ...}
+            {'action': 'read', 'chat_id': ..., 'seq': latest read message seq (optional)}
+            {'action': 'activity', 'chat_id': ..., 'activity': 'TYPING' | 'RECORDING' | 'STOPPED'}
+        Outgoing frames:
+            {'stream': ..., 'chat_id': ..., 'data': ...}
+            {'stream': ..., 'chat_id': ..., 'error': websocket error code}
+            {'stream': 'chat', 'chat_id': ..., 'error': 4029, 'retry_after': seconds} for rate limited messages
+            {'type': 'RESUME', 'data': {'reason': 'slow_consumer', 'subscriptions': [...]}} before slow client is
+            disconnected (see `core.outbound`)
+        A subscribed chat stream is required to send messages, resume, mark read or report activity in that chat.
     """
+    user = None
+    # {(stream, chat_id): group name}
+    subscriptions = None
+    # {chat_id: ChatMessaging}
+    chats = None
+
+    async def connect(self):
+        await self.accept()
+        self.user = self.scope['user']
+        # Validating Data
+        if self.user.is_anonymous:
+            return await self.close(code=auth_user_not_found())
+        self.subscriptions = {}
+        self.chats = {}
+        presence.ensure_history_flusher()
+        presence.ensure_heartbeat()
+        unread.ensure_markers_flusher()
+
+    async def disconnect(self, code):
+        for stream, chat_id in list(self.subscriptions or {}):
+            await self.unsubscribe(stream, chat_id)
+
+    async def receive_json(self, content, **kwargs):
+        if self.subscriptions is None:
+            return
+        if not isinstance(content, dict):
+            return self.send_error(None, None, exceptions.chat_message_invalid())
+        action = content.get('action')
+        stream = content.get('stream', STREAM_CHAT)
+        chat_id = content.get('chat_id')
+        if stream == STREAM_CHAT or action in ('message', 'resume', 'read', 'activity'):
+            stream = STREAM_CHAT
+            if not str(chat_id).isnumeric():
+                return self.send_error(stream, chat_id, exceptions.chat_not_found())
+            chat_id = int(chat_id)
+        elif stream in (STREAM_CHATS, STREAM_NOTIFICATIONS):
+            chat_id = None
+        else:
+            return self.send_error(stream, chat_id, exceptions.chat_message_invalid())
+
+        if action == 'subscribe':
+            await self.subscribe(stream, chat_id)
+        elif action == 'unsubscribe':
+            await self.unsubscribe(stream, chat_id)
+        elif action in ('message', 'resume', 'read', 'activity'):
+            messaging = self.chats.get(chat_id)
+            if messaging is None:
+                return self.send_error(stream, chat_id, exceptions.unauthoraized_chat_access())
+            try:
+                if action == 'resume':
+                    data = await messaging.resume(content)
+                    return self.queue_json({'stream': stream, 'chat_id': chat_id, 'type': 'SYNC', 'data': data})
+                if action == 'activity':
+                    return messaging.report_activity(content.get('activity'))
+                if action == 'read':
+                    data = await messaging.mark_read(content)
+                    return self.queue_json({'stream': stream, 'chat_id': chat_id, 'type': 'READ', 'data': data})
+                await messaging.send(content.get('message'))
+            except RateLimited as error:
+                self.queue_json({'stream': stream, 'chat_id': chat_id, 'error': rate_limited(),
+                                 'retry_after': error.retry_after})
+            except (ValidationError, Exception):
+                return self.send_error(stream, chat_id, exceptions.chat_message_invalid())
+        else:
+            self.send_error(stream, chat_id, exceptions.chat_message_invalid())
+
+    async def subscribe(self, stream, chat_id):
+        if (stream, chat_id) in self.subscriptions:
+            return
+        if stream == STREAM_CHAT:
+            members_ids = await self.get_chat_members(chat_id)
+            if members_ids is None:
+                return self.send_error(stream, chat_id, exceptions.chat_not_found())
+            if self.user.pk not in members_ids:
+                return self.send_error(stream, chat_id, exceptions.unauthoraized_chat_access())
+            chat = await self.get_chat(chat_id)
+            if chat is None:
+                # Deleted meanwhile
+                return self.send_error(stream, chat_id, exceptions.chat_not_found())
+            self.chats[chat_id] = ChatMessaging(self.channel_layer, self.user, chat)
+            group_name = chat_group_name(chat_id)
+        elif stream == STREAM_CHATS:
+            group_name = self.user.chats_group
+        else:
+            group_name = self.user.notifications_group
+        self.subscriptions[(stream, chat_id)] = group_name
+        await self.start_stream_session(stream, chat_id)
+        await self.channel_layer.group_add(group_name, self.channel_name)
+
+    async def unsubscribe(self, stream, chat_id):
+        group_name = self.subscriptions.pop((stream, chat_id), None)
+        if group_name is None:
+            return
+        if stream == STREAM_CHAT:
+            messaging = self.chats.pop(chat_id, None)
+            if messaging is not None:
+                messaging.report_activity(ACTIVITY_STOPPED)
+        await self.channel_layer.group_discard(group_name, self.channel_name)
+        await self.end_stream_session(stream, chat_id)
+
+    def send_error(self, stream, chat_id, code):
+        self.queue_json({'stream': stream, 'chat_id': chat_id, 'error': code})
+
+    async def chat_message(self, event):
+        stream = event.get('stream')
+        if stream == STREAM_CHAT:
+            self.queue_json({'stream': stream, 'chat_id': event['chat_id'], 'data': event['message']})
+        elif stream == STREAM_CHATS:
+            chat = event.get('chat')
+            if chat is not None:
+                chat = project_chat_delta(self.user, chat)
+            if chat is None:
+                chat = await self.get_chat_json(chat_id=event['chat_id'])
+            self.queue_json({'stream': stream, 'chat_id': event['chat_id'], 'data': chat},
+                            key=(stream, event['chat_id']), merge=merge_data)
+        elif stream == STREAM_NOTIFICATIONS:
+            chat_id = event.get('chat_id')
+            frame = digest_frame(event['message'], event.get('count', 1))
+            self.queue_json({'stream': stream, 'chat_id': chat_id, 'data': frame},
+                            key=(stream, chat_id) if chat_id else None, merge=merge_notifications_frames)
+
+    async def chat_activity(self, event):
+        activities = {user_id: value for user_id, value in event['activities'].items() if user_id != str(self.user.pk)}
+        if activities:
+            frame = {'stream': STREAM_CHAT, 'chat_id': event['chat_id'], 'type': 'ACTIVITY', 'data': activities}
+            self.queue_json(frame, key=('activity', event['chat_id']), merge=merge_data, ephemeral=True)
+
+    def resume_hint(self):
+        # Streams to subscribe again, chats are resumed from their latest seq the client has
+        return {'type': 'RESUME', 'data': {
+            'reason': 'slow_consumer',
+            'subscriptions': [{'stream': stream, 'chat_id': chat_id} for stream, chat_id in self.subscriptions],
+        }}
+
+    @database_sync_to_async
+    def get_chat_json(self, chat_id):
+        return get_chat_json(self.user, chat_id)
 
     @database_sync_to_async
-    def get_users_chats_groups(self):
-        active_members = self.chat.users.filter(sessions__state='ACTIVE')
-        return [member.chats_group for member in active_members]
+    def get_chat(self, chat_id):
+        return Chat.objects.filter(pk=chat_id).first()
 
     @database_sync_to_async
-    def get_users_notifications_groups(self):
-        cur_pk = self.user.pk
-        active_members = [member for member in self.chat.users.all() if member.notifications_group_active]
-        active_members_chats_sessions = [(member, member.active_chats_sessions) for member in active_members]
-        return [member.notifications_group for member, sessions in active_members_chats_sessions if
-                member.pk != cur_pk and
-                (len(sessions) == 0 or self.chat.pk not in [session.chat.pk for session in sessions])]
+    def get_chat_members(self, chat_id):
+        return membership.members(chat_id)
 
     @database_sync_to_async
-    def create_message(self, content):
-        serializer = MessageSerializer(data=content)
-        serializer.is_valid(raise_exception=True)
-        serializer.save(user=self.user, chat=self.chat)
-        return serializer.data
+    def start_stream_session(self, stream, chat_id):
+        return presence.connect(self.user.pk, self.channel_name, stream, chat_id=chat_id)
 
     @database_sync_to_async
-    def start_chat_session(self):
-        return self.chat.start_session(user=self.user, channel_name=self.channel_name)
+    def end_stream_session(self, stream, chat_id):
+        presence.disconnect(self.user.pk, self.channel_name, stream, chat_id=chat_id,
+                            keep_history=stream != STREAM_NOTIFICATIONS)
+
+
+class ChatExportConsumer(AsyncHttpConsumer):
+    """
+        ASGI version of `ChatMessageExportApiView`.
+        Django ASGI handler iterates streaming responses inside the event loop, where database access isn't allowed,
+        so export chunks are pulled one by one from a dedicated thread (same thread => same database connection for
+        the whole `iterator()`), and the next chunk isn't read before the previous one is sent.
+    """
+
+    async def handle(self, body):
+        try:
+            chat_id = await self.authorize()
+            params = export.parse_export_params(QueryDict(self.scope['query_string'].decode()))
+        except FlamesCLoudException as error:
+            return await self.send_response(error.status_code, dumps({'errors': error.detail}),
+                                            headers=[(b'Content-Type', b'application/json')])
+        await self.send_headers(headers=[
+            (b'Content-Type', export.EXPORT_CONTENT_TYPE.encode()),
+            (b'Content-Disposition', f'attachment; filename="{export.export_filename(chat_id)}"'.encode()),
+        ])
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        chunks = export.iter_export(export.get_export_rows(chat_id, **params))
+        try:
+            while True:
+                chunk = await loop.run_in_executor(executor, next, chunks, None)
+                if chunk is None:
+                    break
+                await self.send_body(chunk, more_body=True)
+        finally:
+            await loop.run_in_executor(executor, self.close_export, chunks)
+            executor.shutdown(wait=False)
+        await self.send_body(b'')
+
+    async def authorize(self):
+        """
+            @return chat id if user is authenticated member of the chat.
+        """
+        user = self.scope.get('user')
+        if user is None or user.is_anonymous:
+            raise NotAuthenticatedRequest()
+        chat_id = self.scope['url_route']['kwargs']['pk']
+        members_ids = await self.get_chat_members(chat_id) if chat_id.isnumeric() else None
+        if members_ids is None:
+            raise exceptions.NoChatWithId()
+        if user.pk not in members_ids:
+            raise exceptions.NotChatMember()
+        if not await database_sync_to_async(user.has_profile)():
+            raise AuthProfileNotFoundException()
+        return int(chat_id)
 
     @database_sync_to_async
-    def end_chat_session(self):
-        self.session.end()
+    def get_chat_members(self, chat_id):
+        return membership.members(chat_id)
+
+    @staticmethod
+    def close_export(chunks):
+        chunks.close()
+        connection.close()
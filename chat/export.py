@@ -0,0 +1,94 @@
+import zlib
+from itertools import chain
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from core.exceptions import ValidationException
+from core.renderers import dumps
+from .archive import MessageArchive
+from .models import Message
+
+"""
+    Streaming chat export, gzip compressed NDJSON (a `MessageSerializer` like json object per line) ordered by id.
+    Rows are read by `QuerySet.iterator(chunk_size)` and compressed chunk by chunk, so memory is flat whatever chat
+    size is. Archived messages (see `chat.archive`) come first as their ids are lower. An interrupted export is
+    resumed with `after_id` = id of the last complete line received.
+"""
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+EXPORT_COMPRESS_LEVEL = getattr(settings, 'EXPORT_COMPRESS_LEVEL', 6)
+
+EXPORT_FIELDS = ('id', 'chat_id', 'user_id', 'seq', 'type', 'content', 'created_at')
+EXPORT_CONTENT_TYPE = 'application/gzip'
+
+# zlib window bits of gzip container
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def parse_datetime_param(value, field):
+    if value is None:
+        return None
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationException('invalid', field, 'Datetime has wrong format, use ISO 8601.')
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def parse_export_params(params):
+    """
+        @param params: query params, `since`/`until` ISO 8601 datetimes and `after_id` message id.
+    """
+    after_id = params.get('after_id')
+    if after_id is not None and not after_id.isnumeric():
+        raise ValidationException('invalid', 'after_id', 'A valid integer is required.')
+    return {
+        'since': parse_datetime_param(params.get('since'), 'since'),
+        'until': parse_datetime_param(params.get('until'), 'until'),
+        'after_id': int(after_id) if after_id is not None else None,
+    }
+
+
+def get_export_queryset(chat_id, since=None, until=None, after_id=None, include_disabled=False):
+    queryset = Message.objects.filter(chat_id=chat_id)
+    if not include_disabled:
+        queryset = queryset.filter(is_disabled=False)
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    if after_id is not None:
+        queryset = queryset.filter(pk__gt=after_id)
+    return queryset.order_by('pk').values(*EXPORT_FIELDS)
+
+
+def get_export_rows(chat_id, since=None, until=None, after_id=None, include_disabled=False,
+                    chunk_size=EXPORT_CHUNK_SIZE):
+    """
+        @return iterator of archived then hot messages rows, ordered by id.
+    """
+    archived = MessageArchive(chat_id).iter_rows(since, until, after_id, include_disabled)
+    queryset = get_export_queryset(chat_id, since, until, after_id, include_disabled)
+    return chain(archived, queryset.iterator(chunk_size=chunk_size))
+
+
+def iter_export(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+        @return generator of gzip compressed NDJSON chunks of `get_export_rows` rows.
+    """
+    compressor = zlib.compressobj(EXPORT_COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    lines = []
+    for row in rows:
+        lines.append(dumps(row) + b'\n')
+        if len(lines) >= chunk_size:
+            data = compressor.compress(b''.join(lines))
+            lines = []
+            if data:
+                yield data
+    yield compressor.compress(b''.join(lines)) + compressor.flush()
+
+
+def export_filename(chat_id):
+    return f'chat-{chat_id}.ndjson.gz'
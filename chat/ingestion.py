@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from rest_framework.exceptions import ValidationError
+from core import ratelimit
+from .models import Chat, Message
+from .serializers import MessageSerializer
+
+"""
+    Write-behind messages ingestion.
+    Messages submitted by all consumers of the worker within `MESSAGE_BATCH_WINDOW` seconds are inserted with one
+    `bulk_create`, then every sender gets its own saved messages (with ids) back to broadcast them.
+    The whole batch is one sync unit of work (one thread pool hop): senders sync steps before saving (e.g. taking rate
+    tokens) and after saving (e.g. resolving recipients) run in it too, instead of hops of their own.
+"""
+
+MESSAGE_BATCH_WINDOW = getattr(settings, 'MESSAGE_BATCH_WINDOW', 0.005)
+MESSAGE_BATCH_MAX_SIZE = getattr(settings, 'MESSAGE_BATCH_MAX_SIZE', 500)
+MESSAGE_FRAME_MAX_SIZE = getattr(settings, 'MESSAGE_FRAME_MAX_SIZE', 50)
+# Messages per second and burst of a user (all chats) and of a chat (all members), bursts fit a full batch frame
+MESSAGE_RATE_USER = getattr(settings, 'MESSAGE_RATE_USER', 10)
+MESSAGE_RATE_USER_BURST = getattr(settings, 'MESSAGE_RATE_USER_BURST', 60)
+MESSAGE_RATE_CHAT = getattr(settings, 'MESSAGE_RATE_CHAT', 100)
+MESSAGE_RATE_CHAT_BURST = getattr(settings, 'MESSAGE_RATE_CHAT_BURST', 300)
+
+MESSAGE_TYPES = {option for option, _ in Message.TYPE_OPTIONS}
+
+logger = logging.getLogger(__name__)
+
+
+def get_rate_buckets(user_id, chat_id):
+    return [
+        ratelimit.Bucket(f'messages:user:{user_id}', MESSAGE_RATE_USER, MESSAGE_RATE_USER_BURST),
+        ratelimit.Bucket(f'messages:chat:{chat_id}', MESSAGE_RATE_CHAT, MESSAGE_RATE_CHAT_BURST),
+    ]
+
+
+def get_frame_cost(content):
+    """
+        @return messages count of frame content, checked before the frame is validated.
+    """
+    return min(max(len(content), 1), MESSAGE_FRAME_MAX_SIZE) if isinstance(content, list) else 1
+
+
+def build_message(content, user_id, chat_id):
+    """
+        Light validation of incoming frame item instead of full `MessageSerializer` validation.
+    """
+    if not isinstance(content, dict):
+        raise ValidationError('Invalid message.')
+    message_type = content.get('type')
+    message_content = content.get('content')
+    if message_type not in MESSAGE_TYPES:
+        raise ValidationError({'type': f'"{message_type}" is not a valid choice.'})
+    if not isinstance(message_content, str) or not message_content:
+        raise ValidationError({'content': 'This field may not be blank.'})
+    return Message(user_id=user_id, chat_id=chat_id, type=message_type, content=message_content)
+
+
+def build_messages(content, user_id, chat_id):
+    """
+        @param content: frame content, a message or list of messages.
+    """
+    items = content if isinstance(content, list) else [content]
+    if not items or len(items) > MESSAGE_FRAME_MAX_SIZE:
+        raise ValidationError('Invalid messages count.')
+    return [build_message(item, user_id, chat_id) for item in items]
+
+
+def save_messages(messages):
+    """
+        Inserts messages with their chats sequence numbers and updates chats last message.
+        @return serialized saved messages
+    """
+    with transaction.atomic():
+        Chat.assign_sequences(messages)
+        Message.objects.bulk_create(messages, batch_size=MESSAGE_BATCH_MAX_SIZE)
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # e.g. SQLite, rows ids are not returned but the transaction holds the database write lock,
+            # so the latest rows are the inserted ones in the same order.
+            pks = Message.objects.order_by('-pk').values_list('pk', flat=True)[:len(messages)]
+            for message, pk in zip(messages, reversed(list(pks))):
+                message.pk = pk
+        Chat.update_last_messages(messages)
+    return MessageSerializer(messages, many=True).data
+
+
+def save_batch(batch):
+    """
+        @param batch: [(messages, before, after)] of submissions, see `MessageBatcher.submit`.
+        @return [(saved messages, after result) or exception] of submissions, in the same order. Saved messages
+                are never failed by their `after` step (its result is None then).
+    """
+    results = [None] * len(batch)
+    accepted = []
+    for index, (messages, before, _) in enumerate(batch):
+        try:
+            if before is not None:
+                before()
+            accepted.append(index)
+        except Exception as error:
+            results[index] = error
+    data = save_messages([message for index in accepted for message in batch[index][0]]) if accepted else []
+    start = 0
+    for index in accepted:
+        messages, _, after = batch[index]
+        saved = data[start:start + len(messages)]
+        start += len(messages)
+        try:
+            results[index] = (saved, after(saved) if after is not None else None)
+        except Exception:
+            logger.exception('After saving step of %s messages failed', len(saved))
+            results[index] = (saved, None)
+    return results
+
+
+class MessageBatcher:
+    def __init__(self, window=MESSAGE_BATCH_WINDOW, max_size=MESSAGE_BATCH_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self.pending_count = 0
+        self.flush_event = None
+        self.flush_task = None
+
+    async def submit(self, messages, before=None, after=None):
+        """
+            @param before: sync callable run before messages are saved, raising rejects them.
+            @param after: sync callable of saved messages run after they are saved (transaction committed).
+            @return serialized saved messages, in the same order, and `after` result.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((messages, before, after, future))
+        self.pending_count += len(messages)
+        if self.flush_task is None:
+            self.flush_event = asyncio.Event()
+            self.flush_task = asyncio.ensure_future(self.flush())
+        if self.pending_count >= self.max_size:
+            self.flush_event.set()
+        return await future
+
+    async def flush(self):
+        try:
+            await asyncio.wait_for(self.flush_event.wait(), timeout=self.window)
+        except asyncio.TimeoutError:
+            pass
+        batch = self.pending
+        self.pending = []
+        self.pending_count = 0
+        self.flush_task = None
+        try:
+            results = await database_sync_to_async(save_batch)([submission[:3] for submission in batch])
+        except Exception as error:
+            results = [error] * len(batch)
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+batcher = MessageBatcher()
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from chat import archive
+
+
+class Command(BaseCommand):
+    help = 'Moves messages older than --age-days out of messages table into compressed archive segments. ' \
+           'Reads fall through to the archive, so it is safe to run periodically (e.g. daily cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age-days', type=int, default=archive.MESSAGE_ARCHIVE_AGE_DAYS)
+        parser.add_argument('--segment-size', type=int, default=archive.MESSAGE_ARCHIVE_SEGMENT_SIZE)
+        parser.add_argument('--chat', type=int, action='append', dest='chats', help='Chat id, all chats by default.')
+
+    def handle(self, *args, **options):
+        cutoff = archive.get_cutoff(options['age_days'])
+        chats_ids = options['chats'] or list(archive.get_cold_chats_ids(cutoff))
+        archived = 0
+        for chat_id in chats_ids:
+            archived += archive.archive_chat(chat_id, cutoff, options['segment_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} messages of {len(chats_ids)} chats.'))
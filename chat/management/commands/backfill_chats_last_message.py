@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from chat.models import Chat, Message
+
+
+class Command(BaseCommand):
+    help = 'Backfills chats denormalized last message and last activity from messages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        latest = Message.objects.filter(chat=OuterRef('pk')).order_by('-created_at', '-pk')
+        count = 0
+        last_pk = 0
+        while True:
+            pks = list(Chat.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            count += Chat.objects.filter(pk__in=pks).update(
+                last_message_id=Subquery(latest.values('pk')[:1]),
+                last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+            )
+            last_pk = pks[-1]
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {count} chats.'))
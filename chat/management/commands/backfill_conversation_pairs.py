@@ -0,0 +1,33 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from chat.models import Chat, ConversationPair
+
+
+class Command(BaseCommand):
+    help = 'Indexes existing CONVERSATION chats by their users pair, the oldest chat of duplicated pairs is kept.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chats_users = defaultdict(list)
+        memberships = Chat.users.through.objects.filter(
+            chat__type='CONVERSATION', chat__pair__isnull=True
+        ).order_by('chat_id').values_list('chat_id', 'user_id')
+        for chat_id, user_id in memberships.iterator(chunk_size=options['batch_size']):
+            chats_users[chat_id].append(user_id)
+
+        indexed = set(ConversationPair.objects.values_list('low_user_id', 'high_user_id'))
+        pairs = []
+        duplicates = 0
+        for chat_id, users_ids in chats_users.items():
+            if len(users_ids) != 2:
+                continue
+            key = ConversationPair.objects.ordered(*users_ids)
+            if key in indexed:
+                duplicates += 1
+                continue
+            indexed.add(key)
+            pairs.append(ConversationPair(chat_id=chat_id, low_user_id=key[0], high_user_id=key[1]))
+        ConversationPair.objects.bulk_create(pairs, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {len(pairs)} conversations, skipped {duplicates} duplicates.'))
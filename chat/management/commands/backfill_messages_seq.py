@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from chat.models import Chat, Message, MessageArchiveSegment
+
+
+class Command(BaseCommand):
+    help = 'Numbers messages without sequence number by creation order, after the latest sequence number of ' \
+           'their chats. Numbers clients already have are kept.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        chats_ids = list(Message.objects.filter(seq__isnull=True).values_list('chat_id', flat=True).distinct())
+        for chat_id in chats_ids:
+            with transaction.atomic():
+                # Locks counter row, so no messages are numbered meanwhile
+                chats = Chat.objects.select_for_update().filter(pk=chat_id)
+                last_seq = max(
+                    chats.values_list('last_seq', flat=True).get(),
+                    Message.objects.filter(chat_id=chat_id).aggregate(value=Max('seq'))['value'] or 0,
+                    MessageArchiveSegment.objects.filter(chat_id=chat_id).aggregate(value=Max('last_seq'))['value']
+                    or 0,
+                )
+                messages = list(Message.objects.filter(chat_id=chat_id, seq__isnull=True)
+                                .order_by('created_at', 'pk').only('pk'))
+                for seq, message in enumerate(messages, start=last_seq + 1):
+                    message.seq = seq
+                Message.objects.bulk_update(messages, ['seq'], batch_size=batch_size)
+                Chat.objects.filter(pk=chat_id).update(last_seq=last_seq + len(messages))
+        self.stdout.write(self.style.SUCCESS(f'Numbered messages of {len(chats_ids)} chats.'))
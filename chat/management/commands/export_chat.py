@@ -0,0 +1,38 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from chat import export
+from chat.models import Chat
+from core.exceptions import ValidationException
+
+
+class Command(BaseCommand):
+    help = 'Streams chat messages as gzip compressed NDJSON to a file or stdout, with flat memory whatever chat size ' \
+           'is. Interrupted exports are resumed by --after-id of the last complete line.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('chat_id', type=int)
+        parser.add_argument('--output', default='-', help='File path, "-" for stdout.')
+        parser.add_argument('--since', help='ISO 8601 datetime, messages created at or after it.')
+        parser.add_argument('--until', help='ISO 8601 datetime, messages created before it.')
+        parser.add_argument('--after-id', type=int)
+        parser.add_argument('--include-disabled', action='store_true')
+        parser.add_argument('--chunk-size', type=int, default=export.EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        chat_id = options['chat_id']
+        if not Chat.objects.filter(pk=chat_id).exists():
+            raise CommandError(f'No chat with id {chat_id}.')
+        try:
+            since = export.parse_datetime_param(options['since'], 'since')
+            until = export.parse_datetime_param(options['until'], 'until')
+        except ValidationException as error:
+            raise CommandError(error.detail[0]['message'])
+        rows = export.get_export_rows(chat_id, since=since, until=until, after_id=options['after_id'],
+                                      include_disabled=options['include_disabled'], chunk_size=options['chunk_size'])
+        chunks = export.iter_export(rows, chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            sys.stdout.buffer.writelines(chunks)
+            return
+        with open(options['output'], 'wb') as output:
+            output.writelines(chunks)
+        self.stdout.write(self.style.SUCCESS(f'Exported chat {chat_id} to {options["output"]}.'))
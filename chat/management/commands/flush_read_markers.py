@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from chat import unread
+
+
+class Command(BaseCommand):
+    help = 'Persists changed read markers from redis to database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=unread.UNREAD_FLUSH_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        count = unread.flush_all_markers(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Flushed {count} read markers.'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core import presence
+
+
+class Command(BaseCommand):
+    help = 'Flushes ended websocket sessions from presence registry to database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=presence.PRESENCE_FLUSH_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        count = presence.flush_all_history(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Flushed {count} sessions.'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+from chat import search
+
+
+class Command(BaseCommand):
+    help = 'Creates messages search index if missing and reindexes all existing messages. ' \
+           'New messages are indexed incrementally, so it is only needed once for existing data or to compact index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        backend = search.get_backend(options['database'])
+        with transaction.atomic(using=options['database']):
+            backend.install()
+            backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt messages search index ({backend.vendor}).'))
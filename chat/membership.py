@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+from core.cache import LocalLRUCache
+from .models import Chat
+
+"""
+    Chat membership cache.
+    Members ids of every chat are cached in redis set `chat:<chat_id>:members` and in process LRU tier,
+    both are invalidated on `Chat.users` changes (see `chat.signals`), at once and again on commit.
+    Every invalidation bumps the chat membership version `chat:<chat_id>:members:version`, a set loaded from the
+    database is cached (rebuilt at once) only if the version didn't change meanwhile, so a load racing a removal
+    can't cache the removed member back.
+"""
+
+MEMBERSHIP_TTL = getattr(settings, 'MEMBERSHIP_TTL', 60 * 60 * 24)
+MEMBERSHIP_LOCAL_TTL = getattr(settings, 'MEMBERSHIP_LOCAL_TTL', 5)
+MEMBERSHIP_LOCAL_MAXSIZE = getattr(settings, 'MEMBERSHIP_LOCAL_MAXSIZE', 4096)
+
+# Set member that marks loaded set, as redis doesn't keep empty sets (User ids start from 1)
+LOADED_MARKER = 0
+
+_local = LocalLRUCache(maxsize=MEMBERSHIP_LOCAL_MAXSIZE, ttl=MEMBERSHIP_LOCAL_TTL)
+
+
+# KEYS => [members set, version], ARGV => [version read before loading ('' if none), ttl, members...]
+STORE_MEMBERS_LUA = """
+    if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    -- One by one, large rooms would exceed `unpack` limits
+    for i = 3, #ARGV do
+        redis.call('SADD', KEYS[1], ARGV[i])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+"""
+
+
+def members_key(chat_id):
+    return f'chat:{chat_id}:members'
+
+
+def version_key(chat_id):
+    return f'chat:{chat_id}:members:version'
+
+
+def get_connection():
+    return get_redis_connection('default')
+
+
+def _query_members(chat_id):
+    members_ids = frozenset(Chat.users.through.objects.filter(chat_id=chat_id).values_list('user_id', flat=True))
+    if not members_ids and not Chat.objects.filter(pk=chat_id).exists():
+        return None
+    return members_ids
+
+
+def _load_members(chat_id):
+    connection = get_connection()
+    version = connection.get(version_key(chat_id)) or b''
+    members_ids = _query_members(chat_id)
+    if members_ids is not None:
+        connection.eval(STORE_MEMBERS_LUA, 2, members_key(chat_id), version_key(chat_id), version, MEMBERSHIP_TTL,
+                        LOADED_MARKER, *members_ids)
+    return members_ids
+
+
+def members(chat_id):
+    """
+        @return frozenset of chat members ids or None if there is no chat with provided id.
+    """
+    chat_id = int(chat_id)
+    members_ids = _local.get(chat_id)
+    if members_ids is not None:
+        return members_ids
+    values = get_connection().smembers(members_key(chat_id))
+    if not values:
+        # Local tier is filled from redis only, a loaded set may not have been stored (see `STORE_MEMBERS_LUA`)
+        return _load_members(chat_id)
+    members_ids = frozenset(int(value) for value in values) - {LOADED_MARKER}
+    _local.set(chat_id, members_ids)
+    return members_ids
+
+
+def is_member(chat_id, user_id):
+    members_ids = members(chat_id)
+    return members_ids is not None and user_id in members_ids
+
+
+def _delete(chat_ids):
+    pipe = get_connection().pipeline()
+    for chat_id in chat_ids:
+        _local.delete(int(chat_id))
+        pipe.incr(version_key(chat_id))
+        pipe.expire(version_key(chat_id), MEMBERSHIP_TTL)
+        pipe.delete(members_key(chat_id))
+    pipe.execute()
+
+
+def invalidate(chat_ids):
+    chat_ids = list(chat_ids)
+    if not chat_ids:
+        return
+    # Deleted again on commit, so concurrent loads of not yet committed changes don't stay cached
+    _delete(chat_ids)
+    transaction.on_commit(lambda: _delete(chat_ids))
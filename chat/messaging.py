@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import functools
+import logging
+from channels.db import database_sync_to_async
+from authentication.models import chats_group_name
+from authentication.serializers import ChatUserSerializer
+from core import presence
+from core import ratelimit
+from core.exceptions import RateLimited
+from core.layers import group_send_many
+from notification.digests import digests
+from .models import Chat, chat_group_name
+from .recipients import resolve_recipients_groups
+from .serializers import ChatSerializer
+from . import activity
+from . import ingestion
+from . import membership
+from . import sync
+from . import unread
+
+"""
+    Channel layer events carry `stream` (same values as presence kinds) so a multiplexed connection, which is member of
+    chat, chats and notifications groups at once, knows which stream every event belongs to.
+"""
+
+STREAM_CHAT = presence.KIND_CHAT
+STREAM_CHATS = presence.KIND_CHATS
+STREAM_NOTIFICATIONS = presence.KIND_NOTIFICATIONS
+
+logger = logging.getLogger(__name__)
+
+
+def get_chat_json(user, chat_id):
+    chat_json = None
+    try:
+        serializer = ChatSerializer(instance=user.chats.get(pk=chat_id))
+        serializer.uid = user.pk
+        chat_json = serializer.data
+    except Chat.DoesNotExist:
+        pass
+    return chat_json
+
+
+def check_retry_after(retry_after):
+    if retry_after:
+        raise RateLimited(round(retry_after, 3))
+
+
+def project_chat_delta(user, chat):
+    """
+        Per user view of the shared chat delta, picks the user unread count out of all members counts.
+        @return None when counters of the user aren't loaded, the full chat has to be fetched then.
+    """
+    unread_counts = chat.get('unread_counts')
+    if unread_counts is None:
+        return chat
+    if str(user.pk) not in unread_counts:
+        return None
+    chat = {key: value for key, value in chat.items() if key != 'unread_counts'}
+    chat['unread_count'] = unread_counts[str(user.pk)]
+    return chat
+
+
+class ChatMessaging:
+    """
+        Messages pipeline of a chat for one of its connected members, shared by `ChatConsumer` and `MultiplexConsumer`.
+    """
+
+    def __init__(self, channel_layer, user, chat):
+        self.channel_layer = channel_layer
+        self.user = user
+        self.chat = chat
+        self.group_name = chat_group_name(chat.pk)
+
+    async def send(self, content):
+        """
+            @param content: a message or list of messages (batch frame).
+            @return saved messages
+        """
+        buckets = ingestion.get_rate_buckets(self.user.pk, self.chat.pk)
+        cost = ingestion.get_frame_cost(content)
+        # Floods are rejected by local buckets without leaving the event loop
+        check_retry_after(ratelimit.take_local(buckets, cost))
+        messages = ingestion.build_messages(content, user_id=self.user.pk, chat_id=self.chat.pk)
+        # Redis tokens, saving and recipients are one sync unit of work, shared with the batch
+        messages, fan_out = await ingestion.batcher.submit(
+            messages, before=functools.partial(self.take_rate_tokens, buckets, cost), after=self.prepare_fan_out)
+        if fan_out is None:
+            # Messages are saved whatever, they are broadcast to who can be found
+            fan_out = await self.get_degraded_fan_out()
+        users_chats_groups, users_notifications_groups, unread_counts = fan_out
+
+        for message in messages:
+            await self.channel_layer.group_send(
+                self.group_name,
+                {
+                    'type': 'chat_message',
+                    'stream': STREAM_CHAT,
+                    'chat_id': self.chat.pk,
+                    'message': message
+                }
+            )
+        chat_delta = self.build_chat_delta(messages[-1], unread_counts)
+        await self.forward_to_users_chats(users_chats_groups, chat_delta)
+        # Notifications go out debounced, one digest per chat
+        digests.add(self, users_notifications_groups, messages)
+        # Sent message ends typing
+        self.report_activity(activity.ACTIVITY_STOPPED)
+        return messages
+
+    async def resume(self, content):
+        return await self.get_messages_since(content.get('since_seq'), content.get('limit'))
+
+    def report_activity(self, value):
+        """
+            @param value: one of `activity.ACTIVITY_TYPES`, coalesced with activities of other members.
+        """
+        activity.coalescer.submit(self.channel_layer, self.chat.pk, self.user.pk, activity.parse_activity(value))
+
+    async def mark_read(self, content):
+        """
+            @param content: {'seq': latest read message `seq`}, the latest message of the chat if missing.
+            @return {'chat_id': ..., 'last_read_seq': ..., 'unread_count': ...}
+        """
+        seq, unread_count = await self.save_read_marker(content.get('seq'))
+        # Other connections of the user clear the chat badge
+        await self.channel_layer.group_send(self.user.chats_group, {
+            'type': 'chat_message',
+            'stream': STREAM_CHATS,
+            'chat_id': self.chat.pk,
+            'chat': {'id': self.chat.pk, 'unread_counts': {str(self.user.pk): unread_count}},
+        })
+        return {'chat_id': self.chat.pk, 'last_read_seq': seq, 'unread_count': unread_count}
+
+    async def forward_to_users_chats(self, groups, chat_delta):
+        content = {
+            'type': 'chat_message',
+            'stream': STREAM_CHATS,
+            'chat_id': self.chat.pk,
+            'chat': chat_delta,
+        }
+        await group_send_many(self.channel_layer, groups, content)
+
+    async def forward_to_users_notifications(self, groups_counts, message):
+        """
+            @param groups_counts: {notifications group: count of new messages}, only groups that are still recipients
+                                  of the chat notifications get them.
+            @param message: latest of the new messages.
+        """
+        recipients_groups = await self.prepare_message_to_notification(message)
+        counts_groups = collections.defaultdict(list)
+        for group, count in groups_counts.items():
+            if group in recipients_groups:
+                counts_groups[count].append(group)
+        await asyncio.gather(*[group_send_many(self.channel_layer, groups, {
+            'type': 'chat_message',
+            'stream': STREAM_NOTIFICATIONS,
+            'chat_id': self.chat.pk,
+            'count': count,
+            'message': message,
+        }) for count, groups in counts_groups.items()])
+
+    def build_chat_delta(self, latest_message, unread_counts):
+        """
+            Chat list item fields changed by new message (subset of `ChatSerializer` fields), with unread counts of
+            all members (see `project_chat_delta`).
+        """
+        chat_delta = {
+            'id': self.chat.pk,
+            'latest_message': dict(latest_message),
+            'updated_at': latest_message['created_at'],
+            'last_activity_at': latest_message['created_at'],
+        }
+        if unread_counts is not None:
+            chat_delta['unread_counts'] = unread_counts
+        return chat_delta
+
+    @database_sync_to_async
+    def prepare_message_to_notification(self, message):
+        """
+            @return current notifications groups of the chat recipients
+        """
+        del message['chat_id']
+        del message['user_id']
+        chat_serializer = ChatSerializer(instance=self.chat)
+        chat_serializer.uid = self.user.pk
+        message['chat'] = chat_serializer.data
+        message['user'] = ChatUserSerializer(instance=self.user).data
+        return set(resolve_recipients_groups(self.chat, self.user.pk)[1])
+
+    @database_sync_to_async
+    def get_messages_since(self, since_seq, limit):
+        return sync.get_messages_since(self.chat.pk, sync.parse_since_seq(since_seq), sync.parse_limit(limit))
+
+    def prepare_fan_out(self, messages):
+        """
+            @return recipients groups and unread counts of members after new messages.
+        """
+        unread_counts = unread.add_messages(self.chat.pk, membership.members(self.chat.pk) or (), self.user.pk,
+                                            messages[-1]['seq'], len(messages))
+        return resolve_recipients_groups(self.chat, self.user.pk) + (unread_counts,)
+
+    async def get_degraded_fan_out(self):
+        """
+            Fan out when recipients resolution failed (e.g. redis is down): chats groups of all members from the
+            database, without unread counts and notifications.
+        """
+        try:
+            members_ids = await database_sync_to_async(list)(
+                Chat.users.through.objects.filter(chat_id=self.chat.pk).values_list('user_id', flat=True))
+        except Exception:
+            logger.exception('Loading members of chat %s failed', self.chat.pk)
+            members_ids = []
+        return [chats_group_name(pk) for pk in members_ids], [], None
+
+    @database_sync_to_async
+    def save_read_marker(self, seq):
+        return unread.mark_read(self.user.pk, self.chat.pk, unread.parse_seq(seq))
+
+    def take_rate_tokens(self, buckets, cost):
+        """
+            Rejects the frame (`RateLimited`) when the user or the chat is out of messages tokens.
+        """
+        retry_after = ratelimit.take(buckets, cost)
+        if retry_after:
+            # Frame isn't sent, local tokens taken for it are given back
+            ratelimit.refund_local(buckets, cost)
+        check_retry_after(retry_after)
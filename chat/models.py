@@ -1,7 +1,20 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils import timezone
 from authentication.models import User
-from authentication.exceptions import AuthUserNotFoundException
+
+
+def chat_group_name(chat_id):
+    return f'chat.{chat_id}'
+
+
+class ChatManager(models.Manager):
+    def with_users(self):
+        """
+            Chats with last message and users (with everything `ChatUserSerializer` needs) prefetched.
+        """
+        return self.get_queryset().select_related('last_message').prefetch_related(
+            models.Prefetch('users', queryset=User.objects.with_chat_profile())
+        )
 
 
 class Chat(models.Model):
@@ -15,18 +28,50 @@ class Chat(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
     title = models.CharField(max_length=100, default=None, null=True)
+    # Denormalized from messages, maintained by `update_last_messages`
+    last_message = models.ForeignKey(to='Message', on_delete=models.SET_NULL, related_name='+', default=None,
+                                     null=True)
+    last_activity_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # Sequence number of the latest message, see `assign_sequences`
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    objects = ChatManager()
 
     @property
     def latest_message(self):
-        return self.messages.latest('created_at')
+        return self.last_message
+
+    @classmethod
+    def assign_sequences(cls, messages):
+        """
+            Reserves consecutive per chat sequence numbers for unsaved messages (in order),
+            must be called inside the transaction that inserts them, the counter row stays locked till its end.
+        """
+        chats_messages = {}
+        for message in messages:
+            chats_messages.setdefault(message.chat_id, []).append(message)
+        # Counter rows are locked in chat id order, so concurrent batches can't deadlock
+        for chat_id, chat_messages in sorted(chats_messages.items()):
+            cls.objects.filter(pk=chat_id).update(last_seq=models.F('last_seq') + len(chat_messages))
+            last_seq = cls.objects.filter(pk=chat_id).values_list('last_seq', flat=True).get()
+            for seq, message in enumerate(chat_messages, start=last_seq - len(chat_messages) + 1):
+                message.seq = seq
 
-    def start_session(self, user, channel_name):
-        if not isinstance(user, User):
-            raise AuthUserNotFoundException()
-        sessions = self.sessions
-        for session in sessions.filter(user=user, state='ACTIVE'):
-            session.end()
-        return sessions.create(user=user, channel_name=channel_name)
+    @classmethod
+    def update_last_messages(cls, messages):
+        """
+            Sets saved messages as last message of their chats unless a newer one is already set.
+        """
+        latest = {}
+        for message in messages:
+            if message.chat_id not in latest or latest[message.chat_id].pk < message.pk:
+                latest[message.chat_id] = message
+        now = timezone.now()
+        # Chat rows are locked in id order, so concurrent batches can't deadlock
+        for chat_id, message in sorted(latest.items()):
+            cls.objects.filter(
+                models.Q(last_message__isnull=True) | models.Q(last_message_id__lt=message.pk), pk=chat_id
+            ).update(last_message_id=message.pk, last_activity_at=message.created_at, updated_at=now)
 
 
 class Message(models.Model):
@@ -46,6 +91,106 @@ class Message(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(default=timezone.now)
     is_disabled = models.BooleanField(default=False)
+    # Per chat monotonic sequence number, null for messages before it was introduced (see `backfill_messages_seq`)
+    seq = models.PositiveBigIntegerField(default=None, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'seq'], name='unique_chat_message_seq'),
+        ]
+        indexes = [
+            # Chat history pages are index range scans
+            models.Index(fields=['chat', 'is_disabled', 'created_at', 'id'], name='message_chat_history_idx'),
+        ]
+
+
+class MessageArchiveSegment(models.Model):
+    """
+        Compressed run of consecutive (by id) cold messages of a chat, moved out of `Message` table by
+        `chat.archive`. Archived ids of a chat are always lower than its hot messages ids.
+    """
+    chat = models.ForeignKey(to=Chat, on_delete=models.DO_NOTHING, related_name='archive_segments')
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_seq = models.PositiveBigIntegerField(default=None, null=True)
+    last_seq = models.PositiveBigIntegerField(default=None, null=True)
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    # zlib compressed json rows, see `chat.archive.ARCHIVE_FIELDS`
+    data = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'last_id'], name='archive_segment_chat_id_idx'),
+            models.Index(fields=['chat', 'last_seq'], name='archive_segment_chat_seq_idx'),
+        ]
+
+
+class ConversationPairManager(models.Manager):
+    @staticmethod
+    def ordered(user_id, other_user_id):
+        return (user_id, other_user_id) if user_id < other_user_id else (other_user_id, user_id)
+
+    def get_chat(self, user_id, other_user_id):
+        """
+            @return conversation chat of both users or None.
+        """
+        low_user_id, high_user_id = self.ordered(user_id, other_user_id)
+        pair = self.select_related('chat').filter(low_user_id=low_user_id, high_user_id=high_user_id).first()
+        return pair.chat if pair else None
+
+    def get_or_create_chat(self, user_id, other_user_id):
+        """
+            Race safe, concurrent creation of the same pair fails on unique constraint then reads the winner.
+            @return (chat, created)
+        """
+        chat = self.get_chat(user_id, other_user_id)
+        if chat is not None:
+            return chat, False
+        low_user_id, high_user_id = self.ordered(user_id, other_user_id)
+        try:
+            with transaction.atomic():
+                chat = Chat.objects.create(type='CONVERSATION')
+                chat.users.add(low_user_id, high_user_id)
+                self.create(chat=chat, low_user_id=low_user_id, high_user_id=high_user_id)
+        except IntegrityError:
+            return self.get_chat(user_id, other_user_id), False
+        return chat, True
+
+
+class ConversationPair(models.Model):
+    """
+        Canonical (low user id, high user id) index of CONVERSATION chats.
+    """
+    chat = models.OneToOneField(to=Chat, on_delete=models.CASCADE, related_name='pair')
+    low_user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+    high_user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+
+    objects = ConversationPairManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['low_user', 'high_user'], name='unique_conversation_pair'),
+            models.CheckConstraint(check=models.Q(low_user__lt=models.F('high_user')),
+                                   name='ordered_conversation_pair'),
+        ]
+
+
+class ChatReadMarker(models.Model):
+    """
+        Latest message sequence number read by a user in a chat, persisted lazily from redis by `chat.unread`.
+    """
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+')
+    chat = models.ForeignKey(to=Chat, on_delete=models.CASCADE, related_name='read_markers')
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat'], name='unique_chat_read_marker'),
+        ]
 
 
 class Session(models.Model):
@@ -64,4 +209,4 @@ class Session(models.Model):
     def end(self):
         self.state = 'INACTIVE'
         self.ended_at = timezone.now()
-        self.save()
+        self.save(update_fields=['state', 'ended_at'])
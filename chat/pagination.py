@@ -0,0 +1,88 @@
+from core.exceptions import InvalidCursor
+from core.pagination import AnchorCursorPagination
+from .archive import MessageArchive
+from .models import Message
+
+"""
+    Chat messages pagination over hot and archived messages (see `chat.archive`), archived messages come after
+    (are older than) all hot messages.
+"""
+
+
+class TieredMessages:
+    """
+        Newest first sequence of hot messages followed by archived ones, sliced by `Paginator`.
+    """
+    ordered = True
+
+    def __init__(self, queryset, archive):
+        self.queryset = queryset
+        self.archive = archive
+        self._hot_count = None
+
+    @property
+    def hot_count(self):
+        if self._hot_count is None:
+            self._hot_count = self.queryset.count()
+        return self._hot_count
+
+    def count(self):
+        return self.hot_count + self.archive.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('TieredMessages supports slicing only.')
+        start, stop = key.start or 0, key.stop
+        if stop <= self.hot_count:
+            return list(self.queryset[start:stop])
+        items = list(self.queryset[start:self.hot_count]) if start < self.hot_count else []
+        archive_start = max(start - self.hot_count, 0)
+        return items + self.archive.page(archive_start, stop - self.hot_count - archive_start)
+
+
+class ChatMessagesPagination(AnchorCursorPagination):
+    """
+        `AnchorCursorPagination` of a chat messages, continued in the archive past the oldest hot message.
+        View has `chat_id` attribute.
+    """
+    archive = None
+    chat_id = None
+
+    def get_anchor_queryset(self, queryset):
+        return Message.objects.filter(chat_id=self.chat_id)
+
+    def check_anchor(self, queryset, anchor_pk):
+        try:
+            super(ChatMessagesPagination, self).check_anchor(queryset, anchor_pk)
+        except InvalidCursor:
+            if not self.archive.segments.filter(first_id__lte=anchor_pk, last_id__gte=anchor_pk).exists():
+                raise
+
+    def get_before_items(self, queryset, anchor_pk, limit):
+        items = super(ChatMessagesPagination, self).get_before_items(queryset, anchor_pk, limit)
+        if len(items) < limit:
+            # Anchor is either the oldest hot message or an archived one
+            items += self.archive.before(items[-1].pk if items else anchor_pk, limit - len(items))
+        return items
+
+    def get_after_items(self, queryset, anchor_pk, limit):
+        items = super(ChatMessagesPagination, self).get_after_items(queryset, anchor_pk, limit)
+        if items or self.get_anchor_queryset(queryset).filter(pk=anchor_pk).exists():
+            return items
+        # Archived anchor, newer archived messages then the oldest hot ones
+        items = self.archive.after(anchor_pk, limit)
+        if len(items) < limit:
+            items += list(queryset.filter(pk__gt=anchor_pk).order_by(self.ordering_field, 'pk')[:limit - len(items)])
+        return items
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.chat_id = view.chat_id
+        self.archive = MessageArchive(self.chat_id)
+        before = self.get_anchor(request, self.before_query_param)
+        after = self.get_anchor(request, self.after_query_param)
+        if before is None and after is None:
+            queryset = TieredMessages(queryset, self.archive)
+        return super(ChatMessagesPagination, self).paginate_queryset(queryset, request, view)
@@ -1,5 +1,5 @@
 from rest_framework.permissions import BasePermission
-from .models import Chat
+from . import membership
 from enum import Enum
 
 
@@ -13,13 +13,12 @@ class IsChatMember(BasePermission):
 
     def has_permission(self, request, view):
         chat_id = view.kwargs['pk']
-        try:
-            chat = Chat.objects.get(pk=chat_id)
-        except Chat.DoesNotExist:
+        members_ids = membership.members(chat_id) if chat_id.isnumeric() else None
+        if members_ids is None:
             self.code = PermissionCode.NO_CHAT_WITH_ID
             return False
-        if not chat.users.filter(pk=request.user.pk).exists():
+        if request.user.pk not in members_ids:
             self.code = PermissionCode.NOT_CHAT_MEMBER
             return False
-        view.chat = chat
+        view.chat_id = int(chat_id)
         return True
@@ -0,0 +1,23 @@
+from core import presence
+from authentication.models import chats_group_name, notifications_group_name
+from . import membership
+
+
+def resolve_recipients_groups(chat, sender_id):
+    """
+        Resolves new message recipients from cached chat membership and one presence pipeline.
+        @return chats groups of online members and notifications groups of members with active notifications
+                that are not active at the chat (other than the sender).
+    """
+    members_ids = membership.members(chat.pk) or ()
+    members_connections = presence.get_many_connections(members_ids)
+
+    chats_groups = []
+    notifications_groups = []
+    for pk, connections in members_connections.items():
+        if presence.is_connected(connections, presence.KIND_CHATS):
+            chats_groups.append(chats_group_name(pk))
+        if pk != sender_id and presence.is_connected(connections, presence.KIND_NOTIFICATIONS) and \
+                not presence.is_connected(connections, presence.KIND_CHAT, chat.pk):
+            notifications_groups.append(notifications_group_name(pk))
+    return chats_groups, notifications_groups
@@ -1,7 +1,14 @@
 from django.urls import path, re_path
-from .consumers import ChatsConsumer, ChatConsumer
+from core.authentication import TokenAuthMiddleware
+from .consumers import ChatsConsumer, ChatConsumer, MultiplexConsumer, ChatExportConsumer
 
 chat_ws_urlpatterns = [
+    path('ws/stream/', MultiplexConsumer.as_asgi()),
     path('ws/chat/list/', ChatsConsumer.as_asgi()),
     re_path(r'ws/chat/(?P<chat_id>\w+)/$', ChatConsumer.as_asgi())
 ]
+
+# HTTP endpoints served by consumers under ASGI, the rest of HTTP is served by django
+chat_http_urlpatterns = [
+    path('chat/<pk>/export/', TokenAuthMiddleware(ChatExportConsumer.as_asgi())),
+]
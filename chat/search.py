@@ -0,0 +1,214 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.module_loading import import_string
+from core.exceptions import ValidationException
+from .models import Chat, Message
+
+"""
+    Messages full-text search.
+    Index is maintained incrementally by the database itself (SQLite FTS5 table kept by triggers, Postgres GIN
+    expression index), so every write path (`bulk_create` of ingestion included) is indexed without application code.
+    Only `TEXT` messages are indexed, content of other types is media path.
+    Results are ranked (higher `search_rank` first) and paginated by (search_rank, id) keyset.
+"""
+
+MESSAGE_SEARCH_BACKEND = getattr(settings, 'MESSAGE_SEARCH_BACKEND', None)
+MESSAGE_SEARCH_CONFIG = getattr(settings, 'MESSAGE_SEARCH_CONFIG', 'simple')
+MESSAGE_SEARCH_QUERY_MIN_LENGTH = getattr(settings, 'MESSAGE_SEARCH_QUERY_MIN_LENGTH', 2)
+MESSAGE_SEARCH_QUERY_MAX_LENGTH = getattr(settings, 'MESSAGE_SEARCH_QUERY_MAX_LENGTH', 256)
+
+SEARCH_MESSAGE_TYPE = 'TEXT'
+
+
+class SearchBackend:
+    """
+        @method install: creates index structures if missing.
+        @method rebuild: reindexes all messages.
+        @method matches_sql: SQL of (id, score) rows of matching messages of chats selected by `chats_sql`, params
+                are [query] followed by `chats_sql` params.
+    """
+    vendor = None
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def execute(self, *statements):
+        with self.connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def install(self):
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def prepare_query(self, query):
+        return query
+
+    def matches_sql(self, chats_sql):
+        raise NotImplementedError
+
+    def search(self, query, user_id, chat_id=None, cursor=None, limit=20):
+        """
+            @param cursor: (search_rank, id) of the last item of the previous page.
+            @return [(id, search_rank)] of messages in chats of the user.
+        """
+        # Matches are restricted to chats of the user before they are ranked, not ranked globally then filtered
+        chats_sql = f'SELECT chat_id FROM {Chat.users.through._meta.db_table} WHERE user_id = %s'
+        params = [self.prepare_query(query), user_id]
+        if chat_id is not None:
+            chats_sql += ' AND chat_id = %s'
+            params.append(chat_id)
+        sql = f'SELECT id, score FROM ({self.matches_sql(chats_sql)}) matches'
+        if cursor is not None:
+            score, pk = cursor
+            sql += ' WHERE score < %s OR (score = %s AND id < %s)'
+            params += [score, score, pk]
+        sql += ' ORDER BY score DESC, id DESC LIMIT %s'
+        params.append(limit)
+        with self.connection.cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            return db_cursor.fetchall()
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    """
+        External content FTS5 table over `chat_message`, it stores the index only and reads content by rowid.
+    """
+    vendor = 'sqlite'
+    table = f'{Message._meta.db_table}_fts'
+
+    def install(self):
+        messages_table = Message._meta.db_table
+        table = self.table
+        # Index rows must be deleted with the exact indexed content, so triggers check type of old and new rows
+        self.execute(
+            f"""CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(
+                content, content='{messages_table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )""",
+            f"""CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {messages_table}
+                WHEN new.type = '{SEARCH_MESSAGE_TYPE}' BEGIN
+                    INSERT INTO {table}(rowid, content) VALUES (new.id, new.content);
+                END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {messages_table}
+                WHEN old.type = '{SEARCH_MESSAGE_TYPE}' BEGIN
+                    INSERT INTO {table}({table}, rowid, content) VALUES ('delete', old.id, old.content);
+                END""",
+            # One trigger as order of triggers of the same event isn't defined, old row is deleted before new is added
+            f"""CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE OF content, type ON {messages_table} BEGIN
+                    INSERT INTO {table}({table}, rowid, content)
+                        SELECT 'delete', old.id, old.content WHERE old.type = '{SEARCH_MESSAGE_TYPE}';
+                    INSERT INTO {table}(rowid, content)
+                        SELECT new.id, new.content WHERE new.type = '{SEARCH_MESSAGE_TYPE}';
+                END""",
+        )
+
+    def rebuild(self):
+        # 'rebuild' command would index all rows of content table, so index is rebuilt from `TEXT` messages only
+        table = self.table
+        self.execute(
+            f"INSERT INTO {table}({table}) VALUES ('delete-all')",
+            f"""INSERT INTO {table}(rowid, content)
+                SELECT id, content FROM {Message._meta.db_table} WHERE type = '{SEARCH_MESSAGE_TYPE}'""",
+            f"INSERT INTO {table}({table}) VALUES ('optimize')",
+        )
+
+    def prepare_query(self, query):
+        # Every term is quoted => FTS5 query syntax of user input is matched literally, terms are ANDed
+        return ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+
+    def matches_sql(self, chats_sql):
+        # bm25() is lower for better matches
+        return f"""
+            SELECT message.id AS id, -bm25({self.table}) AS score
+            FROM {self.table} JOIN {Message._meta.db_table} message ON message.id = {self.table}.rowid
+            WHERE {self.table} MATCH %s AND message.is_disabled = 0 AND message.chat_id IN ({chats_sql})
+        """
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+        Partial GIN index on `to_tsvector(MESSAGE_SEARCH_CONFIG, content)`, queries repeat the same expression and
+        predicate to use it.
+    """
+    vendor = 'postgresql'
+    index = f'{Message._meta.db_table}_search_idx'
+
+    @property
+    def document(self):
+        return f"to_tsvector('{MESSAGE_SEARCH_CONFIG}', content)"
+
+    def install(self):
+        self.execute(
+            f"""CREATE INDEX IF NOT EXISTS {self.index} ON {Message._meta.db_table} USING GIN ({self.document})
+                WHERE type = '{SEARCH_MESSAGE_TYPE}'"""
+        )
+
+    def rebuild(self):
+        self.execute(f'REINDEX INDEX {self.index}')
+
+    def matches_sql(self, chats_sql):
+        return f"""
+            SELECT message.id AS id, ts_rank({self.document}, query) AS score
+            FROM {Message._meta.db_table} message, plainto_tsquery('{MESSAGE_SEARCH_CONFIG}', %s) query
+            WHERE message.type = '{SEARCH_MESSAGE_TYPE}' AND {self.document} @@ query AND NOT message.is_disabled
+                AND message.chat_id IN ({chats_sql})
+        """
+
+
+BACKENDS = {backend.vendor: backend for backend in (SQLiteFTS5Backend, PostgresSearchBackend)}
+
+
+def get_backend(using=DEFAULT_DB_ALIAS):
+    if MESSAGE_SEARCH_BACKEND:
+        return import_string(MESSAGE_SEARCH_BACKEND)(using)
+    try:
+        return BACKENDS[connections[using].vendor](using)
+    except KeyError:
+        raise ImproperlyConfigured(f'No messages search backend for "{connections[using].vendor}" database.')
+
+
+def parse_query(value):
+    query = (value or '').strip()
+    if not query:
+        raise ValidationException('blank', 'q', 'This field may not be blank.')
+    if len(query) < MESSAGE_SEARCH_QUERY_MIN_LENGTH:
+        raise ValidationException('min_length', 'q',
+                                  f'Ensure this field has at least {MESSAGE_SEARCH_QUERY_MIN_LENGTH} characters.')
+    if len(query) > MESSAGE_SEARCH_QUERY_MAX_LENGTH:
+        raise ValidationException('max_length', 'q',
+                                  f'Ensure this field has no more than {MESSAGE_SEARCH_QUERY_MAX_LENGTH} characters.')
+    return query
+
+
+class MessageSearch:
+    """
+        Search of a user in its chats, paginated by `RankedKeysetPagination`.
+    """
+
+    def __init__(self, query, user_id, chat_id=None):
+        self.query = query
+        self.user_id = user_id
+        self.chat_id = chat_id
+
+    def page(self, cursor, limit):
+        """
+            @return messages with `search_rank` attribute, best match first.
+        """
+        rows = get_backend().search(self.query, self.user_id, self.chat_id, cursor, limit)
+        messages = Message.objects.in_bulk([pk for pk, _ in rows])
+        page = []
+        for pk, score in rows:
+            message = messages.get(pk)
+            # Deleted since matched
+            if message is None:
+                continue
+            message.search_rank = score
+            page.append(message)
+        return page
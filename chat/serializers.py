@@ -1,28 +1,66 @@
+from django.db import models
 from rest_framework import serializers
 from .models import Chat, Message
+from authentication.models import User
 from authentication.serializers import ChatUserSerializer
+from core import presence
+from . import unread
+
+
+def prefetched_users(chat):
+    """
+        @return chat users if prefetched (see `Chat.objects.with_users`) else None.
+    """
+    if 'users' in getattr(chat, '_prefetched_objects_cache', {}):
+        return list(chat.users.all())
+    return None
 
 
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['id', 'chat_id', 'user_id', 'type', 'content', 'created_at']
+        fields = ['id', 'chat_id', 'user_id', 'seq', 'type', 'content', 'created_at']
+        read_only_fields = ['seq']
+
+
+class ChatListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        chats = list(data.all() if isinstance(data, models.Manager) else data)
+        # Live connections of all users and unread counts of the page at once
+        presence.prefetch_connections([user for chat in chats for user in prefetched_users(chat) or []])
+        unread.prefetch_counts(self.child.get_uid(), chats)
+        return super().to_representation(chats)
 
 
 class ChatSerializer(serializers.ModelSerializer):
     users = serializers.SerializerMethodField()
-    latest_message = MessageSerializer(many=False, read_only=True)
+    latest_message = MessageSerializer(source='last_message', many=False, read_only=True)
+    unread_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Chat
-        fields = ['id', 'type', 'users', 'created_at', 'updated_at', 'title', 'latest_message']
+        fields = ['id', 'type', 'users', 'created_at', 'updated_at', 'last_activity_at', 'title', 'latest_message',
+                  'unread_count']
+        list_serializer_class = ChatListSerializer
 
     user_serializer = ChatUserSerializer
     uid = None
 
-    def get_users(self, obj):
+    def get_uid(self):
         if not self.uid:
             request = self.context.get('request', {})
             self.uid = request.user.pk
+        return self.uid
+
+    def get_unread_count(self, obj):
+        return unread.get_count(self.get_uid(), obj)
+
+    def get_users(self, obj):
+        self.get_uid()
 
-        return list(map(lambda user: self.user_serializer(user).data, obj.users.exclude(id=self.uid)))
+        users = prefetched_users(obj)
+        if users is None:
+            users = User.objects.with_chat_profile().filter(chats=obj).exclude(id=self.uid)
+        else:
+            users = [user for user in users if user.pk != self.uid]
+        return self.user_serializer(users, many=True).data
@@ -0,0 +1,26 @@
+from django.db.models.signals import m2m_changed, post_migrate
+from django.dispatch import receiver
+from .models import Chat
+from . import membership
+from . import search
+
+
+@receiver(m2m_changed, sender=Chat.users.through)
+def invalidate_chat_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    # reverse => `user.chats` was changed so `pk_set` holds chats ids
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            membership.invalidate([instance.pk])
+    elif action == 'pre_clear':
+        instance._cleared_chats_ids = list(instance.chats.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        membership.invalidate(getattr(instance, '_cleared_chats_ids', []))
+    elif action in ('post_add', 'post_remove'):
+        membership.invalidate(pk_set)
+
+
+@receiver(post_migrate)
+def install_messages_search(sender, using, **kwargs):
+    # Search index structures are raw SQL (no migrations), created once chat tables exist
+    if sender.name == 'chat':
+        search.get_backend(using).install()
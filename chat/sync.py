@@ -0,0 +1,53 @@
+from django.conf import settings
+from core.exceptions import ValidationException
+from .archive import MessageArchive
+from .models import Chat, Message
+from .serializers import MessageSerializer
+
+"""
+    Resumable messages sync, clients keep the latest `seq` they have of every chat and ask for the gap.
+    Disabled messages are returned as tombstones (`{'id', 'seq', 'is_disabled': True}`) so the `seq` series has no
+    holes and clients drop them if they have them.
+"""
+
+SYNC_MAX_LIMIT = getattr(settings, 'SYNC_MAX_LIMIT', 200)
+
+
+def parse_since_seq(value):
+    try:
+        since_seq = int(value)
+    except (TypeError, ValueError):
+        raise ValidationException('invalid', 'since_seq', 'A valid integer is required.')
+    if since_seq < 0:
+        raise ValidationException('invalid', 'since_seq', 'Ensure this value is greater than or equal to 0.')
+    return since_seq
+
+
+def parse_limit(value):
+    try:
+        return min(max(int(value), 1), SYNC_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return SYNC_MAX_LIMIT
+
+
+def serialize_messages(messages):
+    data = MessageSerializer([message for message in messages if not message.is_disabled], many=True).data
+    enabled = iter(data)
+    return [{'id': message.pk, 'seq': message.seq, 'is_disabled': True} if message.is_disabled else next(enabled)
+            for message in messages]
+
+
+def get_messages_since(chat_id, since_seq, limit=SYNC_MAX_LIMIT):
+    """
+        @return messages with `seq` greater than `since_seq` (oldest first), chat `last_seq` and whether more messages
+                are left, the client asks again from its latest `seq` while `has_more`.
+    """
+    messages = list(Message.objects.filter(chat_id=chat_id, seq__gt=since_seq).order_by('seq')[:limit + 1])
+    if not messages or messages[0].seq > since_seq + 1:
+        # Gap may be archived, archived sequence numbers are lower than hot ones
+        messages = (MessageArchive(chat_id).since_seq(since_seq, limit + 1) + messages)[:limit + 1]
+    return {
+        'messages': serialize_messages(messages[:limit]),
+        'last_seq': Chat.objects.filter(pk=chat_id).values_list('last_seq', flat=True).first(),
+        'has_more': len(messages) > limit,
+    }
@@ -1,3 +1,884 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import json
+import os
+import tempfile
+from datetime import date, datetime, timezone
+from io import StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync
+import fakeredis
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from authentication.models import User, Profile, Media, Session
+from .models import Chat, ConversationPair, Message
+from . import exceptions
+from .consumers import ChatConsumer, ChatsConsumer, MultiplexConsumer
+from .routing import chat_ws_urlpatterns
+from . import membership
+from . import search
+from . import export
+from . import archive
+from . import activity
+from . import unread
+from .ingestion import save_batch, save_messages
+from .messaging import ChatMessaging, project_chat_delta
+from .recipients import resolve_recipients_groups
+from core import presence
+from core import ratelimit
+from core.exceptions import RateLimited
 
-# Create your tests here.
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def no_connections(user_ids):
+    return {user_id: [] for user_id in user_ids}
+
+
+def unread_counts(user_id, chat_ids):
+    return {chat_id: chat_id * 10 for chat_id in chat_ids}
+
+
+class PatchedMembershipMixin:
+    """
+        Chats membership cache patched out, tests set `membership.members.return_value`.
+    """
+
+    def setUp(self):
+        super(PatchedMembershipMixin, self).setUp()
+        for patcher in (mock.patch('chat.membership.invalidate'), mock.patch('chat.membership.members')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class ChatsFixturesMixin:
+    """
+        Authenticated owner user and chats of owner with other users, each with a message.
+    """
+    users_per_chat = 3
+
+    def setUp(self):
+        super(ChatsFixturesMixin, self).setUp()
+        self.user = self.create_user('owner')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @staticmethod
+    def create_user(username):
+        user = User.objects.create_user(username, f'{username}@example.com', 'password')
+        profile = Profile.objects.create(user=user, first_name=username, last_name=username, gender='MALE',
+                                         birthdate=date(2000, 1, 1), country_code='EG', device_language='en')
+        for media_type in ('IMAGE', 'IMAGE', 'COVER'):
+            Media.objects.create(profile=profile, media=f'{username}.png', name=username, type=media_type,
+                                 extension='png', size=1)
+        Session.objects.create(user=user, state='INACTIVE')
+        return user
+
+    def create_chats(self, count):
+        for index in range(count):
+            chat = Chat.objects.create(type='ROOM')
+            chat.users.add(self.user, *[self.create_user(f'user_{chat.pk}_{i}') for i in range(self.users_per_chat)])
+            message = Message.objects.create(user=self.user, chat=chat, type='TEXT', content=str(index))
+            Chat.update_last_messages([message])
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage', CACHES=LOCMEM_CACHES)
+@mock.patch('core.presence.get_many_connections', no_connections)
+@mock.patch('chat.membership.invalidate', mock.Mock())
+@mock.patch('chat.unread.get_counts', unread_counts)
+class ChatListQueriesTestCase(ChatsFixturesMixin, TestCase):
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('chat_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_queries_count_is_constant(self):
+        self.create_chats(2)
+        queries_count = self.count_list_queries()
+        self.create_chats(8)
+        self.assertEqual(self.count_list_queries(), queries_count)
+
+    def test_users_are_serialized_with_latest_media_and_session(self):
+        self.create_chats(1)
+        with self.assertNumQueries(self.count_list_queries()):
+            data = self.client.get(reverse('chat_list')).json()['data']['results']
+        users = data[0]['users']
+        self.assertEqual(len(users), self.users_per_chat)
+        self.assertNotIn(self.user.pk, [user['id'] for user in users])
+        for user in users:
+            profile = user['profile']
+            self.assertEqual(profile['latest_image']['id'], Media.objects.filter(
+                profile_id=profile['id'], type='IMAGE').latest('created_at').pk)
+            self.assertEqual(profile['latest_cover']['type'], 'COVER')
+            self.assertEqual(user['session']['state'], 'INACTIVE')
+
+    def test_cursor_pages_cover_chats_by_latest_activity(self):
+        self.create_chats(5)
+        ids = []
+        cursor = None
+        while True:
+            params = {'page_size': 2, **({'cursor': cursor} if cursor else {})}
+            data = self.client.get(reverse('chat_list'), params).json()['data']
+            ids += [chat['id'] for chat in data['results']]
+            cursor = data['next']
+            if cursor is None:
+                break
+        expected = list(Chat.objects.order_by('-last_activity_at', '-pk').values_list('pk', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_crafted_cursor_is_invalid_cursor(self):
+        self.create_chats(1)
+        for position in ([{}, 1], ['2020-01-01T00:00:00+00:00', 'x'], [True, 1], ['apple', 1], 'x'):
+            cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            response = self.client.get(reverse('chat_list'), {'cursor': cursor})
+            self.assertEqual(response.status_code, 404, position)
+            self.assertEqual(response.json()['errors'][0]['code'], 'invalid_cursor')
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage', CACHES=LOCMEM_CACHES)
+@mock.patch('core.presence.get_many_connections', no_connections)
+class UnreadCountsTestCase(ChatsFixturesMixin, PatchedMembershipMixin, TestCase):
+    def setUp(self):
+        super(UnreadCountsTestCase, self).setUp()
+        patcher = mock.patch('chat.unread.get_connection', return_value=fakeredis.FakeStrictRedis())
+        self.redis = patcher.start()()
+        self.addCleanup(patcher.stop)
+        membership.members.return_value = frozenset([self.user.pk])
+
+    def test_unread_counts_are_read_at_once(self):
+        self.create_chats(3)
+        with mock.patch('chat.unread.get_counts', wraps=unread_counts) as get_counts:
+            data = self.client.get(reverse('chat_list')).json()['data']['results']
+        get_counts.assert_called_once()
+        self.assertEqual([chat['unread_count'] for chat in data], [chat['id'] * 10 for chat in data])
+
+    def test_mark_read_rejects_invalid_seq(self):
+        chat = Chat.objects.create(type='ROOM')
+        chat.users.add(self.user)
+        response = self.client.post(reverse('chat_mark_read', kwargs={'pk': chat.pk}), {'seq': -1}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_counters_are_incremented_once_loaded(self):
+        other = self.create_user('other')
+        chats = [Chat.objects.create(type='ROOM', last_seq=4) for _ in range(2)]
+        for chat in chats:
+            chat.users.add(self.user, other)
+        # New message before counters of the user are loaded (e.g. redis restart)
+        Chat.objects.filter(pk=chats[0].pk).update(last_seq=5)
+        self.assertEqual(unread.add_messages(chats[0].pk, [self.user.pk, other.pk], other.pk, 5, 1),
+                         {str(other.pk): 0})
+        self.assertEqual(unread.get_counts(self.user.pk, [chat.pk for chat in chats]),
+                         {chats[0].pk: 5, chats[1].pk: 4})
+        Chat.objects.filter(pk=chats[0].pk).update(last_seq=6)
+        self.assertEqual(unread.add_messages(chats[0].pk, [self.user.pk, other.pk], other.pk, 6, 1),
+                         {str(self.user.pk): 6, str(other.pk): 0})
+        self.assertEqual(unread.get_counts(self.user.pk, [chats[0].pk]), {chats[0].pk: 6})
+
+    def test_counters_loaded_meanwhile_are_kept(self):
+        chat = Chat.objects.create(type='ROOM', last_seq=5)
+        chat.users.add(self.user)
+        real_filter = Chat.objects.filter
+
+        def filter_chats(*args, **kwargs):
+            # Another worker loads the counters and counts a new message while these are rebuilt
+            self.redis.hset(unread.unread_key(self.user.pk), mapping={unread.LOADED_FIELD: 1, chat.pk: 6})
+            return real_filter(*args, **kwargs)
+
+        with mock.patch.object(Chat.objects, 'filter', side_effect=filter_chats):
+            self.assertEqual(unread.load_counts(self.user.pk), {chat.pk: 6})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@mock.patch('chat.membership.invalidate', mock.Mock())
+class ConversationPairTestCase(TestCase):
+    def setUp(self):
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.other_user = ChatsFixturesMixin.create_user('other')
+
+    def test_conversation_is_created_once_per_pair(self):
+        chat, created = ConversationPair.objects.get_or_create_chat(self.other_user.pk, self.user.pk)
+        self.assertTrue(created)
+        self.assertEqual(ConversationPair.objects.get_or_create_chat(self.user.pk, self.other_user.pk),
+                         (chat, False))
+
+    def test_concurrently_created_pair_is_returned(self):
+        chat, _ = ConversationPair.objects.get_or_create_chat(self.user.pk, self.other_user.pk)
+        get_chat = ConversationPair.objects.get_chat
+        # The concurrent creation is not visible yet on the first read
+        reads = [lambda user_id, other_user_id: None, get_chat]
+        with mock.patch.object(ConversationPair.objects, 'get_chat',
+                               side_effect=lambda *args: reads.pop(0)(*args)):
+            self.assertEqual(ConversationPair.objects.get_or_create_chat(self.other_user.pk, self.user.pk),
+                             (chat, False))
+        self.assertEqual(Chat.objects.filter(type='CONVERSATION').count(), 1)
+
+    def test_chatting_self_is_rejected(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(reverse('chat_conversation_create', kwargs={'oid': self.user.pk}),
+                               {'type': 'TEXT', 'content': 'hello'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'][0]['code'], 'chatting_self_not_permitted')
+        self.assertFalse(ConversationPair.objects.exists())
+
+
+class RecipientsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.client = fakeredis.FakeStrictRedis()
+        for patcher in (mock.patch('core.presence.get_connection', return_value=self.client),
+                        mock.patch('chat.membership.members', return_value=frozenset([1, 2, 3, 4, 5]))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(presence._local_connections.clear)
+        self.chat = mock.Mock(pk=7)
+
+    def test_recipients_groups_are_resolved_in_one_round_trip(self):
+        presence.connect(1, 'channel.1', presence.KIND_CHATS)
+        presence.connect(1, 'channel.2', presence.KIND_NOTIFICATIONS)
+        presence.connect(2, 'channel.3', presence.KIND_NOTIFICATIONS)
+        presence.connect(3, 'channel.4', presence.KIND_NOTIFICATIONS)
+        presence.connect(3, 'channel.5', presence.KIND_CHAT, self.chat.pk)
+        presence.connect(4, 'channel.6', presence.KIND_CHAT, 8)
+        with mock.patch.object(self.client, 'pipeline', wraps=self.client.pipeline) as pipeline:
+            chats_groups, notifications_groups = resolve_recipients_groups(self.chat, 1)
+        pipeline.assert_called_once()
+        self.assertEqual(chats_groups, ['user.1.chats'])
+        # Sender and member active at the chat are not notified, offline members are not either
+        self.assertEqual(notifications_groups, ['user.2.notifications'])
+
+
+class ChatDeltaTestCase(SimpleTestCase):
+    def setUp(self):
+        self.consumer = ChatsConsumer()
+        self.consumer.user = mock.Mock(pk=2)
+        self.consumer.queue_json = mock.Mock()
+        self.consumer.get_chat_json = mock.AsyncMock(return_value={'id': 7, 'unread_count': 0})
+
+    def test_delta_has_changed_chat_list_fields(self):
+        messaging = ChatMessaging(mock.Mock(), mock.Mock(pk=1), mock.Mock(pk=7))
+        latest_message = {'id': 3, 'content': 'hello', 'created_at': '2020-01-01T00:00:00Z'}
+        delta = messaging.build_chat_delta(latest_message, {'1': 0, '2': 4})
+        self.assertEqual(delta, {'id': 7, 'latest_message': latest_message, 'updated_at': '2020-01-01T00:00:00Z',
+                                 'last_activity_at': '2020-01-01T00:00:00Z', 'unread_counts': {'1': 0, '2': 4}})
+        self.assertNotIn('unread_counts', messaging.build_chat_delta(latest_message, None))
+
+    def test_delta_is_projected_per_user(self):
+        delta = {'id': 1, 'unread_counts': {'2': 3, '0': 1}}
+        self.assertEqual(project_chat_delta(self.consumer.user, delta), {'id': 1, 'unread_count': 3})
+        self.assertIn('unread_counts', delta)
+
+    def test_recipient_projects_delta_without_querying(self):
+        delta = {'id': 7, 'latest_message': {'id': 3}, 'unread_counts': {'1': 0, '2': 4}}
+        asyncio.run(self.consumer.chat_message({'chat_id': 7, 'chat': delta}))
+        self.consumer.get_chat_json.assert_not_awaited()
+        self.consumer.queue_json.assert_called_once_with(
+            {'id': 7, 'latest_message': {'id': 3}, 'unread_count': 4}, key=7, merge=mock.ANY)
+
+    def test_recipient_without_loaded_counters_fetches_chat(self):
+        delta = {'id': 7, 'latest_message': {'id': 3}, 'unread_counts': {'1': 0}}
+        asyncio.run(self.consumer.chat_message({'chat_id': 7, 'chat': delta}))
+        self.consumer.get_chat_json.assert_awaited_once_with(chat_id=7)
+        self.consumer.queue_json.assert_called_once_with({'id': 7, 'unread_count': 0}, key=7, merge=mock.ANY)
+
+    def test_event_without_delta_fetches_chat(self):
+        asyncio.run(self.consumer.chat_message({'chat_id': 7}))
+        self.consumer.get_chat_json.assert_awaited_once_with(chat_id=7)
+        self.consumer.queue_json.assert_called_once_with({'id': 7, 'unread_count': 0}, key=7, merge=mock.ANY)
+
+
+class ConsumerRepliesTestCase(SimpleTestCase):
+    def setUp(self):
+        self.messaging = mock.Mock(resume=mock.AsyncMock(return_value={'messages': []}),
+                                   mark_read=mock.AsyncMock(return_value={'seq': 3, 'unread_count': 0}),
+                                   send=mock.AsyncMock(side_effect=RateLimited(2)))
+
+    def receive(self, consumer, *contents):
+        consumer.send_json = mock.AsyncMock()
+        consumer.queue_json = mock.Mock()
+        for content in contents:
+            asyncio.run(consumer.receive_json(content))
+        consumer.send_json.assert_not_awaited()
+        return [call.args[0] for call in consumer.queue_json.call_args_list]
+
+    def test_chat_replies_are_queued(self):
+        consumer = ChatConsumer()
+        consumer.is_chat_member = True
+        consumer.messaging = self.messaging
+        frames = self.receive(consumer, {'action': 'resume'}, {'action': 'read'}, {'type': 'TEXT'})
+        self.assertEqual([frame['type'] for frame in frames], ['SYNC', 'READ', 'ERROR'])
+
+    def test_multiplex_replies_are_queued(self):
+        consumer = MultiplexConsumer()
+        consumer.subscriptions = {}
+        consumer.chats = {1: self.messaging}
+        frames = self.receive(consumer, {'action': 'resume', 'chat_id': 1}, {'action': 'read', 'chat_id': 1},
+                              {'action': 'message', 'chat_id': 1}, {'action': 'read', 'chat_id': 2})
+        self.assertEqual([frame.get('type') for frame in frames[:2]], ['SYNC', 'READ'])
+        self.assertEqual(frames[2]['retry_after'], 2)
+        self.assertEqual(frames[3]['error'], exceptions.unauthoraized_chat_access())
+
+
+class ChatMessagingRateLimitTestCase(SimpleTestCase):
+    @mock.patch('core.ratelimit.local_buckets', ratelimit.LocalBuckets())
+    @mock.patch('core.ratelimit.take', return_value=1.5)
+    def test_redis_rejection_refunds_local_tokens(self, take):
+        messaging = ChatMessaging(mock.Mock(), mock.Mock(pk=1), mock.Mock(pk=1))
+        buckets = [ratelimit.Bucket('user', 1, 2)]
+        with mock.patch('time.monotonic', return_value=100):
+            # Frames rejected by redis buckets don't empty the local bucket
+            for _ in range(3):
+                self.assertEqual(ratelimit.take_local(buckets, 2), 0)
+                with self.assertRaises(RateLimited):
+                    messaging.take_rate_tokens(buckets, 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@mock.patch('chat.membership.invalidate', mock.Mock())
+class ChatLastMessageTestCase(TestCase):
+    def setUp(self):
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.chats = [Chat.objects.create(type='ROOM') for _ in range(2)]
+
+    def save(self, chat, *contents):
+        messages = [Message(user=self.user, chat=chat, type='TEXT', content=content) for content in contents]
+        save_messages(messages)
+        return messages
+
+    def test_saved_messages_update_their_chats_at_once(self):
+        messages = [Message(user=self.user, chat=chat, type='TEXT', content=str(index))
+                    for index, chat in enumerate(self.chats * 2)]
+        with CaptureQueriesContext(connection) as queries:
+            save_messages(messages)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "chat_chat"')
+                   and 'last_message_id' in query['sql']]
+        self.assertEqual(len(updates), 2)
+        for chat, message in zip(self.chats, messages[2:]):
+            chat.refresh_from_db()
+            self.assertEqual(chat.last_message_id, message.pk)
+            self.assertEqual(chat.last_activity_at, message.created_at)
+
+    def test_older_message_does_not_replace_last_message(self):
+        older, newer = self.save(self.chats[0], 'older', 'newer')
+        Chat.update_last_messages([older])
+        self.chats[0].refresh_from_db()
+        self.assertEqual(self.chats[0].last_message_id, newer.pk)
+
+    def test_backfill_sets_latest_message_and_activity(self):
+        message = Message.objects.create(user=self.user, chat=self.chats[0], type='TEXT', content='hello')
+        call_command('backfill_chats_last_message', stdout=StringIO())
+        for chat in self.chats:
+            chat.refresh_from_db()
+        self.assertEqual(self.chats[0].last_message_id, message.pk)
+        self.assertEqual(self.chats[0].last_activity_at, message.created_at)
+        # Chats without messages are active since creation
+        self.assertIsNone(self.chats[1].last_message_id)
+        self.assertEqual(self.chats[1].last_activity_at, self.chats[1].created_at)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatMessagesCursorTestCase(PatchedMembershipMixin, TestCase):
+    def setUp(self):
+        super(ChatMessagesCursorTestCase, self).setUp()
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user)
+        self.messages = [Message.objects.create(user=self.user, chat=self.chat, type='TEXT', content=str(i))
+                         for i in range(7)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        membership.members.return_value = frozenset([self.user.pk])
+
+    def get_page(self, **params):
+        response = self.client.get(reverse('chat_message_list', kwargs={'pk': self.chat.pk}),
+                                   {'page_size': 3, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_before_pages_walk_back_history(self):
+        ids = []
+        page = self.get_page(before=self.messages[-1].pk)
+        while True:
+            ids += [message['id'] for message in page['results']]
+            if page['next'] is None:
+                break
+            page = self.get_page(before=page['next'])
+        self.assertEqual(ids, [message.pk for message in reversed(self.messages[:-1])])
+
+    def test_after_page_is_newest_first(self):
+        page = self.get_page(after=self.messages[1].pk)
+        self.assertEqual([message['id'] for message in page['results']],
+                         [message.pk for message in reversed(self.messages[2:5])])
+        self.assertEqual(page['previous'], self.messages[4].pk)
+
+    def test_disabled_anchor_keeps_paging(self):
+        Message.objects.filter(pk=self.messages[4].pk).update(is_disabled=True)
+        page = self.get_page(before=self.messages[4].pk)
+        self.assertEqual([message['id'] for message in page['results']],
+                         [message.pk for message in reversed(self.messages[1:4])])
+        page = self.get_page(after=self.messages[4].pk)
+        self.assertEqual([message['id'] for message in page['results']],
+                         [message.pk for message in reversed(self.messages[5:])])
+
+    def test_missing_anchor_is_invalid_cursor(self):
+        response = self.client.get(reverse('chat_message_list', kwargs={'pk': self.chat.pk}),
+                                   {'before': self.messages[-1].pk + 100})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['errors'][0]['code'], 'invalid_cursor')
+
+    def test_without_cursor_pages_are_numbered(self):
+        page = self.get_page()
+        self.assertEqual(page['next'], 2)
+        self.assertEqual(len(page['results']), 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatMessageSyncTestCase(PatchedMembershipMixin, TestCase):
+    def setUp(self):
+        super(ChatMessageSyncTestCase, self).setUp()
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user)
+        membership.members.return_value = frozenset([self.user.pk])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def save_messages(self, count):
+        save_messages([Message(user=self.user, chat=self.chat, type='TEXT', content=str(i)) for i in range(count)])
+
+    def test_sequences_are_consecutive_across_batches(self):
+        self.save_messages(3)
+        self.save_messages(2)
+        self.assertEqual(list(self.chat.messages.order_by('pk').values_list('seq', flat=True)), [1, 2, 3, 4, 5])
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_seq, 5)
+
+    def test_batch_unit_of_work_skips_rejected_submissions(self):
+        def reject():
+            raise ValidationError('Rejected.')
+
+        def build(content):
+            return [Message(user=self.user, chat=self.chat, type='TEXT', content=content)]
+
+        results = save_batch([
+            (build('a'), None, lambda saved: [message['seq'] for message in saved]),
+            (build('b'), reject, None),
+            (build('c'), lambda: None, None),
+        ])
+        self.assertEqual(results[0][1], [1])
+        self.assertIsInstance(results[1], ValidationError)
+        self.assertEqual([message['content'] for message in results[2][0]], ['c'])
+        self.assertEqual(list(self.chat.messages.order_by('seq').values_list('content', flat=True)), ['a', 'c'])
+
+    def test_failed_after_step_keeps_saved_messages(self):
+        def fail(saved):
+            raise ConnectionError('redis is down')
+
+        with self.assertLogs('chat.ingestion', 'ERROR'):
+            results = save_batch([([Message(user=self.user, chat=self.chat, type='TEXT', content='a')], None, fail)])
+        saved, fan_out = results[0]
+        self.assertEqual([message['seq'] for message in saved], [1])
+        self.assertIsNone(fan_out)
+
+    def test_backfill_keeps_existing_sequences(self):
+        old = [Message.objects.create(user=self.user, chat=self.chat, type='TEXT', content=str(i)) for i in range(2)]
+        self.save_messages(2)
+        call_command('backfill_messages_seq', stdout=StringIO())
+        self.assertEqual(list(self.chat.messages.order_by('pk').values_list('seq', flat=True)), [3, 4, 1, 2])
+        self.assertEqual([message.pk for message in old], list(
+            self.chat.messages.filter(seq__gt=2).order_by('seq').values_list('pk', flat=True)))
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_seq, 4)
+
+    def test_sync_returns_only_the_gap(self):
+        self.save_messages(5)
+        response = self.client.get(reverse('chat_message_sync', kwargs={'pk': self.chat.pk}),
+                                   {'since_seq': 2, 'limit': 2})
+        data = response.json()['data']
+        self.assertEqual([message['seq'] for message in data['messages']], [3, 4])
+        self.assertEqual(data['last_seq'], 5)
+        self.assertTrue(data['has_more'])
+
+    def test_sync_returns_disabled_messages_as_tombstones(self):
+        self.save_messages(3)
+        self.chat.messages.filter(seq=2).update(is_disabled=True)
+        response = self.client.get(reverse('chat_message_sync', kwargs={'pk': self.chat.pk}), {'since_seq': 0})
+        messages = response.json()['data']['messages']
+        self.assertEqual([message['seq'] for message in messages], [1, 2, 3])
+        self.assertEqual(messages[1], {'id': self.chat.messages.get(seq=2).pk, 'seq': 2, 'is_disabled': True})
+        self.assertEqual(messages[2]['content'], '2')
+
+    def test_sync_rejects_invalid_since_seq(self):
+        response = self.client.get(reverse('chat_message_sync', kwargs={'pk': self.chat.pk}), {'since_seq': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatMessageSearchTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch('chat.membership.invalidate')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.other = ChatsFixturesMixin.create_user('other')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user)
+        self.other_chat = Chat.objects.create(type='ROOM')
+        self.other_chat.users.add(self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get(reverse('chat_message_search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_search_is_scoped_to_user_chats_and_text_messages(self):
+        save_messages([
+            Message(user=self.user, chat=self.chat, type='TEXT', content='hello world'),
+            Message(user=self.user, chat=self.chat, type='IMAGE', content='hello.png'),
+            Message(user=self.user, chat=self.chat, type='TEXT', content='hello disabled', is_disabled=True),
+            Message(user=self.other, chat=self.other_chat, type='TEXT', content='hello there'),
+        ])
+        results = self.search(q='hello')['results']
+        self.assertEqual([message['content'] for message in results], ['hello world'])
+
+    def test_search_ranks_and_pages_by_keyset(self):
+        save_messages([Message(user=self.user, chat=self.chat, type='TEXT', content=content) for content in (
+            'apple', 'apple pie', 'banana', 'apple apple apple', 'apple tart', 'red apple')])
+        expected = [message['id'] for message in self.search(q='apple', page_size=50)['results']]
+        self.assertEqual(len(expected), 5)
+        self.assertEqual(Message.objects.get(pk=expected[0]).content, 'apple apple apple')
+        ids = []
+        cursor = None
+        while True:
+            data = self.search(q='apple', page_size=2, **({'cursor': cursor} if cursor else {}))
+            ids += [message['id'] for message in data['results']]
+            cursor = data['next']
+            if cursor is None:
+                break
+        self.assertEqual(ids, expected)
+
+    def test_search_index_follows_updates_and_query_syntax_is_literal(self):
+        message = Message.objects.create(user=self.user, chat=self.chat, type='TEXT', content='draft')
+        message.content = 'final "quoted" AND (text)'
+        message.save()
+        self.assertEqual(self.search(q='draft')['results'], [])
+        self.assertEqual(len(self.search(q='"quoted" AND (text')['results']), 1)
+
+    def test_rebuild_command_indexes_existing_messages(self):
+        Message.objects.create(user=self.user, chat=self.chat, type='TEXT', content='before index')
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {search.SQLiteFTS5Backend.table}({search.SQLiteFTS5Backend.table}) "
+                           f"VALUES ('delete-all')")
+        self.assertEqual(self.search(q='index')['results'], [])
+        call_command('rebuild_messages_search', stdout=StringIO())
+        self.assertEqual(len(self.search(q='index')['results']), 1)
+
+    def test_too_short_query_is_rejected(self):
+        response = self.client.get(reverse('chat_message_search'), {'q': ' a '})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors'][0]['code'], 'q_min_length')
+
+    def test_search_in_chat_requires_membership(self):
+        with mock.patch('chat.membership.members', return_value=frozenset([self.other.pk])):
+            response = self.client.get(reverse('chat_message_search'), {'q': 'hello', 'chat': self.other_chat.pk})
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatMessageExportTestCase(PatchedMembershipMixin, TestCase):
+    def setUp(self):
+        super(ChatMessageExportTestCase, self).setUp()
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user)
+        membership.members.return_value = frozenset([self.user.pk])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.messages = [Message.objects.create(user=self.user, chat=self.chat, type='TEXT', content=f'message {i}',
+                                                created_at=datetime(2022, 1, i + 1, tzinfo=timezone.utc))
+                         for i in range(5)]
+
+    @staticmethod
+    def read_lines(data):
+        return [json.loads(line) for line in gzip.decompress(data).splitlines()]
+
+    def export(self, **params):
+        response = self.client.get(reverse('chat_message_export', kwargs={'pk': self.chat.pk}), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return self.read_lines(b''.join(response.streaming_content))
+
+    def test_export_streams_all_messages(self):
+        lines = self.export()
+        self.assertEqual([line['id'] for line in lines], [message.pk for message in self.messages])
+        self.assertEqual(lines[0]['content'], 'message 0')
+        self.assertEqual(lines[0]['created_at'], '2022-01-01T00:00:00Z')
+
+    def test_export_chunks_concatenate_to_one_gzip_stream(self):
+        chunks = list(export.iter_export(export.get_export_queryset(self.chat.pk), chunk_size=2))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(len(self.read_lines(b''.join(chunks))), len(self.messages))
+
+    def test_export_date_range_and_resume(self):
+        lines = self.export(since='2022-01-02T00:00:00Z', until='2022-01-05T00:00:00Z',
+                            after_id=self.messages[1].pk)
+        self.assertEqual([line['id'] for line in lines], [message.pk for message in self.messages[2:4]])
+
+    def test_export_rejects_invalid_params(self):
+        response = self.client.get(reverse('chat_message_export', kwargs={'pk': self.chat.pk}), {'since': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_command_writes_gzip_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.ndjson.gz')
+            call_command('export_chat', self.chat.pk, output=path, after_id=self.messages[2].pk, stdout=StringIO())
+            with open(path, 'rb') as file:
+                lines = self.read_lines(file.read())
+        self.assertEqual([line['id'] for line in lines], [message.pk for message in self.messages[3:]])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MessageArchiveTestCase(PatchedMembershipMixin, TestCase):
+    def setUp(self):
+        super(MessageArchiveTestCase, self).setUp()
+        archive._segments.clear()
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user)
+        membership.members.return_value = frozenset([self.user.pk])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.messages = [Message(user=self.user, chat=self.chat, type='TEXT', content=f'message {i}',
+                                 created_at=datetime(2020, 1, i + 1, tzinfo=timezone.utc)) for i in range(7)]
+        self.messages[2].is_disabled = True
+        save_messages(self.messages)
+        self.visible = [message for message in self.messages if not message.is_disabled]
+        # 3 segments of 2 messages, last message stays hot
+        call_command('archive_messages', segment_size=2, stdout=StringIO())
+
+    def get_ids(self, name, **params):
+        response = self.client.get(reverse(name, kwargs={'pk': self.chat.pk}), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_cold_messages_are_moved_to_segments(self):
+        self.assertEqual(list(self.chat.messages.values_list('pk', flat=True)), [self.messages[-1].pk])
+        self.assertEqual(self.chat.archive_segments.count(), 3)
+        self.assertEqual(archive.MessageArchive(self.chat.pk).count(), 5)
+        call_command('archive_messages', segment_size=2, stdout=StringIO())
+        self.assertEqual(self.chat.archive_segments.count(), 3)
+
+    def test_history_pages_fall_through_to_archive(self):
+        ids = []
+        page = self.get_ids('chat_message_list', page_size=2, before=self.messages[-1].pk)
+        while True:
+            ids += [message['id'] for message in page['results']]
+            if page['next'] is None:
+                break
+            page = self.get_ids('chat_message_list', page_size=2, before=page['next'])
+        self.assertEqual(ids, [message.pk for message in reversed(self.visible[:-1])])
+        page = self.get_ids('chat_message_list', page_size=2, after=self.messages[3].pk)
+        self.assertEqual([message['id'] for message in page['results']],
+                         [self.messages[5].pk, self.messages[4].pk])
+        page = self.get_ids('chat_message_list', page_size=4, after=self.messages[4].pk)
+        self.assertEqual([message['id'] for message in page['results']],
+                         [self.messages[6].pk, self.messages[5].pk])
+        page = self.get_ids('chat_message_list', page_size=4, page=2)
+        self.assertEqual([message['id'] for message in page['results']], [self.messages[1].pk, self.messages[0].pk])
+        self.assertEqual(page['results'][0]['content'], 'message 1')
+
+    def test_sync_and_export_read_archived_messages(self):
+        data = self.get_ids('chat_message_sync', since_seq=1, limit=3)
+        # Disabled archived message is a tombstone
+        self.assertEqual([message['seq'] for message in data['messages']], [2, 3, 4])
+        self.assertEqual([message.get('is_disabled', False) for message in data['messages']], [False, True, False])
+        self.assertTrue(data['has_more'])
+        lines = ChatMessageExportTestCase.read_lines(b''.join(export.iter_export(export.get_export_rows(
+            self.chat.pk, after_id=self.messages[0].pk))))
+        self.assertEqual([line['id'] for line in lines], [message.pk for message in self.visible[1:]])
+        self.assertEqual(lines[0]['created_at'], '2020-01-02T00:00:00Z')
+
+
+class ChatActivityTestCase(SimpleTestCase):
+    def test_activities_of_a_chat_are_coalesced_per_interval(self):
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        coalescer = activity.ActivityCoalescer(interval=0.05, repeat_interval=10)
+
+        async def run():
+            self.assertTrue(coalescer.submit(channel_layer, 1, 10, activity.ACTIVITY_TYPING))
+            await asyncio.sleep(0)
+            # Gathered within the interval, repeated activity is dropped
+            coalescer.submit(channel_layer, 1, 11, activity.ACTIVITY_TYPING)
+            coalescer.submit(channel_layer, 1, 12, activity.ACTIVITY_RECORDING)
+            self.assertFalse(coalescer.submit(channel_layer, 1, 10, activity.ACTIVITY_TYPING))
+            coalescer.submit(channel_layer, 1, 11, activity.ACTIVITY_STOPPED)
+            self.assertFalse(coalescer.submit(channel_layer, 1, 13, activity.ACTIVITY_STOPPED))
+            await asyncio.sleep(0.2)
+
+        asyncio.run(run())
+        events = [call.args[1]['activities'] for call in channel_layer.group_send.call_args_list]
+        self.assertEqual(events, [{'10': 'TYPING'}, {'11': 'STOPPED', '12': 'RECORDING'}])
+        self.assertEqual(coalescer.flush_tasks, {})
+
+    def test_invalid_activity_is_rejected(self):
+        with self.assertRaises(ValidationError):
+            activity.parse_activity('DANCING')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatMembershipTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch('chat.membership.get_connection', return_value=fakeredis.FakeStrictRedis())
+        self.redis = patcher.start()()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(membership._local.clear)
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.other = ChatsFixturesMixin.create_user('other')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user)
+
+    def test_membership_changes_are_seen(self):
+        self.assertEqual(membership.members(self.chat.pk), {self.user.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.users.add(self.other)
+        self.assertEqual(membership.members(self.chat.pk), {self.user.pk, self.other.pk})
+        self.assertTrue(membership.is_member(self.chat.pk, self.other.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.other.chats.remove(self.chat)
+        self.assertEqual(membership.members(self.chat.pk), {self.user.pk})
+        self.assertIsNone(membership.members(self.chat.pk + 1))
+
+    def test_load_racing_a_removal_is_not_cached(self):
+        stale = frozenset([self.user.pk, self.other.pk])
+
+        def query_members(chat_id):
+            # Removal is committed while members are loaded
+            membership.invalidate([chat_id])
+            return stale
+
+        with mock.patch('chat.membership._query_members', query_members):
+            self.assertEqual(membership.members(self.chat.pk), stale)
+        self.assertFalse(self.redis.exists(membership.members_key(self.chat.pk)))
+        self.assertEqual(membership.members(self.chat.pk), {self.user.pk})
+
+    def test_loaded_set_replaces_cached_set(self):
+        # Removed member left by an older load
+        self.redis.sadd(membership.members_key(self.chat.pk), self.other.pk)
+        membership._load_members(self.chat.pk)
+        self.assertEqual(self.redis.smembers(membership.members_key(self.chat.pk)),
+                         {str(membership.LOADED_MARKER).encode(), str(self.user.pk).encode()})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ChatMessagingSendTestCase(TransactionTestCase):
+    def setUp(self):
+        for patcher in (mock.patch('chat.membership.invalidate'), mock.patch('core.ratelimit.take', return_value=0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user)
+
+    @mock.patch('chat.messaging.group_send_many', new_callable=mock.AsyncMock)
+    @mock.patch('chat.unread.add_messages', side_effect=ConnectionError('redis is down'))
+    def test_send_falls_back_to_degraded_fan_out(self, add_messages, group_send_many):
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        messaging = ChatMessaging(channel_layer, self.user, self.chat)
+        with self.assertLogs('chat.ingestion', 'ERROR'):
+            messages = async_to_sync(messaging.send)({'type': 'TEXT', 'content': 'a'})
+        # Saved message is broadcast to the chat and to chats lists of all members
+        self.assertEqual(messages[0]['content'], 'a')
+        channel_layer.group_send.assert_awaited_once()
+        groups, content = group_send_many.await_args.args[1:]
+        self.assertEqual(groups, [self.user.chats_group])
+        self.assertNotIn('unread_counts', content['chat'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES,
+                   CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class MultiplexConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        redis = fakeredis.FakeStrictRedis()
+        for module in ('core.presence', 'chat.membership', 'chat.unread', 'core.ratelimit'):
+            patcher = mock.patch(f'{module}.get_connection', return_value=redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(membership._local.clear)
+        self.user = ChatsFixturesMixin.create_user('owner')
+        self.other = ChatsFixturesMixin.create_user('other')
+        self.chat = Chat.objects.create(type='ROOM')
+        self.chat.users.add(self.user, self.other)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(chat_ws_urlpatterns), '/ws/stream/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def subscribe(self, communicator, chat_id, action='subscribe'):
+        await communicator.send_json_to({'action': action, 'stream': 'chat', 'chat_id': chat_id})
+
+    async def test_subscribed_chats_messages_are_routed(self):
+        owner, other = await self.connect(self.user), await self.connect(self.other)
+        await self.subscribe(owner, self.chat.pk)
+        await self.subscribe(other, self.chat.pk)
+        self.assertTrue(await other.receive_nothing())
+        await owner.send_json_to({'action': 'message', 'chat_id': self.chat.pk,
+                                  'message': {'type': 'TEXT', 'content': 'hello'}})
+        for communicator in (owner, other):
+            frame = await communicator.receive_json_from()
+            self.assertEqual((frame['stream'], frame['chat_id'], frame['data']['content']),
+                             ('chat', self.chat.pk, 'hello'))
+        await owner.disconnect()
+        await other.disconnect()
+
+    async def test_unsubscribed_chat_gets_no_messages(self):
+        owner, other = await self.connect(self.user), await self.connect(self.other)
+        await self.subscribe(owner, self.chat.pk)
+        await self.subscribe(other, self.chat.pk)
+        await self.subscribe(other, self.chat.pk, 'unsubscribe')
+        self.assertTrue(await other.receive_nothing())
+        await owner.send_json_to({'action': 'message', 'chat_id': self.chat.pk,
+                                  'message': {'type': 'TEXT', 'content': 'hello'}})
+        await owner.receive_json_from()
+        self.assertTrue(await other.receive_nothing())
+        # Sending requires a subscription
+        await other.send_json_to({'action': 'message', 'chat_id': self.chat.pk,
+                                  'message': {'type': 'TEXT', 'content': 'hello'}})
+        self.assertEqual(await other.receive_json_from(),
+                         {'stream': 'chat', 'chat_id': self.chat.pk, 'error': exceptions.unauthoraized_chat_access()})
+        await owner.disconnect()
+        await other.disconnect()
+
+    async def test_non_member_is_rejected(self):
+        chat = await database_sync_to_async(Chat.objects.create)(type='ROOM')
+        owner = await self.connect(self.user)
+        await self.subscribe(owner, chat.pk)
+        self.assertEqual(await owner.receive_json_from(),
+                         {'stream': 'chat', 'chat_id': chat.pk, 'error': exceptions.unauthoraized_chat_access()})
+        await owner.disconnect()
+
+    async def test_unknown_chat_is_rejected(self):
+        owner = await self.connect(self.user)
+        await self.subscribe(owner, self.chat.pk + 100)
+        self.assertEqual(await owner.receive_json_from(),
+                         {'stream': 'chat', 'chat_id': self.chat.pk + 100, 'error': exceptions.chat_not_found()})
+        # Cached membership of a deleted chat
+        with mock.patch('chat.membership.members', return_value=frozenset([self.user.pk])):
+            await self.subscribe(owner, self.chat.pk + 101)
+            self.assertEqual(await owner.receive_json_from(),
+                             {'stream': 'chat', 'chat_id': self.chat.pk + 101, 'error': exceptions.chat_not_found()})
+        await owner.disconnect()
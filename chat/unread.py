@@ -0,0 +1,247 @@
+import asyncio
+import logging
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django_redis import get_redis_connection
+from core.exceptions import ValidationException
+from .models import Chat, ChatReadMarker
+
+"""
+    Unread counters and read markers.
+    Every user has redis hashes `unread:user:<user_id>` (chat id => unread messages count) and `read:user:<user_id>`
+    (chat id => latest read message `seq`). Counters are incremented while new messages are fanned out and reset by
+    marking the chat read, so chats lists read them with one `HMGET` instead of counting messages.
+    Changed markers are queued in `read:dirty` set and persisted to `ChatReadMarker` in batches, counters of a user
+    are rebuilt from markers and chats `last_seq` when its hash isn't loaded (e.g. redis restart), and only loaded
+    counters are incremented, so a partial counter never hides the rebuilt one.
+"""
+
+UNREAD_FLUSH_INTERVAL = getattr(settings, 'UNREAD_FLUSH_INTERVAL', 10)
+UNREAD_FLUSH_BATCH_SIZE = getattr(settings, 'UNREAD_FLUSH_BATCH_SIZE', 500)
+
+DIRTY_KEY = 'read:dirty'
+
+# Hash field that marks loaded counters, as missing chat fields mean 0 (Chat ids start from 1)
+LOADED_FIELD = 0
+
+logger = logging.getLogger(__name__)
+
+# Moves marker forward only, ARGV => [chat id, seq, unread count, dirty member]
+# KEYS => [read markers hash, unread counters hash, dirty set], @return [read seq, unread count]
+MARK_READ_LUA = """
+    local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+    if tonumber(ARGV[2]) < current then
+        return {current, tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')}
+    end
+    if tonumber(ARGV[2]) > current then
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        redis.call('SADD', KEYS[3], ARGV[4])
+    end
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+    return {tonumber(ARGV[2]), tonumber(ARGV[3])}
+"""
+
+# Increments loaded counters only, ARGV => [loaded field, chat id, count]
+# KEYS => [unread counters hashes], @return counts in KEYS order, nil for counters that aren't loaded
+ADD_MESSAGES_LUA = """
+    local counts = {}
+    for i=1,#KEYS do
+        if redis.call('HEXISTS', KEYS[i], ARGV[1]) == 1 then
+            counts[i] = redis.call('HINCRBY', KEYS[i], ARGV[2], ARGV[3])
+        else
+            counts[i] = false
+        end
+    end
+    return counts
+"""
+
+# Writes rebuilt counters unless loaded meanwhile, ARGV => [loaded field, chat id, count, ...]
+# KEYS => [unread counters hash], @return stored counts in ARGV order
+LOAD_COUNTS_LUA = """
+    if redis.call('HSETNX', KEYS[1], ARGV[1], 1) == 1 then
+        for i=2,#ARGV,2 do
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+    local counts = {}
+    for i=2,#ARGV,2 do
+        counts[#counts + 1] = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0')
+    end
+    return counts
+"""
+
+
+def unread_key(user_id):
+    return f'unread:user:{user_id}'
+
+
+def read_key(user_id):
+    return f'read:user:{user_id}'
+
+
+def dirty_member(user_id, chat_id):
+    return f'{user_id}:{chat_id}'
+
+
+def get_connection():
+    return get_redis_connection('default')
+
+
+def parse_seq(value):
+    """
+        @return read `seq` or None for the latest message.
+    """
+    if value is None:
+        return None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        raise ValidationException('invalid', 'seq', 'A valid integer is required.')
+    if seq < 0:
+        raise ValidationException('invalid', 'seq', 'Ensure this value is greater than or equal to 0.')
+    return seq
+
+
+def _mark_read(client, user_id, chat_id, seq, unread_count):
+    return client.eval(MARK_READ_LUA, 3, read_key(user_id), unread_key(user_id), DIRTY_KEY,
+                       chat_id, seq, unread_count, dirty_member(user_id, chat_id))
+
+
+def add_messages(chat_id, members_ids, sender_id, last_seq, count):
+    """
+        Counts `count` new messages of the chat as unread by its members, the sender has read up to them.
+        Counters of members that aren't loaded are left as they are, loading them counts the messages.
+        @return dict of member id (str, channel layers serialize events by msgpack) => unread count, members with
+                counters that aren't loaded are left out.
+    """
+    pipe = get_connection().pipeline(transaction=False)
+    members_ids = [pk for pk in members_ids if pk != sender_id]
+    pipe.eval(ADD_MESSAGES_LUA, len(members_ids), *[unread_key(pk) for pk in members_ids], LOADED_FIELD, chat_id,
+              count)
+    _mark_read(pipe, sender_id, chat_id, last_seq, 0)
+    counts, (_, sender_count) = pipe.execute()
+    unread_counts = {str(pk): unread_count for pk, unread_count in zip(members_ids, counts) if unread_count is not None}
+    unread_counts[str(sender_id)] = sender_count
+    return unread_counts
+
+
+def mark_read(user_id, chat_id, seq=None):
+    """
+        @param seq: latest read message `seq`, the latest message of the chat by default.
+        @return (read seq, unread count), read marker never moves backwards.
+    """
+    last_seq = Chat.objects.filter(pk=chat_id).values_list('last_seq', flat=True).get()
+    seq = last_seq if seq is None else min(seq, last_seq)
+    return tuple(_mark_read(get_connection(), user_id, chat_id, seq, last_seq - seq))
+
+
+def load_counts(user_id):
+    """
+        Rebuilds unread counters of the user from read markers (unflushed redis ones first) and chats `last_seq`,
+        counters loaded meanwhile (by another worker) are kept.
+        @return dict of chat id => unread count
+    """
+    connection = get_connection()
+    markers = dict(ChatReadMarker.objects.filter(user_id=user_id).values_list('chat_id', 'last_read_seq'))
+    markers.update({int(chat_id): int(seq) for chat_id, seq in connection.hgetall(read_key(user_id)).items()})
+    counts = {chat_id: max(last_seq - markers.get(chat_id, 0), 0)
+              for chat_id, last_seq in Chat.objects.filter(users=user_id).values_list('pk', 'last_seq')}
+    args = [value for item in counts.items() for value in item]
+    stored = connection.eval(LOAD_COUNTS_LUA, 1, unread_key(user_id), LOADED_FIELD, *args)
+    return dict(zip(counts, stored))
+
+
+def get_counts(user_id, chat_ids):
+    """
+        @return dict of chat id => unread count, with one `HMGET`.
+    """
+    chat_ids = list(chat_ids)
+    values = get_connection().hmget(unread_key(user_id), LOADED_FIELD, *chat_ids)
+    if values[0] is None:
+        counts = load_counts(user_id)
+        return {chat_id: counts.get(chat_id, 0) for chat_id in chat_ids}
+    return {chat_id: int(value or 0) for chat_id, value in zip(chat_ids, values[1:])}
+
+
+def prefetch_counts(user_id, chats):
+    """
+        Attaches unread count of the user to chats (`prefetched_unread_count`).
+    """
+    chats = [chat for chat in chats if not hasattr(chat, 'prefetched_unread_count')]
+    if not chats:
+        return
+    counts = get_counts(user_id, [chat.pk for chat in chats])
+    for chat in chats:
+        chat.prefetched_unread_count = counts[chat.pk]
+
+
+def get_count(user_id, chat):
+    if not hasattr(chat, 'prefetched_unread_count'):
+        prefetch_counts(user_id, [chat])
+    return chat.prefetched_unread_count
+
+
+def flush_markers(batch_size=UNREAD_FLUSH_BATCH_SIZE):
+    """
+        Persists one batch of changed read markers.
+        @return number of flushed markers
+    """
+    connection = get_connection()
+    members = connection.spop(DIRTY_KEY, batch_size)
+    if not members:
+        return 0
+    pairs = [tuple(int(pk) for pk in member.decode().split(':')) for member in members]
+    pipe = connection.pipeline(transaction=False)
+    for user_id, chat_id in pairs:
+        pipe.hget(read_key(user_id), chat_id)
+    markers = {pair: int(seq) for pair, seq in zip(pairs, pipe.execute()) if seq is not None}
+    existing = ChatReadMarker.objects.filter(
+        Q(user_id__in={user_id for user_id, _ in markers}) & Q(chat_id__in={chat_id for _, chat_id in markers}))
+    updated = []
+    now = timezone.now()
+    for marker in existing:
+        seq = markers.pop((marker.user_id, marker.chat_id), None)
+        if seq is not None and seq != marker.last_read_seq:
+            marker.last_read_seq = seq
+            marker.updated_at = now
+            updated.append(marker)
+    ChatReadMarker.objects.bulk_update(updated, ['last_read_seq', 'updated_at'], batch_size=batch_size)
+    # Markers of deleted chats are dropped, concurrently created ones are kept
+    chat_ids = set(Chat.objects.filter(pk__in={chat_id for _, chat_id in markers}).values_list('pk', flat=True))
+    ChatReadMarker.objects.bulk_create([
+        ChatReadMarker(user_id=user_id, chat_id=chat_id, last_read_seq=seq)
+        for (user_id, chat_id), seq in markers.items() if chat_id in chat_ids
+    ], batch_size=batch_size, ignore_conflicts=True)
+    return len(members)
+
+
+def flush_all_markers(batch_size=UNREAD_FLUSH_BATCH_SIZE):
+    total = 0
+    while True:
+        count = flush_markers(batch_size)
+        total += count
+        if count < batch_size:
+            return total
+
+
+_markers_flusher = None
+
+
+async def _flush_markers_periodically():
+    while True:
+        await asyncio.sleep(UNREAD_FLUSH_INTERVAL)
+        try:
+            await database_sync_to_async(flush_all_markers)()
+        except Exception:
+            logger.exception('Flushing read markers failed')
+
+
+def ensure_markers_flusher():
+    """
+        Starts (once per worker) the background task that persists read markers, must be called from event loop.
+    """
+    global _markers_flusher
+    if _markers_flusher is None or _markers_flusher.done():
+        _markers_flusher = asyncio.ensure_future(_flush_markers_periodically())
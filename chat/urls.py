@@ -5,5 +5,9 @@ urlpatterns = [
     path('list/', views.ChatListApiView.as_view(), name='chat_list'),
     path('detail/', views.ChatDetailAPIView.as_view(), name='chat_item'),
     path('create/<oid>/', views.ChatConversationCreateAPIView.as_view(), name='chat_conversation_create'),
+    path('search/', views.ChatMessageSearchApiView.as_view(), name='chat_message_search'),
     path('<pk>/', views.ChatMessageListApiView.as_view(), name='chat_message_list'),
+    path('<pk>/sync/', views.ChatMessageSyncApiView.as_view(), name='chat_message_sync'),
+    path('<pk>/read/', views.ChatMarkReadApiView.as_view(), name='chat_mark_read'),
+    path('<pk>/export/', views.ChatMessageExportApiView.as_view(), name='chat_message_export'),
 ]
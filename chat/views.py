@@ -8,22 +8,32 @@ from . import exceptions
 from authentication.exceptions import AuthProfileNotFoundException
 from .permissions import IsChatMember, PermissionCode
 from core.permissions import HasProfile
-from .models import Chat
+from .models import Chat, Message, ConversationPair
 from authentication.models import User
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
 from core.exceptions import validation_exceptions
+from core.pagination import ChatsCursorPagination, RankedKeysetPagination
+from .pagination import ChatMessagesPagination
+from .ingestion import save_messages
+from . import sync
+from . import membership
+from . import unread
+from .search import MessageSearch, parse_query
+from django.http import StreamingHttpResponse
+from . import export
 
 
 class ChatListApiView(ListAPIView):
     serializer_class = ChatSerializer
     renderer_classes = (StandardRenderer,)
     permission_classes = (permissions.IsAuthenticated, HasProfile)
-    pagination_class = None
+    pagination_class = ChatsCursorPagination
 
     def get_queryset(self):
-        return self.request.user.chats.all().order_by('updated_at')
+        # Ordered by pagination => latest activity first
+        return self.request.user.chats.with_users()
 
     def permission_denied(self, request, message=None, code=None):
         try:
@@ -41,9 +51,10 @@ class ChatMessageListApiView(ListAPIView):
     serializer_class = MessageSerializer
     renderer_classes = (StandardRenderer,)
     permission_classes = [permissions.IsAuthenticated, IsChatMember, HasProfile]
+    pagination_class = ChatMessagesPagination
 
     def get_queryset(self):
-        return self.chat.messages.filter(is_disabled=False).order_by('-created_at')
+        return Message.objects.filter(chat_id=self.chat_id, is_disabled=False).order_by('-created_at')
 
     def permission_denied(self, request, message=None, code=None):
         try:
@@ -71,6 +82,136 @@ class ChatMessageListApiView(ListAPIView):
     #     return super(ChatMessageListApiView, self).handle_exception(exc)
 
 
+class ChatMessageSyncApiView(GenericAPIView):
+    renderer_classes = (StandardRenderer,)
+    permission_classes = [permissions.IsAuthenticated, IsChatMember, HasProfile]
+
+    """
+        @param since_seq: latest message sequence number the client has.
+    """
+
+    def get(self, request, pk):
+        since_seq = sync.parse_since_seq(request.GET.get('since_seq'))
+        limit = sync.parse_limit(request.GET.get('limit'))
+        return Response(sync.get_messages_since(self.chat_id, since_seq, limit), status=status.HTTP_200_OK)
+
+    def permission_denied(self, request, message=None, code=None):
+        try:
+            super(ChatMessageSyncApiView, self).permission_denied(request, message, code)
+        except NotAuthenticated:
+            raise NotAuthenticatedRequest()
+        except Exception as error:
+            if code == PermissionCode.NO_CHAT_WITH_ID:
+                raise exceptions.NoChatWithId()
+            elif code == PermissionCode.NOT_CHAT_MEMBER:
+                raise exceptions.NotChatMember()
+            elif code == HasProfile.code:
+                raise AuthProfileNotFoundException()
+            else:
+                raise error
+
+
+class ChatMessageExportApiView(GenericAPIView):
+    renderer_classes = (StandardRenderer,)
+    permission_classes = [permissions.IsAuthenticated, IsChatMember, HasProfile]
+
+    """
+        Streams whole chat as gzip compressed NDJSON (see `chat.export`), ASGI deployments are served by
+        `chat.consumers.ChatExportConsumer` instead.
+        @param since: optional ISO 8601 datetime, messages created at or after it.
+        @param until: optional ISO 8601 datetime, messages created before it.
+        @param after_id: optional id of the last message received, to resume interrupted export.
+    """
+
+    def get(self, request, pk):
+        rows = export.get_export_rows(self.chat_id, **export.parse_export_params(request.GET))
+        response = StreamingHttpResponse(export.iter_export(rows), content_type=export.EXPORT_CONTENT_TYPE)
+        response['Content-Disposition'] = f'attachment; filename="{export.export_filename(self.chat_id)}"'
+        return response
+
+    def permission_denied(self, request, message=None, code=None):
+        try:
+            super(ChatMessageExportApiView, self).permission_denied(request, message, code)
+        except NotAuthenticated:
+            raise NotAuthenticatedRequest()
+        except Exception as error:
+            if code == PermissionCode.NO_CHAT_WITH_ID:
+                raise exceptions.NoChatWithId()
+            elif code == PermissionCode.NOT_CHAT_MEMBER:
+                raise exceptions.NotChatMember()
+            elif code == HasProfile.code:
+                raise AuthProfileNotFoundException()
+            else:
+                raise error
+
+
+class ChatMarkReadApiView(GenericAPIView):
+    renderer_classes = (StandardRenderer,)
+    permission_classes = [permissions.IsAuthenticated, IsChatMember, HasProfile]
+
+    """
+        Moves read marker of the user in the chat forward and resets its unread count.
+        @param seq: optional latest read message sequence number, the latest message of the chat by default.
+    """
+
+    def post(self, request, pk):
+        seq, unread_count = unread.mark_read(request.user.pk, self.chat_id, unread.parse_seq(request.data.get('seq')))
+        return Response({'chat_id': self.chat_id, 'last_read_seq': seq, 'unread_count': unread_count},
+                        status=status.HTTP_200_OK)
+
+    def permission_denied(self, request, message=None, code=None):
+        try:
+            super(ChatMarkReadApiView, self).permission_denied(request, message, code)
+        except NotAuthenticated:
+            raise NotAuthenticatedRequest()
+        except Exception as error:
+            if code == PermissionCode.NO_CHAT_WITH_ID:
+                raise exceptions.NoChatWithId()
+            elif code == PermissionCode.NOT_CHAT_MEMBER:
+                raise exceptions.NotChatMember()
+            elif code == HasProfile.code:
+                raise AuthProfileNotFoundException()
+            else:
+                raise error
+
+
+class ChatMessageSearchApiView(ListAPIView):
+    serializer_class = MessageSerializer
+    renderer_classes = (StandardRenderer,)
+    permission_classes = (permissions.IsAuthenticated, HasProfile)
+    pagination_class = RankedKeysetPagination
+
+    """
+        @param q: search terms, messages containing all of them are matched.
+        @param chat: optional chat id to search in, otherwise all chats of the user are searched.
+    """
+
+    def get_queryset(self):
+        query = parse_query(self.request.GET.get('q'))
+        chat_id = self.request.GET.get('chat')
+        if chat_id is not None:
+            if not chat_id.isnumeric():
+                raise exceptions.NoChatWithId()
+            members_ids = membership.members(chat_id)
+            if members_ids is None:
+                raise exceptions.NoChatWithId()
+            if self.request.user.pk not in members_ids:
+                raise exceptions.NotChatMember()
+            chat_id = int(chat_id)
+        return MessageSearch(query, self.request.user.pk, chat_id)
+
+    def permission_denied(self, request, message=None, code=None):
+        try:
+            super(ChatMessageSearchApiView, self).permission_denied(request, message, code)
+        except NotAuthenticated:
+            raise NotAuthenticatedRequest()
+        except Exception as error:
+            if code == HasProfile.code:
+                raise AuthProfileNotFoundException()
+            else:
+                raise error
+
+
 class ChatDetailAPIView(GenericAPIView):
     renderer_classes = [StandardRenderer]
     permission_classes = (permissions.IsAuthenticated, HasProfile)
@@ -90,21 +231,9 @@ class ChatDetailAPIView(GenericAPIView):
         else:
             if int(uid) == user.pk:
                 raise exceptions.ChattingSelfNotPermitted()
-            try:
-                other_user = User.objects.get(pk=uid)
-            except User.DoesNotExist:
+            if not User.objects.filter(pk=uid).exists():
                 raise exceptions.NoChatUserWithId()
-            chats = user.chats.filter(type='CONVERSATION')
-            if not chats.exists():
-                raise exceptions.NoChatMatched()
-            chat = None
-            """
-                Not the correct way but i am gonna handle it later
-            """
-            for item in chats:
-                if other_user in item.users.all():
-                    chat = item
-                    break
+            chat = ConversationPair.objects.get_chat(user.pk, int(uid))
             if not chat:
                 raise exceptions.NoChatMatched()
         serializer = self.serializer_class(chat)
@@ -132,7 +261,6 @@ class ChatConversationCreateAPIView(GenericAPIView):
         @param oid: Other User Id
     """
 
-    # FIXME: check if chat already exists! Not implemented yet
     def post(self, request, oid):
         user = request.user
         if user.pk == int(oid):
@@ -146,9 +274,12 @@ class ChatConversationCreateAPIView(GenericAPIView):
             serializer.is_valid(raise_exception=True)
         except ValidationError as exception:
             raise validation_exceptions(exception)
-        chat = user.chats.create(type='CONVERSATION')
-        chat.users.add(other_user)
-        serializer.save(user=user, chat=chat)
+        chat, _ = ConversationPair.objects.get_or_create_chat(user.pk, other_user.pk)
+        message = Message(user=user, chat=chat, **serializer.validated_data)
+        save_messages([message])
+        unread.add_messages(chat.pk, membership.members(chat.pk) or (), user.pk, message.seq, 1)
+        chat.last_message = message
+        chat.last_activity_at = message.created_at
         chat_serializer = ChatSerializer(instance=chat)
         chat_serializer.uid = user.pk
         return Response(chat_serializer.data, status=status.HTTP_200_OK)
@@ -11,14 +11,18 @@ import os
 
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
-from chat.routing import chat_ws_urlpatterns
+from django.urls import re_path
+from chat.routing import chat_ws_urlpatterns, chat_http_urlpatterns
 from notification.routing import notification_ws_urlpatterns
 from core.authentication import TokenAuthMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_app.settings')
 
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
+    'http': URLRouter(
+        chat_http_urlpatterns +
+        [re_path(r'', get_asgi_application())]
+    ),
     'websocket': TokenAuthMiddleware(
         URLRouter(
             chat_ws_urlpatterns +
@@ -84,13 +84,85 @@ ASGI_APPLICATION = 'chat_app.asgi.application'
 
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'core.layers.RedisChannelLayer',
         'CONFIG': {
             "hosts": [('127.0.0.1', 6379)],
         },
     },
 }
 
+# Presence
+PRESENCE_TTL = 60 * 60 * 24
+PRESENCE_FLUSH_INTERVAL = 5
+PRESENCE_FLUSH_BATCH_SIZE = 500
+PRESENCE_HEARTBEAT_INTERVAL = 30
+PRESENCE_STALE_AFTER = 90
+PRESENCE_FLUSH_LOCK_TIMEOUT = 60
+
+# Chat Membership Cache
+MEMBERSHIP_TTL = 60 * 60 * 24
+MEMBERSHIP_LOCAL_TTL = 5
+MEMBERSHIP_LOCAL_MAXSIZE = 4096
+
+# Authenticated Identity Cache
+IDENTITY_CACHE_ALIAS = 'default'
+IDENTITY_CACHE_TTL = 60 * 60
+IDENTITY_CACHE_VERSION = 1
+IDENTITY_LOCAL_TTL = 5
+IDENTITY_LOCAL_MAXSIZE = 4096
+
+# Users Search
+# Backend dotted path, default is picked by database vendor (see `authentication.search`)
+USER_SEARCH_BACKEND = None
+USER_SEARCH_CONFIG = 'simple'
+USER_SEARCH_MAX_TERMS = 8
+USER_SEARCH_MIN_TERM_LENGTH = 2
+
+# Messages Ingestion
+MESSAGE_BATCH_WINDOW = 0.005
+MESSAGE_BATCH_MAX_SIZE = 500
+MESSAGE_FRAME_MAX_SIZE = 50
+SYNC_MAX_LIMIT = 200
+
+# Messages Search
+# Backend dotted path, default is picked by database vendor (see `chat.search`)
+MESSAGE_SEARCH_BACKEND = None
+MESSAGE_SEARCH_CONFIG = 'simple'
+MESSAGE_SEARCH_QUERY_MIN_LENGTH = 2
+MESSAGE_SEARCH_QUERY_MAX_LENGTH = 256
+
+# Chats Export
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_COMPRESS_LEVEL = 6
+
+# Unread Counters
+UNREAD_FLUSH_INTERVAL = 10
+UNREAD_FLUSH_BATCH_SIZE = 500
+
+# Websocket Outbound Queues
+OUTBOUND_QUEUE_MAX_SIZE = 500
+OUTBOUND_QUEUE_DROP_THRESHOLD = 50
+OUTBOUND_EPHEMERAL_TTL = 2
+
+# Messages Rate Limits (messages per second, burst)
+MESSAGE_RATE_USER = 10
+MESSAGE_RATE_USER_BURST = 60
+MESSAGE_RATE_CHAT = 100
+MESSAGE_RATE_CHAT_BURST = 300
+
+# Chat Activity
+ACTIVITY_INTERVAL = 1
+ACTIVITY_REPEAT_INTERVAL = 3
+
+# Messages Archive
+MESSAGE_ARCHIVE_AGE_DAYS = 180
+MESSAGE_ARCHIVE_SEGMENT_SIZE = 1000
+MESSAGE_ARCHIVE_COMPRESS_LEVEL = 6
+
+# Notifications Digests (seconds)
+NOTIFICATION_DIGEST_WINDOW = 1.5
+NOTIFICATION_DIGEST_MAX_DELAY = 5
+
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
@@ -15,9 +15,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from core.views import OutboundStatsApiView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('auth/', include('authentication.urls')),
     path('chat/', include('chat.urls')),
+    path('metrics/outbound/', OutboundStatsApiView.as_view(), name='outbound_stats'),
 ]
@@ -1,5 +1,6 @@
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
 from . import exceptions
 
 # For TokenAuthMiddleWare for Websocket
@@ -8,7 +9,7 @@ from django.db import close_old_connections
 from django.contrib.auth.models import AnonymousUser
 from jwt import ExpiredSignatureError, DecodeError, decode as jwt_decode
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from authentication import identity
 
 
 class CustomJWTAuthentication(JWTAuthentication):
@@ -19,27 +20,28 @@ class CustomJWTAuthentication(JWTAuthentication):
             raise exceptions.NotAuthenticatedToken
 
     def get_user(self, validated_token):
+        # User is built from identity cache instead of querying it on every request
         try:
-            return super(CustomJWTAuthentication, self).get_user(validated_token)
-        except AuthenticationFailed as error:
-            if error.detail['code'] == 'user_not_found':
-                raise exceptions.NotAuthenticatedToken
-            elif error.detail['code'] == 'user_inactive':
-                raise exceptions.AuthUserDisabled
-            else:
-                raise error
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise exceptions.NotAuthenticatedToken
+        user = identity.get_user(user_id)
+        if user is None:
+            raise exceptions.NotAuthenticatedToken
+        if not user.is_active:
+            raise exceptions.AuthUserDisabled
+        return user
 
 
 @database_sync_to_async
 def get_user(user_id):
-    user_cls = get_user_model()
-    try:
-        return user_cls.objects.get(id=user_id)
+    user = identity.get_user(user_id)
     # Over Exception Handling -> as if token is okay for sure user_id is correct
-    except user_cls.DoesNotExist:
+    if user is None:
         # I am leaving it as it's to make it translatable in future
         msg = 'User Does Not Exist.'
         raise AuthenticationFailed(msg)
+    return user
 
 
 class TokenAuthMiddleware:
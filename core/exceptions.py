@@ -87,6 +87,23 @@ class ValidationException(FlamesCLoudException):
         FlamesCLoudException.__init__(self)
 
 
+class InvalidCursor(FlamesCLoudException):
+    status_code = status.HTTP_404_NOT_FOUND
+    code = 'invalid_cursor'
+    message = 'Invalid cursor.'
+    fields = ['cursor']
+
+
+class RateLimited(FlamesCLoudException):
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    code = 'rate_limited'
+    message = 'Too many messages, retry later.'
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        FlamesCLoudException.__init__(self)
+
+
 def validation_exceptions(error):
     errors = EmptyException()
     for key in error.detail:
@@ -95,3 +112,16 @@ def validation_exceptions(error):
         error_message = str(error_item)
         errors += ValidationException(error_code, key, error_message)
     return errors
+
+
+"""
+    Websocket Exceptions Codes
+"""
+
+
+def slow_consumer():
+    return 4008
+
+
+def rate_limited():
+    return 4029
@@ -0,0 +1,95 @@
+import asyncio
+import collections
+import logging
+import time
+
+from channels_redis.core import RedisChannelLayer as BaseRedisChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+class RedisChannelLayer(BaseRedisChannelLayer):
+    """
+        Redis channel layer with a bulk `group_send_many`, one pipeline to read every group members and one LUA script
+        per connection to push the message to all of them, instead of 2 round trips (at least) per group.
+    """
+
+    group_send_many_lua = """
+        local over_capacity = 0
+        local current_time = ARGV[#ARGV - 1]
+        local expiry = ARGV[#ARGV]
+        for i=1,#KEYS do
+            redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, current_time - expiry)
+            if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+                redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+                redis.call('EXPIRE', KEYS[i], expiry)
+            else
+                over_capacity = over_capacity + 1
+            end
+        end
+        return over_capacity
+    """
+
+    async def group_send_many(self, groups, message):
+        """
+            Sends the same message to every channel of the given groups,
+            a channel subscribed to more than one of these groups receives the message once.
+        """
+        groups = list(dict.fromkeys(groups))
+        if not groups:
+            return
+        for group in groups:
+            assert self.valid_group_name(group), "Group name not valid"
+
+        # Bucket groups keys by connection index => {index: [key0, key1]}
+        connection_to_group_keys = collections.defaultdict(list)
+        for group in groups:
+            connection_to_group_keys[self.consistent_hash(group)].append(self._group_key(group))
+
+        channel_names = []
+        for connection_index, group_keys in connection_to_group_keys.items():
+            async with self.connection(connection_index) as connection:
+                pipe = connection.pipeline()
+                for key in group_keys:
+                    # Discard old channels based on group_expiry
+                    pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+                    pipe.zrange(key, 0, -1)
+                results = await pipe.execute()
+            # Results are [removed_count, members, removed_count, members, ...]
+            for members in results[1::2]:
+                channel_names += [x.decode('utf8') for x in members]
+        channel_names = list(dict.fromkeys(channel_names))
+        if not channel_names:
+            return
+
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
+            args = [channel_keys_to_message[channel_key] for channel_key in channel_redis_keys]
+            args += [channel_keys_to_capacity[channel_key] for channel_key in channel_redis_keys]
+            args += [time.time(), self.expiry]
+            async with self.connection(connection_index) as connection:
+                channels_over_capacity = await connection.eval(
+                    self.group_send_many_lua, keys=channel_redis_keys, args=args
+                )
+            if channels_over_capacity > 0:
+                logger.info(
+                    '%s of %s channels over capacity in groups %s',
+                    channels_over_capacity,
+                    len(channel_names),
+                    groups,
+                )
+
+
+async def group_send_many(channel_layer, groups, message):
+    """
+        Bulk group send, falls back to concurrent `group_send` calls for layers without `group_send_many`
+        (ex: InMemoryChannelLayer in development and tests).
+    """
+    if hasattr(channel_layer, 'group_send_many'):
+        return await channel_layer.group_send_many(groups, message)
+    await asyncio.gather(*[channel_layer.group_send(group, message) for group in dict.fromkeys(groups)])
@@ -0,0 +1,143 @@
+import asyncio
+import collections
+import itertools
+import logging
+import time
+from django.conf import settings
+from .exceptions import slow_consumer
+
+"""
+    Per connection bounded outbound queue.
+    Channel layer handlers put frames in the queue and return at once, so the connection inbox is drained whatever
+    client speed is, and a writer task sends queued frames in order. A slow client only grows its own queue:
+        - frames with the same key are coalesced in place (e.g. chats list updates of the same chat),
+        - ephemeral frames (e.g. typing) are dropped when queue is over `OUTBOUND_QUEUE_DROP_THRESHOLD` or when they
+          are older than `OUTBOUND_EPHEMERAL_TTL` seconds at send time,
+        - queue over `OUTBOUND_QUEUE_MAX_SIZE` disconnects the client with a resume hint frame, it reconnects and
+          resumes (see `resume` action) instead of being fed forever.
+    Counters of the worker are kept in `stats`.
+"""
+
+OUTBOUND_QUEUE_MAX_SIZE = getattr(settings, 'OUTBOUND_QUEUE_MAX_SIZE', 500)
+OUTBOUND_QUEUE_DROP_THRESHOLD = getattr(settings, 'OUTBOUND_QUEUE_DROP_THRESHOLD', 50)
+OUTBOUND_EPHEMERAL_TTL = getattr(settings, 'OUTBOUND_EPHEMERAL_TTL', 2)
+
+logger = logging.getLogger(__name__)
+
+# Worker counters => queued, sent, coalesced, dropped, disconnected, depth (frames queued now), max_depth
+stats = collections.Counter()
+
+
+def get_stats():
+    return dict(stats)
+
+
+def merge_data(old, new):
+    """
+        Coalesces dict frames (or their 'data' dicts) field by field, the latest value of every field wins.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    if isinstance(old.get('data'), dict) and isinstance(new.get('data'), dict):
+        return {**new, 'data': {**old['data'], **new['data']}}
+    return {**old, **new}
+
+
+class OutboundQueue:
+    def __init__(self, send, on_overflow, max_size=OUTBOUND_QUEUE_MAX_SIZE,
+                 drop_threshold=OUTBOUND_QUEUE_DROP_THRESHOLD, ephemeral_ttl=OUTBOUND_EPHEMERAL_TTL):
+        """
+            @param send: async callable that sends a frame.
+            @param on_overflow: async callable called once when queue exceeds `max_size`.
+        """
+        self.send = send
+        self.on_overflow = on_overflow
+        self.max_size = max_size
+        self.drop_threshold = drop_threshold
+        self.ephemeral_ttl = ephemeral_ttl
+        # {key: [frame, ephemeral, queued_at]}, in sending order
+        self.frames = collections.OrderedDict()
+        self.keys = itertools.count()
+        self.task = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, key=None, merge=None, ephemeral=False):
+        """
+            @param key: frames with the same key are coalesced by `merge(old, new)` (or replaced) while queued.
+            @param ephemeral: frame may be dropped under pressure or when stale.
+        """
+        if self.closed:
+            return
+        if key is not None and key in self.frames:
+            entry = self.frames[key]
+            entry[0] = merge(entry[0], frame) if merge else frame
+            entry[2] = time.monotonic()
+            stats['coalesced'] += 1
+            return
+        if ephemeral and len(self.frames) >= self.drop_threshold:
+            stats['dropped'] += 1
+            return
+        if len(self.frames) >= self.max_size:
+            logger.warning('Outbound queue over %s frames, disconnecting slow client', self.max_size)
+            stats['disconnected'] += 1
+            stats['dropped'] += len(self.frames) + 1
+            self.close()
+            asyncio.ensure_future(self.on_overflow())
+            return
+        self.frames[key if key is not None else ('frame', next(self.keys))] = [frame, ephemeral, time.monotonic()]
+        stats['queued'] += 1
+        stats['depth'] += 1
+        stats['max_depth'] = max(stats['max_depth'], len(self.frames))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        try:
+            while self.frames:
+                _, (frame, ephemeral, queued_at) = self.frames.popitem(last=False)
+                stats['depth'] -= 1
+                if ephemeral and time.monotonic() - queued_at > self.ephemeral_ttl:
+                    stats['dropped'] += 1
+                    continue
+                await self.send(frame)
+                stats['sent'] += 1
+        finally:
+            self.task = None
+
+    def close(self):
+        self.closed = True
+        stats['depth'] -= len(self.frames)
+        self.frames.clear()
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class OutboundQueueMixin:
+    """
+        Websocket consumer mixin, `queue_json` instead of `send_json` for every frame (channel layer events and
+        replies), so frames are sent in order by one writer.
+    """
+    outbound = None
+
+    def queue_json(self, content, key=None, merge=None, ephemeral=False):
+        if self.outbound is None:
+            self.outbound = OutboundQueue(self.send_json, self.outbound_overflow)
+        self.outbound.put(content, key, merge, ephemeral)
+
+    def resume_hint(self):
+        """
+            @return last frame sent to a disconnected slow client.
+        """
+        return {'type': 'RESUME', 'data': {'reason': 'slow_consumer'}}
+
+    async def outbound_overflow(self):
+        await self.send_json(self.resume_hint())
+        await self.close(code=slow_consumer())
+
+    async def websocket_disconnect(self, message):
+        if self.outbound is not None:
+            self.outbound.close()
+        await super(OutboundQueueMixin, self).websocket_disconnect(message)
@@ -1,5 +1,11 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q, Subquery
+from django.utils.dateparse import parse_datetime
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from .exceptions import InvalidCursor
 
 
 class PaginationMessage:
@@ -30,3 +36,187 @@ class StandardResultsSetPagination(PageNumberPagination):
             'previous': self.page.previous_page_number() if self.page.has_previous() else None,
             'results': data
         })
+
+
+class KeysetPagination(BasePagination):
+    """
+        Keyset (seek) pagination over descending (ordering_field, id), no COUNT and no OFFSET.
+        Cursor is opaque base64 of the last item [ordering_field, id] of the previous page.
+    """
+    ordering_field = None
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    cursor_query_param = 'cursor'
+
+    next_cursor = None
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, item):
+        value = getattr(item, self.ordering_field)
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([value, item.pk]).encode()).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            # Position is a string (datetimes are iso strings) or a number, never a container or a boolean
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise ValueError(value)
+            if isinstance(pk, bool) or not isinstance(pk, int):
+                raise ValueError(pk)
+            parsed_value = parse_datetime(value) if isinstance(value, str) else value
+            return parsed_value or value, pk
+        except (TypeError, ValueError):
+            raise InvalidCursor()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(f'-{self.ordering_field}', '-pk')
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            value, pk = cursor
+            try:
+                queryset = queryset.filter(Q(**{f'{self.ordering_field}__lt': value}) |
+                                           Q(**{self.ordering_field: value, 'pk__lt': pk}))
+            except DjangoValidationError:
+                # Position of another field type (e.g. a string that is not a datetime)
+                raise InvalidCursor()
+        # One extra item to know if there is a next page
+        items = list(queryset[:page_size + 1])
+        page = items[:page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if len(items) > page_size else None
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.next_cursor,
+            'results': data
+        })
+
+
+class ChatsCursorPagination(KeysetPagination):
+    ordering_field = 'last_activity_at'
+
+
+class RankedKeysetPagination(KeysetPagination):
+    """
+        Keyset pagination of search results, best match first.
+        Paginated object is a search with `page(cursor, limit)` method, not a queryset, as rank is computed by the
+        search backend.
+    """
+    ordering_field = 'search_rank'
+
+    def paginate_queryset(self, search, request, view=None):
+        page_size = self.get_page_size(request)
+        items = search.page(self.decode_cursor(request), page_size + 1)
+        page = items[:page_size]
+        self.next_cursor = self.encode_cursor(page[-1]) if len(items) > page_size else None
+        return page
+
+
+class AnchorCursorPagination(StandardResultsSetPagination):
+    """
+        Page number pagination plus `before`/`after` item id cursor mode, which seeks on descending
+        (ordering_field, id) from the anchor item without COUNT or OFFSET.
+        Results are newest first in both modes.
+    """
+    ordering_field = 'created_at'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    cursor_mode = False
+    next_anchor = None
+    previous_anchor = None
+
+    def get_anchor(self, request, param):
+        anchor = request.query_params.get(param)
+        if anchor is None:
+            return None
+        if not anchor.isnumeric():
+            raise InvalidCursor()
+        return int(anchor)
+
+    def get_anchor_queryset(self, queryset):
+        """
+            @return items anchors are looked up in, items filtered out of pages since (e.g. disabled) stay valid
+                    anchors.
+        """
+        return queryset.model._default_manager.all()
+
+    def check_anchor(self, queryset, anchor_pk):
+        """
+            Raises `InvalidCursor` for a missing anchor, instead of an empty page ending the history.
+        """
+        if not self.get_anchor_queryset(queryset).filter(pk=anchor_pk).exists():
+            raise InvalidCursor()
+
+    def get_before_items(self, queryset, anchor_pk, limit):
+        """
+            @return up to `limit` items before the anchor, newest first.
+        """
+        field = self.ordering_field
+        # Anchor value is resolved in the same query
+        anchor_value = Subquery(self.get_anchor_queryset(queryset).filter(pk=anchor_pk).values(field)[:1])
+        items = list(queryset.filter(Q(**{f'{field}__lt': anchor_value}) |
+                                     Q(**{field: anchor_value, 'pk__lt': anchor_pk}))
+                     .order_by(f'-{field}', '-pk')[:limit])
+        if not items:
+            self.check_anchor(queryset, anchor_pk)
+        return items
+
+    def get_after_items(self, queryset, anchor_pk, limit):
+        """
+            @return up to `limit` items after the anchor, oldest first.
+        """
+        field = self.ordering_field
+        anchor_value = Subquery(self.get_anchor_queryset(queryset).filter(pk=anchor_pk).values(field)[:1])
+        items = list(queryset.filter(Q(**{f'{field}__gt': anchor_value}) |
+                                     Q(**{field: anchor_value, 'pk__gt': anchor_pk}))
+                     .order_by(field, 'pk')[:limit])
+        if not items:
+            self.check_anchor(queryset, anchor_pk)
+        return items
+
+    def paginate_queryset(self, queryset, request, view=None):
+        before = self.get_anchor(request, self.before_query_param)
+        after = self.get_anchor(request, self.after_query_param)
+        self.cursor_mode = before is not None or after is not None
+        if not self.cursor_mode:
+            return super(AnchorCursorPagination, self).paginate_queryset(queryset, request, view)
+
+        page_size = self.get_page_size(request) or self.page_size
+        anchor_pk = before if before is not None else after
+        if before is not None:
+            items = self.get_before_items(queryset, anchor_pk, page_size + 1)
+        else:
+            items = self.get_after_items(queryset, anchor_pk, page_size + 1)
+        has_more = len(items) > page_size
+        page = items[:page_size]
+        if before is not None:
+            self.next_anchor = page[-1].pk if has_more else None
+            self.previous_anchor = page[0].pk if page else anchor_pk
+        else:
+            page.reverse()
+            self.previous_anchor = page[0].pk if has_more else None
+            self.next_anchor = page[-1].pk if page else anchor_pk
+        return page
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super(AnchorCursorPagination, self).get_paginated_response(data)
+        return Response({
+            'next': self.next_anchor,
+            'previous': self.previous_anchor,
+            'results': data
+        })
@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from channels.db import database_sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+"""
+    Live presence registry.
+    Every websocket connection stream is a field in the user hash `presence:user:<user_id>` keyed by
+    `<channel name>|<kind>|<chat id>` (a multiplexed connection has many streams):
+        {'kind': 'chats' | 'notifications' | 'chat', 'user_id': ..., 'chat_id': ..., 'started_at': ...}
+    So connecting and disconnecting are O(1) `HSET`/`HDEL` and no database row is written.
+    Every field has its own liveness in zset `presence:alive:<user_id>` scored by the latest heartbeat time, workers
+    heartbeat their connections every `PRESENCE_HEARTBEAT_INTERVAL` seconds. Fields not seen for
+    `PRESENCE_STALE_AFTER` seconds (crashed or redeployed workers) are pruned when connections are read.
+    Ended connections are pushed to `presence:history` list and flushed to `Session` tables in batches, by one worker
+    at a time (`presence:history:lock`), a batch is removed from the list once its sessions are saved. Notifications
+    connections have no `Session` table, they aren't pushed to history.
+"""
+
+KIND_CHATS = 'chats'
+KIND_CHAT = 'chat'
+KIND_NOTIFICATIONS = 'notifications'
+
+PRESENCE_TTL = getattr(settings, 'PRESENCE_TTL', 60 * 60 * 24)
+PRESENCE_FLUSH_INTERVAL = getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 5)
+PRESENCE_FLUSH_BATCH_SIZE = getattr(settings, 'PRESENCE_FLUSH_BATCH_SIZE', 500)
+PRESENCE_HEARTBEAT_INTERVAL = getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 30)
+PRESENCE_STALE_AFTER = getattr(settings, 'PRESENCE_STALE_AFTER', 90)
+PRESENCE_FLUSH_LOCK_TIMEOUT = getattr(settings, 'PRESENCE_FLUSH_LOCK_TIMEOUT', 60)
+
+HISTORY_KEY = 'presence:history'
+HISTORY_LOCK_KEY = 'presence:history:lock'
+
+logger = logging.getLogger(__name__)
+
+# Atomic HGET + HDEL + ZREM + RPUSH of ended connection, ARGV => [field, ended (json), keep_history]
+# History record is the json array [connection, ended]
+DISCONNECT_LUA = """
+    redis.call('ZREM', KEYS[3], ARGV[1])
+    local value = redis.call('HGET', KEYS[1], ARGV[1])
+    if not value then
+        return nil
+    end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    if ARGV[3] == '1' then
+        redis.call('RPUSH', KEYS[2], '[' .. value .. ',' .. ARGV[2] .. ']')
+    end
+    return value
+"""
+
+# Prunes fields not seen since ARGV[1] (ended at their latest heartbeat time) and returns live connections,
+# connections of kind ARGV[2] have no history. KEYS => [user hash, alive zset, history]
+CONNECTIONS_LUA = """
+    local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1], 'WITHSCORES')
+    for i = 1, #stale, 2 do
+        local value = redis.call('HGET', KEYS[1], stale[i])
+        if value then
+            redis.call('HDEL', KEYS[1], stale[i])
+            local channel_name, kind = string.match(stale[i], '^(.-)|(.-)|')
+            if kind ~= ARGV[2] then
+                local ended = '{"channel_name": "' .. channel_name .. '", "ended_at": ' .. stale[i + 1] .. '}'
+                redis.call('RPUSH', KEYS[3], '[' .. value .. ',' .. ended .. ']')
+            end
+        end
+    end
+    if #stale > 0 then
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1])
+    end
+    return redis.call('HVALS', KEYS[1])
+"""
+
+
+def user_key(user_id):
+    return f'presence:user:{user_id}'
+
+
+def alive_key(user_id):
+    return f'presence:alive:{user_id}'
+
+
+def connection_field(channel_name, kind, chat_id=None):
+    return f'{channel_name}|{kind}|{chat_id or ""}'
+
+
+def get_connection():
+    return get_redis_connection('default')
+
+
+# Connections of this worker => {(user_id, field): value}, kept alive by `heartbeat`
+_local_connections = {}
+_local_connections_lock = threading.Lock()
+
+
+def _set_alive(pipe, user_id, field, value, now):
+    pipe.hset(user_key(user_id), field, value)
+    pipe.zadd(alive_key(user_id), {field: now})
+    pipe.expire(user_key(user_id), PRESENCE_TTL)
+    pipe.expire(alive_key(user_id), PRESENCE_TTL)
+
+
+def connect(user_id, channel_name, kind, chat_id=None):
+    started_at = timezone.now()
+    value = json.dumps({'kind': kind, 'user_id': user_id, 'chat_id': chat_id, 'started_at': started_at.isoformat()})
+    field = connection_field(channel_name, kind, chat_id)
+    pipe = get_connection().pipeline()
+    _set_alive(pipe, user_id, field, value, time.time())
+    pipe.execute()
+    with _local_connections_lock:
+        _local_connections[(user_id, field)] = value
+    return started_at
+
+
+def disconnect(user_id, channel_name, kind, chat_id=None, keep_history=True):
+    field = connection_field(channel_name, kind, chat_id)
+    with _local_connections_lock:
+        _local_connections.pop((user_id, field), None)
+    connection = get_connection()
+    ended = json.dumps({'channel_name': channel_name, 'ended_at': timezone.now().isoformat()})
+    args = [field, ended, '1' if keep_history else '0']
+    return connection.eval(DISCONNECT_LUA, 3, user_key(user_id), HISTORY_KEY, alive_key(user_id), *args)
+
+
+def heartbeat():
+    """
+        Refreshes liveness of connections of this worker (restoring them if they were pruned meanwhile).
+        @return number of connections
+    """
+    with _local_connections_lock:
+        connections = list(_local_connections.items())
+    if not connections:
+        return 0
+    now = time.time()
+    pipe = get_connection().pipeline(transaction=False)
+    for (user_id, field), value in connections:
+        _set_alive(pipe, user_id, field, value, now)
+    pipe.execute()
+    return len(connections)
+
+
+def _decode_connections(values):
+    connections = [json.loads(value) for value in values]
+    for connection in connections:
+        connection['started_at'] = parse_datetime(connection['started_at'])
+    return connections
+
+
+def _load_connections(client, user_id):
+    stale_before = time.time() - PRESENCE_STALE_AFTER
+    return client.eval(CONNECTIONS_LUA, 3, user_key(user_id), alive_key(user_id), HISTORY_KEY, stale_before,
+                       KIND_NOTIFICATIONS)
+
+
+def get_connections(user_id):
+    return _decode_connections(_load_connections(get_connection(), user_id))
+
+
+def get_many_connections(user_ids):
+    """
+        @return dict of user id => list of live connections, using one pipeline for all users.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    pipe = get_connection().pipeline(transaction=False)
+    for user_id in user_ids:
+        _load_connections(pipe, user_id)
+    return {user_id: _decode_connections(values) for user_id, values in zip(user_ids, pipe.execute())}
+
+
+def prefetch_connections(users):
+    """
+        Attaches live connections to users (`prefetched_connections`) using one pipeline.
+    """
+    users = [user for user in users if not hasattr(user, 'prefetched_connections')]
+    connections = get_many_connections({user.pk for user in users})
+    for user in users:
+        user.prefetched_connections = connections[user.pk]
+
+
+def is_connected(connections, kind, chat_id=None):
+    return any(connection['kind'] == kind and (chat_id is None or connection['chat_id'] == chat_id)
+               for connection in connections)
+
+
+def flush_history(batch_size=PRESENCE_FLUSH_BATCH_SIZE):
+    """
+        Moves one batch of ended connections from redis to `Session` tables, records are removed from redis only
+        once saved, so a failed flush is retried.
+        @return number of flushed records, 0 while another worker is flushing
+    """
+    connection = get_connection()
+    lock = connection.lock(HISTORY_LOCK_KEY, timeout=PRESENCE_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        records = connection.lrange(HISTORY_KEY, 0, batch_size - 1)
+        if records:
+            with transaction.atomic():
+                _save_history(records, batch_size)
+            # Records are only appended meanwhile, the batch is still the head of the list
+            connection.ltrim(HISTORY_KEY, len(records), -1)
+        return len(records)
+    finally:
+        lock.release()
+
+
+def _save_history(records, batch_size):
+    user_session_cls = apps.get_model('authentication', 'Session')
+    chat_session_cls = apps.get_model('chat', 'Session')
+    users_sessions = []
+    chats_sessions = []
+    for connection, ended in map(json.loads, records):
+        record = connection | ended
+        session = {
+            'user_id': record['user_id'],
+            'state': 'INACTIVE',
+            'channel_name': record['channel_name'],
+            'started_at': parse_datetime(record['started_at']),
+            'ended_at': _parse_ended_at(record['ended_at']),
+        }
+        if record['kind'] == KIND_CHAT:
+            chats_sessions.append(chat_session_cls(chat_id=record['chat_id'], **session))
+        elif record['kind'] == KIND_CHATS:
+            users_sessions.append(user_session_cls(**session))
+        # Notifications records (pushed by older workers) have no table
+    user_session_cls.objects.bulk_create(users_sessions, batch_size=batch_size)
+    chat_session_cls.objects.bulk_create(chats_sessions, batch_size=batch_size)
+
+
+def _parse_ended_at(value):
+    # Pruned stale connections ended at their latest heartbeat (timestamp)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+    return parse_datetime(value)
+
+
+def flush_all_history(batch_size=PRESENCE_FLUSH_BATCH_SIZE):
+    total = 0
+    while True:
+        count = flush_history(batch_size)
+        total += count
+        if count < batch_size:
+            return total
+
+
+_history_flusher = None
+_heartbeat = None
+
+
+async def _flush_history_periodically():
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+        try:
+            await database_sync_to_async(flush_all_history)()
+        except Exception:
+            logger.exception('Flushing sessions history failed')
+
+
+def ensure_history_flusher():
+    """
+        Starts (once per worker) the background task that flushes sessions history, must be called from event loop.
+    """
+    global _history_flusher
+    if _history_flusher is None or _history_flusher.done():
+        _history_flusher = asyncio.ensure_future(_flush_history_periodically())
+
+
+async def _heartbeat_periodically():
+    while True:
+        await asyncio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+        try:
+            await database_sync_to_async(heartbeat)()
+        except Exception:
+            logger.exception('Presence heartbeat failed')
+
+
+def ensure_heartbeat():
+    """
+        Starts (once per worker) the background task that keeps connections of the worker alive, must be called from
+        event loop.
+    """
+    global _heartbeat
+    if _heartbeat is None or _heartbeat.done():
+        _heartbeat = asyncio.ensure_future(_heartbeat_periodically())
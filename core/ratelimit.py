@@ -0,0 +1,125 @@
+import collections
+import threading
+import time
+from django.conf import settings
+from django_redis import get_redis_connection
+
+"""
+    Token bucket rate limiting shared by all workers.
+    A bucket refills `rate` tokens per second up to `burst`, a request takes `cost` tokens from all of its buckets at
+    once or from none. Buckets live in redis hashes `ratelimit:<key>` updated by one LUA script (redis clock), and
+    every worker keeps the same buckets locally: traffic a worker sees is a part of the global traffic, so an empty
+    local bucket rejects without a redis round trip (fast path for floods) and the redis bucket decides otherwise.
+"""
+
+RATE_LIMIT_LOCAL_MAXSIZE = getattr(settings, 'RATE_LIMIT_LOCAL_MAXSIZE', 10000)
+
+Bucket = collections.namedtuple('Bucket', ['key', 'rate', 'burst'])
+
+# KEYS => buckets keys, ARGV => [cost, rate1, burst1, rate2, burst2, ...]
+# @return '0' when tokens are taken, else seconds to wait (string, LUA numbers are truncated to integers in replies)
+TAKE_LUA = """
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local cost = tonumber(ARGV[1])
+    local tokens = {}
+    local retry_after = 0
+    for i = 1, #KEYS do
+        local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'updated_at')
+        local available = tonumber(bucket[1]) or burst
+        local updated_at = tonumber(bucket[2]) or now
+        tokens[i] = math.min(burst, available + math.max(0, now - updated_at) * rate)
+        if tokens[i] < cost then
+            retry_after = math.max(retry_after, (cost - tokens[i]) / rate)
+        end
+    end
+    if retry_after > 0 then
+        return tostring(retry_after)
+    end
+    for i = 1, #KEYS do
+        local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        redis.call('HSET', KEYS[i], 'tokens', tokens[i] - cost, 'updated_at', now)
+        redis.call('EXPIRE', KEYS[i], math.ceil(burst / rate) + 1)
+    end
+    return '0'
+"""
+
+
+def bucket_key(key):
+    return f'ratelimit:{key}'
+
+
+def get_connection():
+    return get_redis_connection('default')
+
+
+class LocalBuckets:
+    def __init__(self, maxsize=RATE_LIMIT_LOCAL_MAXSIZE):
+        self.maxsize = maxsize
+        # {key: [tokens, updated_at]}, least recently used first
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, buckets, cost):
+        """
+            @return 0 when tokens are taken, else seconds to wait
+        """
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            retry_after = 0
+            for bucket in buckets:
+                tokens, updated_at = self._data.get(bucket.key) or (bucket.burst, now)
+                tokens = min(bucket.burst, tokens + (now - updated_at) * bucket.rate)
+                states.append(tokens)
+                if tokens < cost:
+                    retry_after = max(retry_after, (cost - tokens) / bucket.rate)
+            if retry_after:
+                return retry_after
+            for bucket, tokens in zip(buckets, states):
+                self._data[bucket.key] = [tokens - cost, now]
+                self._data.move_to_end(bucket.key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return 0
+
+    def refund(self, buckets, cost):
+        """
+            Gives back `cost` tokens taken from the buckets, up to their burst.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for bucket in buckets:
+                state = self._data.get(bucket.key)
+                if state is None:
+                    continue
+                tokens, updated_at = state
+                self._data[bucket.key] = [min(bucket.burst, tokens + (now - updated_at) * bucket.rate + cost), now]
+
+
+local_buckets = LocalBuckets()
+
+
+def take_local(buckets, cost=1):
+    return local_buckets.take(buckets, cost)
+
+
+def refund_local(buckets, cost=1):
+    """
+        Gives back tokens of `take_local` when the request is rejected by redis buckets, so the rejected request
+        isn't counted twice against the local buckets.
+    """
+    local_buckets.refund(buckets, cost)
+
+
+def take(buckets, cost=1):
+    """
+        Takes tokens from redis buckets, call `take_local` first.
+        @return 0 when tokens are taken, else seconds to wait
+    """
+    args = [cost]
+    for bucket in buckets:
+        args += [bucket.rate, bucket.burst]
+    return float(get_connection().eval(TAKE_LUA, len(buckets), *[bucket_key(bucket.key) for bucket in buckets],
+                                       *args))
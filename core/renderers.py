@@ -1,9 +1,57 @@
-from rest_framework import renderers
+import decimal
 import json
+from django.utils.functional import Promise
+from rest_framework import renderers
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONEncoder(encoders.JSONEncoder):
+    """
+        DRF encoder (datetimes, uuids, querysets, ...) with lossless decimals, as `DecimalField` renders them.
+    """
+
+    def default(self, obj):
+        if isinstance(obj, decimal.Decimal):
+            return str(obj)
+        return super(JSONEncoder, self).default(obj)
+
+
+_encoder = JSONEncoder()
+
+
+def _default(obj):
+    if isinstance(obj, Promise):
+        return str(obj)
+    return _encoder.default(obj)
+
+
+def dumps(data):
+    """
+        @return utf-8 json bytes, by orjson when it's installed.
+    """
+    if orjson is not None:
+        # Same datetimes format as DRF fields ('Z' suffix for UTC)
+        return orjson.dumps(data, default=_default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
 
 
 class StandardRenderer(renderers.JSONRenderer):
+    """
+        Wraps response data in {'data': ...} or {'errors': ...} envelope.
+        Errors are known by response status (exception handler responses and 4xx/5xx responses of views) instead of
+        scanning data text for `ErrorDetail`.
+    """
     charset = 'utf-8'
 
+    @staticmethod
+    def is_error(renderer_context):
+        response = (renderer_context or {}).get('response')
+        return response is not None and (response.exception or response.status_code >= 400)
+
     def render(self, data, accepted_media_type=None, renderer_context=None):
-        return json.dumps({'errors': data} if 'ErrorDetail' in str(data) else {'data': data})
+        return dumps({'errors': data} if self.is_error(renderer_context) else {'data': data})
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest import mock
+import fakeredis
+import fakeredis.aioredis
+from channels.layers import InMemoryChannelLayer
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.response import Response
+from . import renderers
+from .renderers import StandardRenderer
+from . import outbound
+from . import ratelimit
+from . import presence
+from . import layers
+from authentication.models import Session, User
+
+
+class StandardRendererTestCase(SimpleTestCase):
+    def render(self, data, status=200, exception=False):
+        response = Response(status=status)
+        response.exception = exception
+        return json.loads(StandardRenderer().render(data, renderer_context={'response': response}))
+
+    def test_envelope_follows_response_status(self):
+        self.assertEqual(self.render({'id': 1}), {'data': {'id': 1}})
+        self.assertEqual(self.render({'token': ErrorDetail('Invalid Token', code='invalid-token')}, status=400),
+                         {'errors': {'token': 'Invalid Token'}})
+        self.assertEqual(self.render([{'code': 'error'}], status=403, exception=True), {'errors': [{'code': 'error'}]})
+        # Success data mentioning errors text isn't an error anymore
+        self.assertEqual(self.render({'content': 'ErrorDetail'}), {'data': {'content': 'ErrorDetail'}})
+
+    def test_datetimes_and_decimals_with_both_encoders(self):
+        data = {'at': datetime(2022, 1, 1, 10, 30, tzinfo=timezone.utc), 'price': Decimal('10.10'), 1: 'key'}
+        expected = {'data': {'at': '2022-01-01T10:30:00Z', 'price': '10.10', '1': 'key'}}
+        self.assertEqual(self.render(data), expected)
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(self.render(data), expected)
+
+
+class OutboundQueueTestCase(SimpleTestCase):
+    def run_queue(self, frames, **options):
+        """
+            Queues frames while the client is blocked on the first one, then lets it read everything.
+        """
+        sent = []
+        overflow = mock.AsyncMock()
+
+        async def run():
+            unblock = asyncio.Event()
+
+            async def send(frame):
+                await unblock.wait()
+                sent.append(frame)
+
+            queue = outbound.OutboundQueue(send, overflow, **options)
+            for frame, kwargs in frames:
+                queue.put(frame, **kwargs)
+                await asyncio.sleep(0)
+            unblock.set()
+            await asyncio.sleep(0.01)
+            return queue
+
+        return asyncio.run(run()), sent, overflow
+
+    def test_same_key_frames_are_merged_in_place(self):
+        frames = [({'id': 0}, {}), ({'id': 1, 'a': 1}, {'key': 1, 'merge': outbound.merge_data}),
+                  ({'id': 2}, {}), ({'id': 1, 'b': 2}, {'key': 1, 'merge': outbound.merge_data})]
+        queue, sent, _ = self.run_queue(frames)
+        self.assertEqual(sent, [{'id': 0}, {'id': 1, 'a': 1, 'b': 2}, {'id': 2}])
+        self.assertEqual(len(queue), 0)
+
+    def test_ephemeral_frames_are_dropped_under_pressure(self):
+        frames = [({'id': i}, {}) for i in range(3)] + [({'typing': 1}, {'ephemeral': True})]
+        _, sent, _ = self.run_queue(frames, drop_threshold=2)
+        self.assertEqual(sent, [{'id': i} for i in range(3)])
+
+    def test_overflow_disconnects_once(self):
+        frames = [({'id': i}, {}) for i in range(5)]
+        queue, sent, overflow = self.run_queue(frames, max_size=2)
+        self.assertTrue(queue.closed)
+        overflow.assert_awaited_once()
+        # Pending send is cancelled too, client resumes instead
+        self.assertEqual(sent, [])
+
+
+class RateLimitTestCase(SimpleTestCase):
+    def test_local_buckets_take_from_all_buckets_or_none(self):
+        buckets = ratelimit.LocalBuckets()
+        user, chat = ratelimit.Bucket('user', 1, 3), ratelimit.Bucket('chat', 100, 2)
+        with mock.patch('time.monotonic', return_value=100):
+            self.assertEqual(buckets.take([user, chat], 2), 0)
+            # Chat bucket is out of tokens, user bucket keeps its token
+            self.assertGreater(buckets.take([user, chat], 1), 0)
+            self.assertEqual(buckets.take([user], 1), 0)
+            self.assertEqual(buckets.take([user], 1), 1)
+        with mock.patch('time.monotonic', return_value=101):
+            self.assertEqual(buckets.take([user, chat], 1), 0)
+
+    def test_refund_gives_back_tokens_up_to_burst(self):
+        buckets = ratelimit.LocalBuckets()
+        user, chat = ratelimit.Bucket('user', 1, 3), ratelimit.Bucket('chat', 100, 2)
+        with mock.patch('time.monotonic', return_value=100):
+            self.assertEqual(buckets.take([user, chat], 2), 0)
+            buckets.refund([user, chat], 2)
+            self.assertEqual(buckets.take([user, chat], 2), 0)
+            buckets.refund([user, chat], 5)
+            self.assertGreater(buckets.take([chat], 3), 0)
+            self.assertEqual(buckets.take([user], 3), 0)
+
+
+class GroupSendManyTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+        async def create_redis_pool(address=None, **kwargs):
+            return await fakeredis.aioredis.create_redis_pool(self.server)
+
+        patcher = mock.patch('channels_redis.core.aioredis.create_redis_pool', create_redis_pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_messages(self, layer, channel):
+        client = fakeredis.FakeStrictRedis(server=self.server)
+        return [layer.deserialize(message) for message in client.zrange(layer.prefix + channel, 0, -1)]
+
+    def test_channel_in_many_groups_receives_message_once(self):
+        layer = layers.RedisChannelLayer(hosts=['redis://localhost'])
+
+        async def send():
+            await layer.group_add('chat_1', 'first')
+            await layer.group_add('chat_2', 'first')
+            await layer.group_add('chat_2', 'second')
+            await layer.group_send_many(['chat_1', 'chat_2', 'chat_3'], {'type': 'chat.message'})
+
+        asyncio.run(send())
+        self.assertEqual(self.get_messages(layer, 'first'),
+                         [{'type': 'chat.message', '__asgi_channel__': ['first']}])
+        self.assertEqual(self.get_messages(layer, 'second'),
+                         [{'type': 'chat.message', '__asgi_channel__': ['second']}])
+
+    def test_layer_without_bulk_send_gets_message_per_group(self):
+        layer = InMemoryChannelLayer()
+
+        async def send():
+            await layer.group_add('chat_1', 'first')
+            await layer.group_add('chat_2', 'second')
+            await layers.group_send_many(layer, ['chat_1', 'chat_2', 'chat_1'], {'type': 'chat.message'})
+            return await layer.receive('first'), await layer.receive('second')
+
+        self.assertEqual(asyncio.run(send()), ({'type': 'chat.message'}, {'type': 'chat.message'}))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PresenceTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch('core.presence.get_connection', return_value=fakeredis.FakeStrictRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(presence._local_connections.clear)
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+
+    def kinds(self):
+        return [connection['kind'] for connection in presence.get_connections(self.user.pk)]
+
+    def test_disconnect_ends_connection(self):
+        presence.connect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+        presence.connect(self.user.pk, 'channel.2', presence.KIND_NOTIFICATIONS)
+        self.assertEqual(sorted(self.kinds()), [presence.KIND_CHATS, presence.KIND_NOTIFICATIONS])
+        presence.disconnect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+        self.assertEqual(self.kinds(), [presence.KIND_NOTIFICATIONS])
+        self.assertEqual(presence.flush_all_history(), 1)
+        self.assertEqual(Session.objects.get(user=self.user).channel_name, 'channel.1')
+
+    def test_stale_connections_are_pruned_on_read(self):
+        with mock.patch('time.time', return_value=1000):
+            presence.connect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+            presence.connect(self.user.pk, 'channel.2', presence.KIND_NOTIFICATIONS)
+        # Worker of channel.1 is gone, channel.2 keeps heartbeating
+        presence._local_connections.pop((self.user.pk, presence.connection_field('channel.1', presence.KIND_CHATS)))
+        with mock.patch('time.time', return_value=1000 + presence.PRESENCE_STALE_AFTER - 1):
+            presence.heartbeat()
+        with mock.patch('time.time', return_value=1000 + presence.PRESENCE_STALE_AFTER + 1):
+            connections = presence.get_many_connections([self.user.pk])[self.user.pk]
+        self.assertEqual([connection['kind'] for connection in connections], [presence.KIND_NOTIFICATIONS])
+        self.assertEqual(presence.flush_all_history(), 1)
+        session = Session.objects.get(user=self.user)
+        self.assertEqual(session.ended_at, datetime.fromtimestamp(1000, tz=timezone.utc))
+
+    def test_failed_flush_keeps_history(self):
+        presence.connect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+        presence.disconnect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+        with mock.patch.object(Session.objects, 'bulk_create', side_effect=DatabaseError('database is locked')):
+            with self.assertRaises(DatabaseError):
+                presence.flush_history()
+        self.assertEqual(presence.get_connection().llen(presence.HISTORY_KEY), 1)
+        self.assertEqual(presence.flush_all_history(), 1)
+        self.assertEqual(presence.get_connection().llen(presence.HISTORY_KEY), 0)
+        self.assertEqual(Session.objects.get(user=self.user).channel_name, 'channel.1')
+
+    def test_flush_is_skipped_while_another_worker_flushes(self):
+        presence.connect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+        presence.disconnect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+        lock = presence.get_connection().lock(presence.HISTORY_LOCK_KEY, timeout=60)
+        lock.acquire(blocking=False)
+        self.assertEqual(presence.flush_history(), 0)
+        lock.release()
+        self.assertEqual(presence.flush_history(), 1)
+
+    def test_notifications_connections_have_no_history(self):
+        now = time.time()
+        presence.connect(self.user.pk, 'channel.1', presence.KIND_NOTIFICATIONS)
+        presence.connect(self.user.pk, 'channel.2', presence.KIND_NOTIFICATIONS)
+        presence.disconnect(self.user.pk, 'channel.1', presence.KIND_NOTIFICATIONS, keep_history=False)
+        # channel.2 is pruned as stale
+        with mock.patch('time.time', return_value=now + presence.PRESENCE_STALE_AFTER + 1):
+            self.assertEqual(self.kinds(), [])
+        self.assertEqual(presence.get_connection().llen(presence.HISTORY_KEY), 0)
+
+    def test_heartbeat_restores_pruned_connection(self):
+        with mock.patch('time.time', return_value=1000):
+            presence.connect(self.user.pk, 'channel.1', presence.KIND_CHATS)
+        with mock.patch('time.time', return_value=1000 + presence.PRESENCE_STALE_AFTER + 1):
+            self.assertEqual(self.kinds(), [])
+            presence.heartbeat()
+            self.assertEqual(self.kinds(), [presence.KIND_CHATS])
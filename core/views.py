@@ -0,0 +1,25 @@
+from rest_framework import permissions, status
+from rest_framework.exceptions import NotAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .exceptions import NotAuthenticatedRequest
+from .renderers import StandardRenderer
+from . import outbound
+
+
+class OutboundStatsApiView(APIView):
+    renderer_classes = (StandardRenderer,)
+    permission_classes = (permissions.IsAdminUser,)
+
+    """
+        Outbound queues counters of the worker serving the request (see `core.outbound`).
+    """
+
+    def get(self, request):
+        return Response(outbound.get_stats(), status=status.HTTP_200_OK)
+
+    def permission_denied(self, request, message=None, code=None):
+        try:
+            super(OutboundStatsApiView, self).permission_denied(request, message, code)
+        except NotAuthenticated:
+            raise NotAuthenticatedRequest()
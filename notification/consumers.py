@@ -1,8 +1,12 @@
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from authentication.exceptions import auth_user_not_found
+from core import presence
+from core.outbound import OutboundQueueMixin
+from .digests import digest_frame, merge_digest_frames
 
 
-class NotificationsConsumer(AsyncJsonWebsocketConsumer):
+class NotificationsConsumer(OutboundQueueMixin, AsyncJsonWebsocketConsumer):
     user = None
     notifications_group_name = None
 
@@ -14,6 +18,7 @@ class NotificationsConsumer(AsyncJsonWebsocketConsumer):
             return await self.close(code=auth_user_not_found())
         # Init Session
         await self.start_notification_session()
+        presence.ensure_heartbeat()
         self.notifications_group_name = self.user.notifications_group
         await self.channel_layer.group_add(self.notifications_group_name, self.channel_name)
 
@@ -23,14 +28,15 @@ class NotificationsConsumer(AsyncJsonWebsocketConsumer):
             await self.end_notification_session()
 
     async def chat_message(self, event):
-        message = event['message']
-        await self.send_json(content={
-            'type': 'NEW_MESSAGE',
-            'data': message
-        })
+        # Digests of the same chat still queued for a slow client add up
+        chat_id = event.get('chat_id')
+        self.queue_json(digest_frame(event['message'], event.get('count', 1)),
+                        key=('notifications', chat_id) if chat_id else None, merge=merge_digest_frames)
 
-    async def start_notification_session(self):
-        self.user.activate_notifications()
+    @database_sync_to_async
+    def start_notification_session(self):
+        presence.connect(self.user.pk, self.channel_name, presence.KIND_NOTIFICATIONS)
 
-    async def end_notification_session(self):
-        self.user.deactivate_notifications()
+    @database_sync_to_async
+    def end_notification_session(self):
+        presence.disconnect(self.user.pk, self.channel_name, presence.KIND_NOTIFICATIONS, keep_history=False)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from django.conf import settings
+
+"""
+    Debounced notifications.
+    New messages of a chat are gathered per worker while the chat keeps receiving messages within
+    `NOTIFICATION_DIGEST_WINDOW` seconds (but no longer than `NOTIFICATION_DIGEST_MAX_DELAY` seconds), then every
+    recipient gets one digest event with the count of messages it was a recipient of and the latest message, whose
+    chat and sender are serialized once. Recipients are resolved again when the digest is sent, so a recipient that
+    opened the chat meanwhile gets nothing.
+    Digests of the same chat waiting in a recipient outbound queue are merged as well (see `merge_digest_frames`).
+"""
+
+NOTIFICATION_DIGEST_WINDOW = getattr(settings, 'NOTIFICATION_DIGEST_WINDOW', 1.5)
+NOTIFICATION_DIGEST_MAX_DELAY = getattr(settings, 'NOTIFICATION_DIGEST_MAX_DELAY', 5)
+
+logger = logging.getLogger(__name__)
+
+
+def digest_frame(message, count):
+    """
+        @return notifications socket frame, a single message keeps `NEW_MESSAGE` frame.
+    """
+    if count == 1:
+        return {'type': 'NEW_MESSAGE', 'data': message}
+    return {'type': 'NEW_MESSAGES', 'data': {'count': count, 'message': message}}
+
+
+def frame_count(frame):
+    return 1 if frame['type'] == 'NEW_MESSAGE' else frame['data']['count']
+
+
+def frame_message(frame):
+    return frame['data'] if frame['type'] == 'NEW_MESSAGE' else frame['data']['message']
+
+
+def merge_digest_frames(old, new):
+    return digest_frame(frame_message(new), frame_count(old) + frame_count(new))
+
+
+class NotificationDigests:
+    def __init__(self, window=NOTIFICATION_DIGEST_WINDOW, max_delay=NOTIFICATION_DIGEST_MAX_DELAY):
+        self.window = window
+        self.max_delay = max_delay
+        # {chat_id: {'messaging', 'counts': {notifications group: count}, 'message', 'first_at', 'last_at'}}
+        self.pending = {}
+        self.tasks = {}
+
+    def add(self, messaging, groups, messages):
+        """
+            @param messaging: `ChatMessaging` of the sender, it forwards the digest.
+            @param groups: notifications groups of recipients of these messages, every recipient counts the messages
+                           it was a recipient of.
+        """
+        if not groups or not messages:
+            return
+        now = time.monotonic()
+        chat_id = messaging.chat.pk
+        digest = self.pending.get(chat_id)
+        if digest is None:
+            digest = self.pending[chat_id] = {'counts': {}, 'first_at': now}
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.ensure_future(self.wait(chat_id))
+        for group in groups:
+            digest['counts'][group] = digest['counts'].get(group, 0) + len(messages)
+        # Latest message with its sender is the one shown
+        digest['messaging'] = messaging
+        digest['message'] = dict(messages[-1])
+        digest['last_at'] = now
+
+    def get_delay(self, chat_id):
+        """
+            @return seconds until the chat digest is due, `window` after the latest message within `max_delay`.
+        """
+        digest = self.pending[chat_id]
+        return min(digest['last_at'] + self.window, digest['first_at'] + self.max_delay) - time.monotonic()
+
+    async def wait(self, chat_id):
+        try:
+            delay = self.get_delay(chat_id)
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.get_delay(chat_id)
+        finally:
+            self.tasks.pop(chat_id, None)
+        await self.flush(chat_id)
+
+    async def flush(self, chat_id):
+        """
+            Sends the chat digest, recipients active at the chat meanwhile are skipped (see
+            `ChatMessaging.forward_to_users_notifications`).
+        """
+        digest = self.pending.pop(chat_id, None)
+        if digest is None:
+            return
+        try:
+            await digest['messaging'].forward_to_users_notifications(digest['counts'], digest['message'])
+        except Exception:
+            logger.exception('Sending notifications digest of chat %s failed', chat_id)
+
+
+digests = NotificationDigests()
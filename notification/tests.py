@@ -1,3 +1,60 @@
-from django.test import TestCase
+import asyncio
+from unittest import mock
+from django.test import SimpleTestCase
+from chat.messaging import ChatMessaging
+from . import digests
 
-# Create your tests here.
+
+class NotificationDigestsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.messaging = mock.Mock(chat=mock.Mock(pk=1), forward_to_users_notifications=mock.AsyncMock())
+        self.aggregator = digests.NotificationDigests(window=2, max_delay=5)
+
+    def run_at(self, now, coroutine):
+        async def run():
+            with mock.patch('time.monotonic', return_value=now):
+                result = await coroutine()
+            # Flushes are driven by tests
+            for task in list(self.aggregator.tasks.values()):
+                task.cancel()
+            self.aggregator.tasks.clear()
+            return result
+
+        return asyncio.run(run())
+
+    def add(self, now, groups, messages):
+        async def add():
+            self.aggregator.add(self.messaging, groups, messages)
+            return self.aggregator.get_delay(1)
+
+        return self.run_at(now, add)
+
+    def test_recipients_count_messages_they_were_recipients_of(self):
+        self.add(100, ['notifications_10'], [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.add(101, ['notifications_10', 'notifications_11'], [{'id': 3}]), 2)
+        self.run_at(103, lambda: self.aggregator.flush(1))
+        self.messaging.forward_to_users_notifications.assert_awaited_once_with(
+            {'notifications_10': 3, 'notifications_11': 1}, {'id': 3})
+        self.assertEqual(self.aggregator.pending, {})
+
+    def test_digest_is_due_within_max_delay(self):
+        self.add(100, ['notifications_10'], [{'id': 1}])
+        self.assertEqual(self.add(104.5, ['notifications_10'], [{'id': 2}]), 0.5)
+
+    def test_queued_digests_frames_are_merged(self):
+        frame = digests.merge_digest_frames(digests.digest_frame({'id': 1}, 1), digests.digest_frame({'id': 4}, 3))
+        self.assertEqual(frame, {'type': 'NEW_MESSAGES', 'data': {'count': 4, 'message': {'id': 4}}})
+
+
+class ForwardNotificationsTestCase(SimpleTestCase):
+    @mock.patch('chat.messaging.group_send_many', new_callable=mock.AsyncMock)
+    def test_only_current_recipients_get_their_counts(self, group_send_many):
+        messaging = ChatMessaging(mock.Mock(), mock.Mock(pk=10), mock.Mock(pk=1))
+        # notifications_12 opened the chat meanwhile
+        current_groups = {'notifications_11', 'notifications_13'}
+        with mock.patch.object(ChatMessaging, 'prepare_message_to_notification',
+                               mock.AsyncMock(return_value=current_groups)):
+            asyncio.run(messaging.forward_to_users_notifications(
+                {'notifications_11': 3, 'notifications_12': 3, 'notifications_13': 1}, {'id': 3}))
+        sent = {(tuple(call.args[1]), call.args[2]['count']) for call in group_send_many.await_args_list}
+        self.assertEqual(sent, {(('notifications_11',), 3), (('notifications_13',), 1)})